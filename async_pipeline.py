@@ -0,0 +1,248 @@
+"""
+async_pipeline.py — asyncio orchestration of the per-TU stages (main.py --async-pipeline).
+
+In the thread pool of main.py one worker carries a TU through the probe
+compile and the value read, so a TU stuck in a long retry loop holds its
+worker while cheap steps of other TUs wait.  Here every stage has its own
+limit (StageLimits):
+
+  preprocess  concurrent `-E -dM` runs (asyncio.create_subprocess_exec)
+  compile     concurrent probe compiles.  The first attempt of every probe
+              (shard) runs with create_subprocess_exec; a failing probe keeps
+              its slot for the whole retry loop, which runs in a thread.
+  read        concurrent reads of the values from the probe objects.
+
+Compiled TUs reach the read stage through a bounded queue: compiles go on
+while reads catch up, and a backlog of unread TUs holds back new compiles.
+There is no queue after the preprocess stage, since the global probe planner
+needs every TU's dump before any probe is built.
+
+On Ctrl-C (or any cancellation) running compilers are killed, retry loops
+give up after their current compile, and the probe files and memo claims of
+unfinished TUs are released before KeyboardInterrupt reaches the caller.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import threading
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from core import PreparedFile, ProbeJob, compile_probe_async, evaluation_fingerprint, prepare_file_async
+from driver_cache import DriverCache
+from probe_memo import FingerprintRegistry
+
+
+class StageLimits(NamedTuple):
+    """How many TUs may be in each stage at once."""
+    preprocess: int
+    compile: int
+    read: int
+
+
+# Compiled TUs waiting to be read, per read slot
+_READ_BACKLOG = 2
+
+
+def preprocess_files(jobs: Sequence[Tuple[str, str, str]],
+                     limits: StageLimits,
+                     clang_exec: str = "clang",
+                     collect_dependencies: bool = False,
+                     drivers: Optional[DriverCache] = None,
+                     priorities: Optional[Sequence[float]] = None) -> List[PreparedFile]:
+    """
+    core.prepare_file() for every (source_file, original_cmd, directory) of
+    *jobs*, at most limits.preprocess at a time, highest priorities (e.g.
+    job_costs estimates) first.  Files that fail are logged and left out.
+    """
+    return asyncio.run(_preprocess_files(jobs, limits, clang_exec, collect_dependencies, drivers, priorities))
+
+
+def _by_priority(count: int, priorities: Optional[Sequence[float]]) -> List[int]:
+    if priorities is None:
+        return list(range(count))
+    return sorted(range(count), key=lambda i: -priorities[i])
+
+
+async def _preprocess_files(jobs, limits, clang_exec, collect_dependencies, drivers, priorities) -> List[PreparedFile]:
+    slots = asyncio.Semaphore(limits.preprocess)
+    results = [None] * len(jobs)
+
+    async def preprocess(i):
+        async with slots:
+            results[i] = await prepare_file_async(*jobs[i], clang_exec, collect_dependencies, drivers)
+
+    # Tasks take the semaphore in the order they are created
+    outcomes = await asyncio.gather(*(preprocess(i) for i in _by_priority(len(jobs), priorities)),
+                                    return_exceptions=True)
+    for outcome in outcomes:
+        if isinstance(outcome, Exception):
+            logging.getLogger("core").error(f"Error preprocessing file: {outcome}")
+    return [prepared for prepared in results if prepared is not None]
+
+
+def evaluate_files(items: Sequence[Tuple[PreparedFile, Optional[Set[str]], object]],
+                   limits: StageLimits,
+                   on_done: Callable[[], None],
+                   fingerprints: Optional[FingerprintRegistry] = None,
+                   priorities: Optional[Sequence[float]] = None,
+                   **options) -> List[Optional[Dict]]:
+    """
+    core.evaluate_prepared() for every (prepared, only_names, pch) of *items*,
+    with the compile and read steps in separate stages, highest priorities
+    first.  *options* are the
+    remaining keyword arguments of evaluate_prepared() (clang_exec, memo,
+    shards, pipe, ...).  on_done() is called as each TU succeeds; the
+    return value holds the macro dicts in the order of *items* (None where a
+    TU failed).
+    """
+    return asyncio.run(_ProbeStages(limits, on_done, fingerprints, options).run(items, priorities))
+
+
+class _ProbeStages:
+    """The compile and read stages of evaluate_files()."""
+
+    def __init__(self,
+                 limits: StageLimits,
+                 on_done: Callable[[], None],
+                 fingerprints: Optional[FingerprintRegistry],
+                 options: Dict):
+        self.limits = limits
+        self.on_done = on_done
+        self.fingerprints = fingerprints
+        self.options = options
+        # Building probe TUs, retry loops and reads run in threads; with a
+        # thread for every slot of both stages, none waits for another
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2 * limits.compile + limits.read)
+        self.stop = threading.Event()
+        self.results: List[Optional[Dict]] = []
+        # One asyncio.Lock per fingerprint: a TU waits here (not in a
+        # thread) while an identical TU is being evaluated
+        self.fp_locks: Dict[str, asyncio.Lock] = {}
+        # Started jobs not closed yet (closed on the way out if cancelled)
+        self.live: Set[ProbeJob] = set()
+        self.live_lock = threading.Lock()
+
+    async def run(self, items, priorities: Optional[Sequence[float]] = None) -> List[Optional[Dict]]:
+        self.results = [None] * len(items)
+        todo: asyncio.Queue = asyncio.Queue()
+        for i in _by_priority(len(items), priorities):
+            todo.put_nowait((i, *items[i]))
+        compiled: asyncio.Queue = asyncio.Queue(maxsize=_READ_BACKLOG * self.limits.read)
+        compile_slots = asyncio.Semaphore(self.limits.compile)
+
+        try:
+            async with asyncio.TaskGroup() as tg:
+                readers = [tg.create_task(self._read_stage(compiled)) for _ in range(self.limits.read)]
+                compilers = [tg.create_task(self._compile_stage(todo, compiled, compile_slots))
+                             for _ in range(self.limits.compile)]
+                await asyncio.gather(*compilers)
+                for _ in readers:
+                    await compiled.put(None)
+        finally:
+            self.stop.set()
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            for job in list(self.live):
+                self._close(job)
+        return self.results
+
+    # -- compile stage --------------------------------------------------------
+
+    async def _compile_stage(self, todo: asyncio.Queue, compiled: asyncio.Queue, slots: asyncio.Semaphore) -> None:
+        loop = asyncio.get_running_loop()
+        while not todo.empty():
+            i, prepared, only_names, pch = todo.get_nowait()
+            fp = None
+            if self.fingerprints is not None:
+                fp = evaluation_fingerprint(prepared, self.options.get("clang_exec", "clang"),
+                                            self.options.get("header_only", False), only_names)
+                lock = self.fp_locks.setdefault(fp, asyncio.Lock())
+                await lock.acquire()
+                # Never blocks: whoever held the lock published or abandoned fp
+                owner, shared = self.fingerprints.claim(fp)
+                if not owner:
+                    lock.release()
+                    logging.getLogger("core").info(
+                        f"Reusing result of an identical macro environment for {prepared.source_file} ({fp[:12]})"
+                    )
+                    self._deliver(i, shared)
+                    continue
+
+            job = None
+            try:
+                logging.getLogger("core").info(f"Processing: {prepared.source_file}")
+                job = await loop.run_in_executor(self.executor, self._start, prepared, only_names, pch)
+                outcomes = await self._compile(job, slots)
+                if job.pch_failed:
+                    logging.getLogger("core").warning(
+                        f"Probes of {prepared.source_file} do not compile with the shared PCH; retrying without it"
+                    )
+                    self._close(job)
+                    job = await loop.run_in_executor(self.executor, self._start, prepared, only_names, None)
+                    outcomes = await self._compile(job, slots)
+            except Exception as e:
+                logging.getLogger("core").error(f"Error processing file: {e}")
+                if job is not None:
+                    self._close(job)
+                self._settle(fp, None)
+                continue
+            await compiled.put((i, fp, job, outcomes))
+
+    async def _compile(self, job: ProbeJob, slots: asyncio.Semaphore) -> List[Tuple[bool, List[str]]]:
+        async def compile_one(probe):
+            async with slots:
+                return await compile_probe_async(job, probe, self.executor, self.stop)
+
+        async with asyncio.TaskGroup() as tg:
+            tasks = [tg.create_task(compile_one(probe)) for probe in job.probes]
+        return [task.result() for task in tasks]
+
+    def _start(self, prepared: PreparedFile, only_names, pch) -> ProbeJob:
+        job = ProbeJob.start(prepared, only_names=only_names, pch=pch, **self.options)
+        with self.live_lock:
+            self.live.add(job)
+        return job
+
+    # -- read stage -----------------------------------------------------------
+
+    async def _read_stage(self, compiled: asyncio.Queue) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            entry = await compiled.get()
+            if entry is None:
+                return
+            i, fp, job, outcomes = entry
+            macros = None
+            try:
+                macros = await loop.run_in_executor(self.executor, job.finish, outcomes)
+            except Exception as e:
+                logging.getLogger("core").error(f"Error processing file: {e}")
+            finally:
+                self._close(job)
+            self._settle(fp, macros)
+            self._deliver(i, macros)
+
+    # -- bookkeeping ----------------------------------------------------------
+
+    def _close(self, job: ProbeJob) -> None:
+        with self.live_lock:
+            if job not in self.live:
+                return
+            self.live.discard(job)
+        job.close()
+
+    def _settle(self, fp: Optional[str], macros: Optional[Dict]) -> None:
+        """Publish (or abandon) a claimed fingerprint and let the next TU with it in."""
+        if fp is None:
+            return
+        if macros is None:
+            self.fingerprints.abandon(fp)
+        else:
+            self.fingerprints.publish(fp, macros)
+        self.fp_locks[fp].release()
+
+    def _deliver(self, i: int, macros: Optional[Dict]) -> None:
+        if macros is None:
+            return
+        self.results[i] = macros
+        self.on_done()
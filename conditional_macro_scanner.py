@@ -8,9 +8,9 @@ every macro identifier referenced inside a preprocessing conditional directive:
     #elif       #elifdef    #elifndef   (C23 / GCC extension)
 
 Handles many real-world complexities:
-  - Line continuations (backslash-newline) → joins them before parsing
-  - Single-line comments (//) stripped before scanning
-  - Block comments (/* … */) stripped across lines
+  - Line continuations (backslash-newline) → joined into one logical line
+  - Single-line comments (//) and block comments (/* … */, across lines)
+  - String and character literals (a `//` or `/*` inside "…" is not a comment)
   - Both `defined(MACRO)` and `defined MACRO` syntax
   - Free-standing identifier references in expressions:
         #if TIMEOUT > 0
@@ -20,30 +20,42 @@ Handles many real-world complexities:
   - C keywords used in #if expressions (e.g. `defined`) are excluded
   - Standard C/C++ compiler-internal double-underscore names are excluded
 
+Files are scanned in a process pool (collect_conditional_macros(jobs=...)).
+Each file is mmapped; a file without a single `#` byte is skipped before
+decoding, and the rest go through a single-pass lexer (_lex_directives) that
+handles continuations, comments, literals and directive detection together,
+jumping from one significant character to the next instead of building
+joined / comment-stripped copies of the file.
+
+`python conditional_macro_scanner.py --benchmark <dir>` compares its
+throughput with the earlier regex-based scanners.
+
+With an index_path, per-file results are kept in a scan_index.ScanIndex and
+only files that changed since the previous run are read and parsed again.
+
 Public API:
-    collect_conditional_macros(repo_dir: str) -> set[str]
+    collect_conditional_macros(repo_dir: str, jobs: int | None = None,
+                               index_path: str | None = None) -> set[str]
+    scan_conditional_macros(paths: list[str], jobs: int | None = None,
+                            index_path: str | None = None) -> set[str]
 """
 
 from __future__ import annotations
 
+import hashlib
+import logging
+import mmap
 import os
 import re
-from pathlib import Path
-from typing import Set
-
-# ---------------------------------------------------------------------------
-# Source file extensions to scan
-# ---------------------------------------------------------------------------
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 
-_SOURCE_EXTENSIONS = frozenset({
-    ".c", ".h",
-    ".cpp", ".cxx", ".cc",
-    ".hpp", ".hxx", ".hh",
-    ".inl", ".inc",
-})
+from repo_crawler import RepoEntry, crawl_repo
+from scan_index import IndexEntry, ScanIndex
 
-# Directories to skip entirely during the tree walk
-_SKIP_DIRS = frozenset({"build", ".git", ".svn", ".hg", "node_modules"})
+# Bump when a change to the scanner can change the names found in a file;
+# a scan index written by another version is discarded.
+_SCANNER_VERSION = "2"
 
 # ---------------------------------------------------------------------------
 # Keywords / built-ins that appear in #if expressions but are NOT user macros
@@ -82,6 +94,11 @@ _DIRECTIVE_RE = re.compile(
     re.VERBOSE | re.IGNORECASE,
 )
 
+# _DIRECTIVE_RE without the line-start anchor: starting with a literal '#'
+# lets the regex engine jump between candidates; the caller checks that only
+# blanks precede the '#' on its line.
+_DIRECTIVE_HASH_RE = re.compile(r"\#[ \t]*(if|ifdef|elif|elifdef)\b(.*)", re.IGNORECASE)
+
 # Identifiers: sequences of letters, digits, underscores starting with letter or underscore
 _IDENTIFIER_RE = re.compile(r"\b([A-Za-z_][A-Za-z0-9_]*)\b")
 
@@ -90,6 +107,44 @@ _BLOCK_COMMENT_RE = re.compile(r"/\*.*?\*/", re.DOTALL)
 # Single-line comment
 _LINE_COMMENT_RE = re.compile(r"//.*")
 
+# ---------------------------------------------------------------------------
+# Single-pass lexer patterns (newlines may be \n, \r\n or \r)
+# ---------------------------------------------------------------------------
+
+# Block comment; an unterminated one runs to the end of the text
+_LEX_BLOCK_COMMENT = r"/\*[^*]*\*+(?:[^/*][^*]*\*+)*/|/\*[\s\S]*"
+# // comment, continued across backslash-newlines
+_LEX_LINE_COMMENT = r"//(?:[^\\\r\n]+|\\(?:\r\n?|\n)?)*"
+# String / character literal; an unterminated one ends at the newline
+_LEX_LITERAL = r""""(?:[^"\\\r\n]+|\\(?:\r\n?|\n|.))*"?|'(?:[^'\\\r\n]+|\\(?:\r\n?|\n|.))*'?"""
+_LEX_CONTINUATION = r"\\(?:\r\n?|\n)"
+
+# One token per match; the text between tokens is skipped inside the regex
+# engine.  Comments and literals are consumed whole, so a '#' or comment
+# marker inside them never becomes a token.  A '#' or a continuation is only
+# a token if what follows could make it matter (a conditional directive
+# name, a comment, a continuation), and consecutive // comment lines are
+# one token.  (No capturing groups: they would disable the engine's
+# first-character scan; tokens are told apart by their first characters.)
+_LEX_TOKEN_RE = re.compile(
+    r"\#(?=[ \t]*(?:(?i:if|ifdef|elif|elifdef)\b|/\*|\\))"
+    + "|" + _LEX_BLOCK_COMMENT
+    + "|" + _LEX_LINE_COMMENT + r"(?:(?:\r\n?|\n)[ \t]*" + _LEX_LINE_COMMENT + ")*"
+    + "|" + _LEX_LITERAL
+    + "|" + _LEX_CONTINUATION + r"(?=[ \t]*[\#/\\])"
+)
+# After a block comment or continuation: could a directive '#' still follow?
+_LEX_MAY_PRECEDE_HASH_RE = re.compile(r"[ \t]*(?:\#|/\*|\\)")
+# Text between tokens that keeps a line "blank"
+_LEX_BLANK_RE = re.compile(r"[ \t]*")
+# Next token inside a directive line; a bare newline ends the line
+_LEX_DIRECTIVE_RE = re.compile(
+    f"(?P<block>{_LEX_BLOCK_COMMENT})|(?P<line>{_LEX_LINE_COMMENT})|(?P<literal>{_LEX_LITERAL})"
+    f"|(?P<cont>{_LEX_CONTINUATION})|(?P<end>\\r\\n?|\\n)"
+)
+# Logical directive line (after the '#', with comments and literals blanked)
+_LEX_BODY_RE = re.compile(r"[ \t]*(if|ifdef|elif|elifdef)\b(.*)", re.IGNORECASE)
+
 # ---------------------------------------------------------------------------
 # Internal helpers
 # ---------------------------------------------------------------------------
@@ -177,53 +232,336 @@ def _process_file(path: str) -> Set[str]:
         m = _DIRECTIVE_RE.match(line)
         if not m:
             continue
+        _collect_directive(m, found)
+
+    return found
+
+
+def _collect_directive(m: re.Match, found: Set[str]) -> None:
+    """Add the macro names referenced by one _DIRECTIVE_RE match to *found*."""
+    _add_directive_names(m.group(1).lower(), m.group(2), found)
+
 
-        directive = m.group(1).lower()   # if / ifdef / ifndef / elif / elifdef / elifndef
-        expr = m.group(2).strip()
-
-        if directive in ("ifdef", "ifndef", "elifdef", "elifndef"):
-            # These are followed directly by a single identifier (no expression).
-            # Extract just that identifier.
-            id_m = _IDENTIFIER_RE.match(expr.lstrip())
-            if id_m:
-                name = id_m.group(1)
-                if (name not in _NON_MACRO_KEYWORDS
-                        and not (name.startswith("__") and name.endswith("__"))):
-                    found.add(name)
+def _add_directive_names(directive: str, expr: str, found: Set[str]) -> None:
+    """Add the macro names referenced by one conditional directive to *found*."""
+    # directive: if / ifdef / ifndef / elif / elifdef / elifndef (lower case)
+    expr = expr.strip()
+
+    if directive in ("ifdef", "ifndef", "elifdef", "elifndef"):
+        # These are followed directly by a single identifier (no expression).
+        # Extract just that identifier.
+        id_m = _IDENTIFIER_RE.match(expr.lstrip())
+        if id_m:
+            name = id_m.group(1)
+            if (name not in _NON_MACRO_KEYWORDS
+                    and not (name.startswith("__") and name.endswith("__"))):
+                found.add(name)
+    else:
+        # #if / #elif — full expression; collect all identifiers.
+        found.update(_extract_identifiers_from_expression(expr))
+
+
+def _lex_directive_line(text: str, pos: int) -> Optional[Tuple[str, str]]:
+    """
+    (directive, expression) of the directive whose '#' ends at *pos*, if it
+    is a conditional directive.  Continuations are dropped and comments and
+    literals replaced by a blank; this one logical line is the only text
+    copied.
+    """
+    parts: List[str] = []
+    while True:
+        m = _LEX_DIRECTIVE_RE.search(text, pos)
+        if m is None:
+            parts.append(text[pos:])
+            break
+        parts.append(text[pos:m.start()])
+        kind = m.lastgroup
+        if kind == "end":
+            break
+        if kind == "block" or kind == "literal":
+            parts.append(" ")
+        pos = m.end()
+
+    body = _LEX_BODY_RE.match("".join(parts))
+    if body is None:
+        return None
+    return body.group(1).lower(), body.group(2)
+
+
+def _lex_at_line_start(text: str, pos: int, blank_end: Optional[int], has_cr: bool) -> bool:
+    """
+    True if only blanks, comments and continuations precede *pos* on its
+    logical line.  *blank_end* is where the last such run of comments /
+    continuations ended (see _lex_directives), or None.
+    """
+    if blank_end is not None and _LEX_BLANK_RE.fullmatch(text, blank_end, pos) is not None:
+        return True
+    line_start = text.rfind("\n", 0, pos) + 1
+    if has_cr:
+        line_start = max(line_start, text.rfind("\r", 0, pos) + 1)
+    if _LEX_BLANK_RE.fullmatch(text, line_start, pos) is None:
+        return False
+    return not _lex_continues_line(text, line_start)
+
+
+def _lex_continues_line(text: str, line_start: int) -> bool:
+    """True if the physical line at *line_start* continues the previous one (backslash-newline)."""
+    return ((line_start >= 2 and text[line_start - 2] == "\\" and text[line_start - 1] in "\r\n")
+            or (line_start >= 3 and text[line_start - 3:line_start] == "\\\r\n"))
+
+
+def _lex_directives(text: str) -> Iterator[Tuple[str, str]]:
+    """
+    Single-pass lexer: yield (directive, expression) for every conditional
+    directive in *text*, with the line semantics of _process_file().
+
+    Tokens are '#', comments, literals and continuations; everything else is
+    skipped by the token regex.  A '#' starts a directive if only blanks
+    precede it on its logical line — or blanks after a run of comments and
+    continuations that itself started the line, whose end is kept in
+    *blank_end*.
+    """
+    has_cr = "\r" in text
+    blank_end: Optional[int] = None
+    # Literals only need lexing one by one on physical lines where a comment
+    # marker or continuation follows them; other lines are skipped from the
+    # first quote on.  *literal_line_end* is the end of the line already
+    # known to need it.
+    literal_line_end = -1
+    search = _LEX_TOKEN_RE.search
+    pos = 0
+    while True:
+        m = search(text, pos)
+        if m is None:
+            return
+        start = m.start()
+        pos = m.end()
+        c = text[start]
+        if c == "#":
+            if (text[start - 1:start] == "\n" and not _lex_continues_line(text, start)) \
+                    or _lex_at_line_start(text, start, blank_end, has_cr):
+                directive = _lex_directive_line(text, start + 1)
+                if directive is not None:
+                    yield directive
+            blank_end = None
+        elif c == '"' or c == "'":
+            blank_end = None
+            if start > literal_line_end:
+                line_end = text.find("\n", start)
+                if line_end < 0:
+                    line_end = len(text)
+                if has_cr:
+                    cr = text.find("\r", start, line_end)
+                    if cr >= 0:
+                        line_end = cr
+                if (text.find("/", start, line_end) < 0
+                        and text.find("\\", line_end - 1, line_end) < 0):
+                    pos = max(pos, line_end)  # nothing on this line can matter
+                else:
+                    literal_line_end = line_end
+        elif c == "\\" or text.startswith("/*", start):
+            # Block comment or continuation: the line stays blank if it was
+            if (_LEX_MAY_PRECEDE_HASH_RE.match(text, pos) is not None
+                    and _lex_at_line_start(text, start, blank_end, has_cr)):
+                blank_end = pos
+            else:
+                blank_end = None
         else:
-            # #if / #elif — full expression; collect all identifiers.
-            found.update(_extract_identifiers_from_expression(expr))
+            blank_end = None  # line comment
+
+
+def _scan_text_regex(text: str) -> Set[str]:
+    """
+    The previous whole-text scanner: join continuations, strip comments with
+    _BLOCK_COMMENT_RE / _LINE_COMMENT_RE, then run the directive regex at
+    every '#'.  Only kept as a baseline for --benchmark.
+    """
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = text.replace("\\\n", "")
+
+    found: Set[str] = set()
+    clean_text = _strip_comments(text)
+    for m in _DIRECTIVE_HASH_RE.finditer(clean_text):
+        line_start = clean_text.rfind("\n", 0, m.start()) + 1
+        if clean_text[line_start:m.start()].strip(" \t"):
+            continue  # '#' in the middle of a line, not a directive
+        _collect_directive(m, found)
+    return found
+
 
+def _scan_text(text: str) -> Set[str]:
+    """Macro names referenced by the conditional directives of *text*."""
+    found: Set[str] = set()
+    for directive, expr in _lex_directives(text):
+        _add_directive_names(directive, expr, found)
     return found
 
 
+def _read_source(path: str) -> Optional[str]:
+    """Decoded contents of *path*, or None if it is empty, unreadable or has no '#'."""
+    try:
+        with open(path, "rb") as fh:
+            if os.fstat(fh.fileno()).st_size == 0:
+                return None
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm.find(b"#") < 0:
+                    return None
+                data = mm[:]
+    except (OSError, ValueError):
+        return None
+    return data.decode("utf-8", errors="replace")
+
+
+def _scan_file(path: str) -> Set[str]:
+    """
+    Same result as _process_file() (except that comment markers inside
+    string literals are no longer treated as comments), but the file is
+    mmapped and skipped without decoding if it has no `#`, and the text goes
+    through the single-pass lexer.
+    """
+    text = _read_source(path)
+    if text is None:
+        return set()
+    return _scan_text(text)
+
+
+def _scan_files(paths: List[str]) -> Set[str]:
+    """Process-pool task: scan a batch of files."""
+    found: Set[str] = set()
+    for path in paths:
+        found.update(_scan_file(path))
+    return found
+
+
+def _scan_indexed_files(items: List[Tuple[str, Optional[bytes]]]) -> List[Tuple[str, Optional[IndexEntry]]]:
+    """
+    Process-pool task for collect_conditional_macros(index_path=...): scan a
+    batch of (path, previous digest) and return (path, IndexEntry).  A file
+    whose contents still hash to its previous digest is not parsed; its
+    entry then has names=None.  Unreadable files give None.
+    """
+    results = []
+    for path, previous_digest in items:
+        try:
+            with open(path, "rb") as fh:
+                st = os.fstat(fh.fileno())
+                data = fh.read()
+        except OSError:
+            results.append((path, None))
+            continue
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        if digest == previous_digest:
+            names = None
+        elif b"#" not in data:
+            names = ()
+        else:
+            names = tuple(sorted(_scan_text(data.decode("utf-8", errors="replace"))))
+        results.append((path, IndexEntry(st.st_mtime_ns, st.st_size, digest, names)))
+    return results
+
+
 # ---------------------------------------------------------------------------
 # Public API
 # ---------------------------------------------------------------------------
 
 
-def collect_conditional_macros(repo_dir: str) -> Set[str]:
+# Below this many files a process pool costs more than it saves
+_PARALLEL_MIN_FILES = 256
+# Files handed to a pool worker per task
+_BATCH_SIZE = 64
+
+
+def collect_conditional_macros(repo_dir: str,
+                               jobs: Optional[int] = None,
+                               index_path: Optional[str] = None,
+                               entries: Optional[List[RepoEntry]] = None) -> Set[str]:
     """
     Recursively walk *repo_dir*, scanning every C/C++/header source file
     for macro identifiers used inside conditional compilation directives.
 
+    *jobs* is the number of scanner processes (default: CPU count); with
+    jobs=1 or a small tree the files are scanned in-process.  *index_path*
+    is a scan index (SQLite file) to reuse and update.  *entries* is the
+    repo_crawler listing of *repo_dir* if the caller already has it.
+
     Returns a set of macro names (strings).
     """
-    all_macros: Set[str] = set()
-    repo_path = Path(repo_dir)
+    if entries is None:
+        entries = crawl_repo(repo_dir)
+    paths = [entry.path for entry in entries]
+    if index_path is not None:
+        stats = {entry.path: (entry.mtime_ns, entry.size) for entry in entries}
+        return _collect_indexed(paths, jobs, ScanIndex(index_path, _SCANNER_VERSION), stats)
+    return scan_conditional_macros(paths, jobs)
+
+
+def scan_conditional_macros(paths: List[str],
+                            jobs: Optional[int] = None,
+                            index_path: Optional[str] = None) -> Set[str]:
+    """
+    Like collect_conditional_macros(), but for an explicit list of files
+    (e.g. the include closure of a build), whatever their extension.
+    """
+    paths = list(dict.fromkeys(paths))
+    if index_path is not None:
+        return _collect_indexed(paths, jobs, ScanIndex(index_path, _SCANNER_VERSION))
+    return set().union(*_map_batches(_scan_files, paths, jobs))
+
+
+def _map_batches(task, items: List, jobs: Optional[int]) -> List:
+    """Run *task* over batches of *items*, in a process pool unless there are few."""
+    if jobs == 1 or len(items) < _PARALLEL_MIN_FILES:
+        return [task(items)]
+    batches = [items[i:i + _BATCH_SIZE] for i in range(0, len(items), _BATCH_SIZE)]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(task, batches))
 
-    for root, dirs, files in os.walk(repo_path):
-        # Prune unwanted directories in-place so os.walk doesn't descend into them
-        dirs[:] = [d for d in dirs if d not in _SKIP_DIRS]
 
-        for fname in files:
-            suffix = Path(fname).suffix.lower()
-            if suffix not in _SOURCE_EXTENSIONS:
+def _collect_indexed(paths: List[str],
+                     jobs: Optional[int],
+                     index: ScanIndex,
+                     stats: Optional[Dict[str, Tuple[int, int]]] = None) -> Set[str]:
+    """
+    collect_conditional_macros() for *paths*, reusing and updating *index*.
+    *stats* maps paths to (mtime_ns, size) already known from the crawl.
+    """
+    previous = index.load()
+    all_macros: Set[str] = set()
+    stale: List[Tuple[str, Optional[bytes]]] = []
+    for path in paths:
+        entry = previous.get(path)
+        if entry is not None:
+            stamp = stats.get(path) if stats is not None else None
+            if stamp is None:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                stamp = (st.st_mtime_ns, st.st_size)
+            if stamp == (entry.mtime_ns, entry.size):
+                all_macros.update(entry.names)
                 continue
-            full_path = os.path.join(root, fname)
-            macros = _process_file(full_path)
-            all_macros.update(macros)
+        stale.append((path, entry.digest if entry is not None else None))
 
+    changed: Dict[str, IndexEntry] = {}
+    rehashed = 0
+    for results in _map_batches(_scan_indexed_files, stale, jobs):
+        for path, entry in results:
+            if entry is None:
+                continue
+            if entry.names is None:  # touched, contents unchanged
+                entry = entry._replace(names=previous[path].names)
+                rehashed += 1
+            changed[path] = entry
+            all_macros.update(entry.names)
+
+    if changed or len(previous) != len(paths):
+        index.update(changed, keep=paths)
+    logging.getLogger("conditional-macro").info(
+        f"Scan index: {len(paths) - len(stale)} file(s) unchanged, {rehashed} touched but identical, "
+        f"{len(stale) - rehashed} (re)scanned"
+    )
     return all_macros
 
 
@@ -231,12 +569,41 @@ def collect_conditional_macros(repo_dir: str) -> Set[str]:
 # CLI convenience (for debugging / manual inspection)
 # ---------------------------------------------------------------------------
 
+
+def _benchmark(repo_dir: str) -> None:
+    """
+    Print the single-threaded throughput of the lexer and of the earlier
+    scanners over the source files of *repo_dir* (file reading excluded,
+    except for the line-based scanner, which reads its own files).
+    """
+    import time
+
+    paths = [entry.path for entry in crawl_repo(repo_dir)]
+    texts = [text for text in map(_read_source, paths) if text is not None]
+    size_mb = sum(len(text) for text in texts) / (1 << 20)
+    print(f"{len(paths)} files, {len(texts)} with a '#', {size_mb:.1f} MiB")
+
+    scanners = [
+        ("lexer", lambda: [_scan_text(text) for text in texts]),
+        ("whole-text regex", lambda: [_scan_text_regex(text) for text in texts]),
+        ("line-based (incl. I/O)", lambda: [_process_file(path) for path in paths]),
+    ]
+    for label, scan in scanners:
+        start = time.perf_counter()
+        found = set().union(*scan())
+        elapsed = time.perf_counter() - start
+        print(f"{label:>24}: {elapsed:7.2f}s  {size_mb / elapsed:7.1f} MiB/s  {len(found)} macros")
+
+
 if __name__ == "__main__":
     import sys
     import json
 
+    if len(sys.argv) == 3 and sys.argv[1] == "--benchmark":
+        _benchmark(sys.argv[2])
+        sys.exit(0)
     if len(sys.argv) < 2:
-        print("Usage: python conditional_macro_scanner.py <repo_dir>")
+        print("Usage: python conditional_macro_scanner.py [--benchmark] <repo_dir>")
         sys.exit(1)
 
     result = collect_conditional_macros(sys.argv[1])
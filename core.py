@@ -5,8 +5,18 @@ Pipeline:
   1. inject_probes()       → write probe.c with PROBE_xxx global variables
   2. compile probe.c       → produce probe.obj using the original compile command
      2a. If compile fails, parse stderr for error lines, remove offending probes, retry
-  3. read_probe_values()   → extract values from probe.obj via llvm-objdump / fromelf
+         (retries compile the probe file preprocessed once, with -x cpp-output)
+         (errors that cannot be attributed to a line are isolated by bisection)
+     2b. Large probe sets are split into shards compiled concurrently
+     2c. Optionally (pipe=True) probes are compiled over stdin/stdout with no files at all
+     2d. Optionally (backend="llvm-ir") probes are compiled to LLVM IR text, skipping codegen
+  3. read_probe_values()   → extract values from probe.obj (in-process ELF/COFF reader,
+                              external dump tool, or the IR text — see elf_reader.BACKENDS)
   4. cleanup               → delete probe.c, probe.obj
+
+Probe files live in a per-TU directory under a scratch root (/dev/shm when
+available), not next to the source; a `#line` directive and `-iquote <srcdir>`
+keep the source's __FILE__, diagnostics and relative #include lookups.
 """
 
 import os
@@ -14,13 +24,24 @@ import re
 import sys
 import subprocess
 import shlex
+import shutil
 import tempfile
+import asyncio
 import logging
+import threading
+import functools
+import concurrent.futures
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
 
-from macro_extractor import inject_probes
-from elf_reader import read_probe_values
+from macro_extractor import (
+    PROBE_BANNER, build_probe_source, preprocessor_command, run_preprocessor, extract_target_flags,
+    parse_macro_dump,
+)
+from elf_reader import decode_probe_values, read_probe_values
+from probe_memo import FingerprintRegistry, MacroMemo, tu_fingerprint
+from driver_cache import DriverCache
+from job_control import in_job_context, run_process
 
 
 # ---------------------------------------------------------------------------
@@ -184,10 +205,38 @@ def _expand_response_files(parts: List[str], directory: str) -> List[str]:
 # Compilation with error-based probe removal
 # ---------------------------------------------------------------------------
 
-def _parse_probe_error_lines(stderr_text: str, probe_c_path: str) -> List[int]:
+_LINE_DIRECTIVE_RE = re.compile(r'#line 1 "((?:[^"\\]|\\.)*)"')
+
+# Name compilers give the input in diagnostics when it is read from stdin
+_STDIN_NAME = "<stdin>"
+
+
+def _line_origin(first_line: str) -> Optional[str]:
+    """The file named by a probe's leading #line directive, if any."""
+    m = _LINE_DIRECTIVE_RE.match(first_line)
+    return m.group(1).replace('\\"', '"') if m else None
+
+
+def _probe_line_origin(probe_c_path: str) -> Optional[str]:
+    """_line_origin() of the probe file on disk."""
+    try:
+        with open(probe_c_path, "r", encoding="utf-8") as f:
+            return _line_origin(f.readline())
+    except OSError:
+        return None
+
+
+def _parse_probe_error_lines(stderr_text: str,
+                             probe_c_path: str,
+                             first_line: Optional[str] = None) -> List[int]:
     """
     Extract line numbers from compiler error messages that reference probe_c_path.
     Returns a sorted list of 1-indexed line numbers with errors.
+
+    If the probe file starts with a #line directive (see inject_probes'
+    line_origin), errors reported against the named file are mapped back
+    to probe file lines.  first_line is the probe's first line when it is
+    not a file on disk (compiled from stdin).
     """
     error_lines = []
     # Patterns: "file.c:LINE:COL: error:" or "file.c(LINE): error"
@@ -199,18 +248,20 @@ def _parse_probe_error_lines(stderr_text: str, probe_c_path: str) -> List[int]:
     for pattern in patterns:
         for m in pattern.finditer(stderr_text):
             error_lines.append(int(m.group(1)))
+
+    origin = _probe_line_origin(probe_c_path) if first_line is None else _line_origin(first_line)
+    if origin is not None:
+        pattern = re.compile(r'(?im)^' + re.escape(origin) + r':(\d+):\d+:\s+(?:fatal )?error:')
+        # The directive itself is line 1; what follows starts at reported line 1
+        error_lines.extend(int(m.group(1)) + 1 for m in pattern.finditer(stderr_text))
     return sorted(set(error_lines))
 
 
-def _remove_probes_at_lines(probe_c_path: str, error_lines: List[int]) -> Tuple[List[str], int]:
+def _drop_probe_lines(lines: List[str], error_lines: List[int]) -> Tuple[List[str], List[str]]:
     """
-    Remove PROBE_ variable declarations that appear at or near the given error lines.
-    Returns (removed_probe_names, count_removed).
+    Drop the PROBE_ declarations at the given 1-indexed lines.
+    Returns (remaining_lines, removed_probe_names).
     """
-    with open(probe_c_path, "r", encoding="utf-8") as f:
-        lines = f.readlines()
-
-    # Walk backwards from each error line to find the start of the PROBE_ declaration
     probe_name_pattern = re.compile(r'\bPROBE_([A-Za-z0-9_]+)\b')
     removed_names = []
     lines_to_remove = set()
@@ -223,136 +274,1024 @@ def _remove_probes_at_lines(probe_c_path: str, error_lines: List[int]) -> Tuple[
             lines_to_remove.add(idx)
 
     if not lines_to_remove:
+        return lines, []
+    return [line for i, line in enumerate(lines) if i not in lines_to_remove], removed_names
+
+
+def _remove_probes_at_lines(probe_c_path: str, error_lines: List[int]) -> Tuple[List[str], int]:
+    """
+    Remove PROBE_ variable declarations that appear at or near the given error lines.
+    Returns (removed_probe_names, count_removed).
+    """
+    with open(probe_c_path, "r", encoding="utf-8") as f:
+        lines = f.readlines()
+
+    new_lines, removed_names = _drop_probe_lines(lines, error_lines)
+    if not removed_names:
         return [], 0
 
-    new_lines = [line for i, line in enumerate(lines) if i not in lines_to_remove]
     with open(probe_c_path, "w", encoding="utf-8") as f:
         f.writelines(new_lines)
 
-    return removed_names, len(lines_to_remove)
+    return removed_names, len(removed_names)
+
+
+def _drop_probes_named(lines: List[str], names: Set[str]) -> Tuple[List[str], List[str]]:
+    """
+    Drop the PROBE_ declarations of the given macro names.
+    Returns (remaining_lines, names_that_were_present).
+    """
+    probe_decl_pattern = re.compile(r'\bPROBE_([A-Za-z0-9_]+)\s*=')
+    removed_names = []
+    new_lines = []
+    for line in lines:
+        m = probe_decl_pattern.search(line)
+        if m and m.group(1) in names:
+            removed_names.append(m.group(1))
+            continue
+        new_lines.append(line)
+    return new_lines, removed_names
+
+
+def _remove_probes_named(probe_c_path: str, names: Set[str]) -> List[str]:
+    """
+    Remove the PROBE_ declarations of the given macro names.
+    Returns the names that were actually present and removed.
+    """
+    with open(probe_c_path, "r", encoding="utf-8") as f:
+        lines = f.readlines()
+
+    new_lines, removed_names = _drop_probes_named(lines, names)
+    if removed_names:
+        with open(probe_c_path, "w", encoding="utf-8") as f:
+            f.writelines(new_lines)
+    return removed_names
+
+
+def _split_probe_text(text: str) -> Tuple[str, List[str]]:
+    """Split probe source text into (prelude up to PROBE_BANNER, probe declaration lines)."""
+    idx = text.rfind(PROBE_BANNER)
+    if idx < 0:
+        return text, []
+    idx += len(PROBE_BANNER)
+    return text[:idx], text[idx:].splitlines(keepends=True)
+
+
+def _split_probe_source(probe_c_path: str) -> Tuple[str, List[str]]:
+    """_split_probe_text() of a probe file."""
+    with open(probe_c_path, "r", encoding="utf-8") as f:
+        return _split_probe_text(f.read())
+
+
+def _probe_line_name(line: str) -> Optional[str]:
+    m = re.search(r'\bPROBE_([A-Za-z0-9_]+)\s*=', line)
+    return m.group(1) if m else None
+
+
+def _output_path(compile_cmd: List[str]) -> Optional[str]:
+    """The -o argument of a compile command, if any."""
+    for i, part in enumerate(compile_cmd):
+        if part == "-o" and i + 1 < len(compile_cmd):
+            return compile_cmd[i + 1]
+        if part.startswith("-o") and len(part) > 2:
+            return part[2:]
+    return None
+
+
+def _retarget_compile_cmd(compile_cmd: List[str],
+                          probe_c_path: str,
+                          new_c_path: str,
+                          new_obj_path: str) -> List[str]:
+    """Point a probe compile command at another input file and object file."""
+    new_cmd: List[str] = []
+    i = 0
+    while i < len(compile_cmd):
+        part = compile_cmd[i]
+        if part == "-o" and i + 1 < len(compile_cmd):
+            new_cmd.extend(["-o", new_obj_path])
+            i += 2
+            continue
+        if part.startswith("-o") and len(part) > 2:
+            new_cmd.append(f"-o{new_obj_path}")
+        elif part == probe_c_path:
+            new_cmd.append(new_c_path)
+        else:
+            new_cmd.append(part)
+        i += 1
+    return new_cmd
+
+
+def _bisect_probe_lines(probe_lines: List[str], compiles) -> Optional[List[str]]:
+    """
+    Names of the failing probes among *probe_lines*, given compiles(lines)
+    which compiles the prelude followed by *lines*; None if the prelude
+    alone does not compile.
+    """
+    def bisect(lines: List[str]) -> List[str]:
+        if compiles(lines):
+            return []
+        if len(lines) == 1:
+            name = _probe_line_name(lines[0])
+            return [name] if name else []
+        mid = len(lines) // 2
+        return bisect(lines[:mid]) + bisect(lines[mid:])
+
+    if not compiles([]):
+        return None
+    return bisect(probe_lines) if probe_lines else []
+
+
+def _bisect_failing_probes(compile_cmd: List[str],
+                           probe_c_path: str,
+                           directory: str,
+                           drivers: Optional[DriverCache] = None) -> Optional[List[str]]:
+    """
+    Isolate the probes that break a compile whose errors cannot be mapped to
+    probe lines (e.g. an error reported inside a macro's #define or a header).
+
+    The probe set is halved recursively; a half that compiles is cleared in
+    one step, so k bad probes among n cost about k·log2(n) small compiles.
+    Returns the names of the failing probes, or None if the prelude alone
+    does not compile (the TU itself is broken, not a probe).
+    """
+    prelude, probe_lines = _split_probe_source(probe_c_path)
+    root, ext = os.path.splitext(probe_c_path)
+    bisect_c_path = f"{root}.bisect{ext}"
+    bisect_obj_path = f"{root}.bisect.obj"
+    bisect_cmd = _retarget_compile_cmd(compile_cmd, probe_c_path, bisect_c_path, bisect_obj_path)
+    if drivers is not None:
+        bisect_cmd = drivers.command(bisect_cmd, directory, [bisect_c_path, bisect_obj_path])
+
+    def compiles(lines: List[str]) -> bool:
+        with open(bisect_c_path, "w", encoding="utf-8") as f:
+            f.write(prelude + "".join(lines))
+        result = run_process(bisect_cmd, cwd=directory, text=True)
+        return result.returncode == 0
+
+    try:
+        return _bisect_probe_lines(probe_lines, compiles)
+    finally:
+        for path in (bisect_c_path, bisect_obj_path):
+            if os.path.exists(path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+_PROBE_DECL_RE = re.compile(r'\bPROBE_([A-Za-z0-9_]+)\s*=')
+
+
+class _PreprocessedProbe:
+    """
+    A probe file preprocessed once (-E) and kept in memory.
+
+    Retries compile this text with `-x cpp-output` instead of rerunning the
+    original command, so headers are not searched, read and preprocessed
+    again.  Removed probes are blanked rather than deleted: the linemarkers
+    in the text keep error messages pointing at the probe file's lines as
+    they were when it was preprocessed.
+    """
+
+    def __init__(self, compile_cmd: List[str], probe_c_path: str, text: str):
+        root, ext = os.path.splitext(probe_c_path)
+        is_c = ext.lower() == ".c"
+        self.path = f"{root}.i" if is_c else f"{root}.ii"
+        self.lines = text.splitlines(keepends=True)
+        with open(probe_c_path, "r", encoding="utf-8") as f:
+            self.source_lines = f.readlines()
+
+        self.compile_cmd = []
+        for part in compile_cmd:
+            if part == probe_c_path:
+                self.compile_cmd.extend(["-x", "cpp-output" if is_c else "c++-cpp-output", self.path])
+            else:
+                self.compile_cmd.append(part)
+
+    def names_at_lines(self, error_lines: List[int]) -> List[str]:
+        """Probe names declared at the given 1-indexed lines of the original probe file."""
+        return _names_at_lines(self.source_lines, error_lines)
+
+    def remove(self, names) -> None:
+        _blank_probes_named(self.lines, set(names))
+
+    def write(self) -> None:
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.writelines(self.lines)
+
+    def cleanup(self) -> None:
+        if os.path.exists(self.path):
+            try:
+                os.remove(self.path)
+            except OSError as e:
+                logging.getLogger("core").warning(f"Could not remove {self.path}: {e}")
+
+
+def _names_at_lines(source_lines: List[str], error_lines: List[int]) -> List[str]:
+    """Probe names declared at the given 1-indexed lines of *source_lines*."""
+    names = []
+    for line_no in error_lines:
+        if 0 < line_no <= len(source_lines):
+            m = re.search(r'\bPROBE_([A-Za-z0-9_]+)\b', source_lines[line_no - 1])
+            if m:
+                names.append(m.group(1))
+    return names
+
+
+def _blank_probes_named(lines: List[str], names: Set[str]) -> None:
+    """Blank (in place) the PROBE_ declarations of the given names, keeping line numbers."""
+    for i, line in enumerate(lines):
+        m = _PROBE_DECL_RE.search(line)
+        if m and m.group(1) in names:
+            lines[i] = "\n"
+
+
+def _preprocess_cmd(compile_cmd: List[str]) -> List[str]:
+    """The probe compile command turned into a -E run."""
+    # -E cannot reproduce a PCH's text; include its header instead
+    preprocess_cmd = []
+    for part in compile_cmd:
+        if part == "-emit-llvm":
+            continue
+        if preprocess_cmd and preprocess_cmd[-1] == "-include-pch" and part.endswith(".pch"):
+            preprocess_cmd[-1] = "-include"
+            part = part[:-len(".pch")]
+        preprocess_cmd.append("-E" if part in ("-c", "-S") else part)
+    return preprocess_cmd
+
+
+def _emit_llvm_cmd(compile_cmd: List[str]) -> List[str]:
+    """A probe compile command producing LLVM IR text (-S -emit-llvm) instead of an object."""
+    new_cmd = []
+    for part in compile_cmd:
+        new_cmd.extend(["-S", "-emit-llvm"] if part == "-c" else [part])
+    return new_cmd
+
+
+def _preprocess_probe(compile_cmd: List[str],
+                      probe_c_path: str,
+                      directory: str,
+                      drivers: Optional[DriverCache] = None) -> Optional[_PreprocessedProbe]:
+    """Run the probe compile command with -E; None if preprocessing fails."""
+    preprocess_cmd = _retarget_compile_cmd(_preprocess_cmd(compile_cmd), probe_c_path, probe_c_path, "-")
+    if drivers is not None:
+        preprocess_cmd = drivers.command(preprocess_cmd, directory, [probe_c_path])
+    logging.getLogger("core").info(f"Preprocessing probe for retries: {' '.join(preprocess_cmd)}")
+    result = run_process(preprocess_cmd, cwd=directory, text=True)
+    if result.returncode != 0:
+        logging.getLogger("core").warning("Could not preprocess the probe file; retries recompile from source.")
+        return None
+    return _PreprocessedProbe(compile_cmd, probe_c_path, result.stdout)
+
+
+def _decode_stderr(result: subprocess.CompletedProcess) -> subprocess.CompletedProcess:
+    result.stderr = result.stderr.decode("utf-8", errors="replace")
+    return result
+
+
+class _ProbeFile:
+    """A probe TU on disk, as compiled by compile_probe()."""
+
+    def __init__(self,
+                 compile_cmd: List[str],
+                 probe_c_path: str,
+                 directory: str,
+                 drivers: Optional[DriverCache] = None):
+        self.compile_cmd = compile_cmd
+        self.path = probe_c_path
+        self.directory = directory
+        self.drivers = drivers
+        self.preprocessed: Optional[_PreprocessedProbe] = None
+        # Set by _compile_with_retries when the prelude alone does not compile
+        self.prelude_failed = False
+
+    def command(self, attempt: int) -> Tuple[List[str], Optional[bytes]]:
+        """The compile command of *attempt* and its stdin (None: none)."""
+        cmd, input_path = self.compile_cmd, self.path
+        if self.preprocessed is not None:
+            self.preprocessed.write()
+            cmd, input_path = self.preprocessed.compile_cmd, self.preprocessed.path
+        if self.drivers is not None:
+            cmd = self.drivers.command(cmd, self.directory, [input_path, _output_path(cmd)])
+        logging.getLogger("core").info(f"Compiling probe (attempt {attempt + 1}): {' '.join(cmd)}")
+        return cmd, None
+
+    def compile(self, attempt: int) -> subprocess.CompletedProcess:
+        cmd, _ = self.command(attempt)
+        return self.accept(run_process(cmd, cwd=self.directory))
+
+    def accept(self, result: subprocess.CompletedProcess) -> subprocess.CompletedProcess:
+        """Take the (bytes) result of running command(); stderr becomes text."""
+        return _decode_stderr(result)
+
+    def remove_at_error_lines(self, stderr: str) -> List[str]:
+        error_lines = _parse_probe_error_lines(stderr, self.path)
+        if self.preprocessed is not None:
+            return self.remove_named(self.preprocessed.names_at_lines(error_lines))
+        if error_lines:
+            return _remove_probes_at_lines(self.path, error_lines)[0]
+        return []
+
+    def remove_named(self, names) -> List[str]:
+        if self.preprocessed is not None:
+            self.preprocessed.remove(names)
+        return _remove_probes_named(self.path, set(names))
+
+    def bisect(self) -> Optional[List[str]]:
+        return _bisect_failing_probes(self.compile_cmd, self.path, self.directory, self.drivers)
+
+    def preprocess(self) -> None:
+        self.preprocessed = _preprocess_probe(self.compile_cmd, self.path, self.directory, self.drivers)
+
+    def cleanup(self) -> None:
+        if self.preprocessed is not None:
+            self.preprocessed.cleanup()
+
+
+# Stands for the probe input in a compile command built for a _PipedProbe
+_PIPE_INPUT = "\0probe"
+
+
+class _PipedProbe:
+    """
+    A probe TU kept in memory and compiled over pipes: the source is fed to
+    the compiler on stdin (`-x <lang> -`) and the object is read from its
+    stdout (`-o -`), so no file is written.  Retries compile the `-E` output
+    (`-x cpp-output -`), bisection feeds the halves the same way.
+
+    compile_cmd comes from build_probe_compile_cmd() with _PIPE_INPUT as the
+    probe path and "-" as the object path.
+    """
+
+    def __init__(self,
+                 compile_cmd: List[str],
+                 text: str,
+                 is_c: bool,
+                 directory: str,
+                 drivers: Optional[DriverCache] = None):
+        self.lines = text.splitlines(keepends=True)
+        self.is_c = is_c
+        self.directory = directory
+        self.drivers = drivers
+        # A depfile would be named after the "-" output
+        self.compile_cmd = [part for part in compile_cmd if part not in ("-MD", "-MMD")]
+        self.preprocessed: Optional[List[str]] = None
+        self.source_lines: List[str] = []
+        self.obj = b""
+        self.prelude_failed = False
+
+    def _cmd(self, lang: str, cmd: Optional[List[str]] = None) -> List[str]:
+        new_cmd = []
+        for part in cmd if cmd is not None else self.compile_cmd:
+            if part == _PIPE_INPUT:
+                new_cmd.extend(["-x", lang, "-"])
+            else:
+                new_cmd.append(part)
+        return new_cmd
+
+    def _run(self, cmd: List[str], text: str) -> subprocess.CompletedProcess:
+        if self.drivers is not None:
+            cmd = self.drivers.command(cmd, self.directory)
+        result = run_process(cmd, input=text.encode("utf-8"), cwd=self.directory)
+        return _decode_stderr(result)
+
+    def command(self, attempt: int) -> Tuple[List[str], Optional[bytes]]:
+        """The compile command of *attempt* and its stdin (the probe text)."""
+        if self.preprocessed is not None:
+            cmd = self._cmd("cpp-output" if self.is_c else "c++-cpp-output")
+            text = "".join(self.preprocessed)
+        else:
+            cmd = self._cmd("c" if self.is_c else "c++")
+            text = "".join(self.lines)
+        logging.getLogger("core").info(f"Compiling probe over pipes (attempt {attempt + 1}): {' '.join(cmd)}")
+        if self.drivers is not None:
+            cmd = self.drivers.command(cmd, self.directory)
+        return cmd, text.encode("utf-8")
+
+    def compile(self, attempt: int) -> subprocess.CompletedProcess:
+        cmd, data = self.command(attempt)
+        return self.accept(run_process(cmd, input=data, cwd=self.directory))
+
+    def accept(self, result: subprocess.CompletedProcess) -> subprocess.CompletedProcess:
+        """Take the (bytes) result of running command(): keep the object, decode stderr."""
+        self.obj = result.stdout if result.returncode == 0 else b""
+        return _decode_stderr(result)
+
+    def remove_at_error_lines(self, stderr: str) -> List[str]:
+        if self.preprocessed is not None:
+            error_lines = _parse_probe_error_lines(stderr, _STDIN_NAME, self.source_lines[0])
+            return self.remove_named(_names_at_lines(self.source_lines, error_lines))
+        error_lines = _parse_probe_error_lines(stderr, _STDIN_NAME, self.lines[0] if self.lines else "")
+        if not error_lines:
+            return []
+        self.lines, names = _drop_probe_lines(self.lines, error_lines)
+        return names
+
+    def remove_named(self, names) -> List[str]:
+        names = set(names)
+        if self.preprocessed is not None:
+            _blank_probes_named(self.preprocessed, names)
+        self.lines, removed = _drop_probes_named(self.lines, names)
+        return removed
+
+    def bisect(self) -> Optional[List[str]]:
+        prelude, probe_lines = _split_probe_text("".join(self.lines))
+        cmd = self._cmd("c" if self.is_c else "c++")
+        return _bisect_probe_lines(
+            probe_lines, lambda lines: self._run(cmd, prelude + "".join(lines)).returncode == 0
+        )
+
+    def preprocess(self) -> None:
+        cmd = self._cmd("c" if self.is_c else "c++", _preprocess_cmd(self.compile_cmd))
+        logging.getLogger("core").info(f"Preprocessing probe for retries: {' '.join(cmd)}")
+        result = self._run(cmd, "".join(self.lines))
+        if result.returncode != 0:
+            logging.getLogger("core").warning("Could not preprocess the probe; retries recompile from source.")
+            return
+        self.preprocessed = result.stdout.decode("utf-8", errors="replace").splitlines(keepends=True)
+        self.source_lines = list(self.lines)
+
+    def cleanup(self) -> None:
+        pass
 
 
 def compile_probe(compile_cmd: List[str],
                   probe_c_path: str,
                   directory: str,
-                  max_retries: int = 50) -> Tuple[bool, List[str]]:
+                  max_retries: int = 50,
+                  drivers: Optional[DriverCache] = None) -> Tuple[bool, List[str]]:
     """
     Compile the probe file, automatically removing problematic PROBE_ declarations
     if the compilation fails.
 
+    After the first failure the probe file is preprocessed once; the retries
+    compile that text (see _PreprocessedProbe) with the failing probes blanked.
+
+    With a DriverCache the compiles run as direct cc1 jobs.
+
     Returns (success, list_of_removed_macro_names).
     """
+    return _compile_with_retries(_ProbeFile(compile_cmd, probe_c_path, directory, drivers),
+                                 max_retries)
+
+
+def _compile_with_retries(probe,
+                          max_retries: int = 50,
+                          first_result: Optional[subprocess.CompletedProcess] = None,
+                          stop: Optional[threading.Event] = None) -> Tuple[bool, List[str]]:
+    """
+    The retry loop of compile_probe() for a _ProbeFile or a _PipedProbe.
+    first_result is the outcome of an attempt 0 the caller already ran
+    (probe.accept()ed); once *stop* is set no further attempt starts.
+    """
     removed_macros: List[str] = []
 
-    for attempt in range(max_retries + 1):
-        logging.getLogger("core").info(f"Compiling probe (attempt {attempt + 1}): {' '.join(compile_cmd)}")
-        result = subprocess.run(
-            compile_cmd,
-            capture_output=True,
-            text=True,
-            cwd=directory,
-        )
+    try:
+        for attempt in range(max_retries + 1):
+            if attempt == 0 and first_result is not None:
+                result = first_result
+            else:
+                result = probe.compile(attempt)
+
+            if result.returncode == 0:
+                return True, removed_macros
+
+            stderr = result.stderr
+            logging.getLogger("core").error(f"Compilation failed (exit {result.returncode})")
+
+            if stop is not None and stop.is_set():
+                logging.getLogger("core").warning("Interrupted; giving up on this probe file.")
+                return False, removed_macros
+
+            if attempt >= max_retries:
+                logging.getLogger("core").error("Max retries reached. Giving up on this probe file.")
+                logging.getLogger("core").error(f"Last stderr:\n{stderr[:2000]}")
+                return False, removed_macros
+
+            names = probe.remove_at_error_lines(stderr)
+            count = len(names)
+
+            if count == 0:
+                # Can't map the errors to probe lines — bisect the probe set instead
+                logging.getLogger("core").warning("Cannot attribute compiler errors to probe lines; bisecting probes.")
+                bad = probe.bisect()
+                if bad is None:
+                    logging.getLogger("core").error("Probe file fails to compile without any probes:")
+                    logging.getLogger("core").error(stderr[:2000])
+                    probe.prelude_failed = True
+                    return False, removed_macros
+                names = probe.remove_named(bad)
+                count = len(names)
+                if count == 0:
+                    logging.getLogger("core").error("Bisection found no failing probe; giving up on this probe file.")
+                    logging.getLogger("core").error(stderr[:2000])
+                    return False, removed_macros
+
+            removed_macros.extend(names)
+            logging.getLogger("core").info(f"Removed {count} problematic probe(s): {names}")
+
+            if probe.preprocessed is None and attempt == 0:
+                probe.preprocess()
+
+        return False, removed_macros
+    finally:
+        probe.cleanup()
 
-        if result.returncode == 0:
-            return True, removed_macros
 
-        stderr = result.stderr
-        logging.getLogger("core").error(f"Compilation failed (exit {result.returncode})")
+def _blank_source_lines(text: str, line_indices) -> str:
+    """Replace the given 0-indexed lines of *text* with empty lines."""
+    lines = text.splitlines(keepends=True)
+    for idx in line_indices:
+        if idx < len(lines):
+            lines[idx] = "\n"
+    return "".join(lines)
 
-        if attempt >= max_retries:
-            logging.getLogger("core").error("Max retries reached. Giving up on this probe file.")
-            logging.getLogger("core").error(f"Last stderr:\n{stderr[:2000]}")
-            return False, removed_macros
 
-        error_lines = _parse_probe_error_lines(stderr, probe_c_path)
-        if not error_lines:
-            # Can't identify problem lines — print stderr and bail
-            logging.getLogger("core").error("Cannot identify error lines in compiler output:")
-            logging.getLogger("core").error(stderr[:2000])
-            return False, removed_macros
+# Shards are only worth an extra compile of the prelude above this many probes
+_MIN_PROBES_PER_SHARD = 32
+
+
+def _shard_probe_text(text: str, shards: int) -> List[Tuple[str, List[str]]]:
+    """
+    Split probe source text into up to *shards* texts that share its prelude.
+    Returns [(shard_text, probe_names)].
+    """
+    prelude, probe_lines = _split_probe_text(text)
+    count = max(1, min(shards, len(probe_lines) // _MIN_PROBES_PER_SHARD))
+    per_shard = -(-len(probe_lines) // count) if probe_lines else 0
+    result = []
+    for k in range(count):
+        lines = probe_lines[k * per_shard:(k + 1) * per_shard]
+        names = [n for n in map(_probe_line_name, lines) if n]
+        result.append((prelude + "".join(lines), names))
+    return result
+
+
+def _write_probe_shards(probe_c_path: str,
+                        parts: List[Tuple[str, List[str]]],
+                        obj_ext: str = ".obj") -> List[Tuple[str, str, List[str]]]:
+    """
+    Write the _shard_probe_text() parts next to *probe_c_path*.
+    Returns [(shard_c_path, shard_obj_path, probe_names)]; a single part is
+    written to probe_c_path itself.
+    """
+    root, ext = os.path.splitext(probe_c_path)
+    result = []
+    for k, (text, names) in enumerate(parts):
+        shard_c_path = probe_c_path if len(parts) == 1 else f"{root}.{k}{ext}"
+        with open(shard_c_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        result.append((shard_c_path, f"{root}{obj_ext}" if len(parts) == 1 else f"{root}.{k}{obj_ext}", names))
+    return result
+
+
+# ---------------------------------------------------------------------------
+# Scratch directory
+# ---------------------------------------------------------------------------
 
-        names, count = _remove_probes_at_lines(probe_c_path, error_lines)
-        if count == 0:
-            logging.getLogger("core").error("Could not remove any probes based on error lines.")
-            return False, removed_macros
+@functools.lru_cache(maxsize=None)
+def default_scratch_root() -> str:
+    """/dev/shm if it is a writable directory (RAM-backed on Linux), else the system temp dir."""
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK | os.X_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
 
-        removed_macros.extend(names)
-        logging.getLogger("core").info(f"Removed {count} problematic probe(s): {names}")
 
-    return False, removed_macros
+def _probe_quote_dir_flags(source_file: str) -> List[str]:
+    """Search the source's directory first for #include "..." from a probe file elsewhere."""
+    return ["-iquote", os.path.dirname(os.path.abspath(source_file))]
 
 
 # ---------------------------------------------------------------------------
 # Public entry point
 # ---------------------------------------------------------------------------
 
+class PreparedFile(NamedTuple):
+    """Result of the preprocessing stage for one TU (see prepare_file)."""
+    source_file: str
+    original_cmd: str
+    directory: str
+    preprocessor_flags: List[str]
+    macro_output: str
+    macro_table: Dict[str, Tuple[Optional[str], str]]
+    # Source + headers read by the preprocessor (absolute paths), if collected
+    dependencies: Tuple[str, ...] = ()
+
+
+def prepare_file(source_file: str,
+                 original_cmd: str,
+                 directory: str,
+                 clang_exec: str = "clang",
+                 collect_dependencies: bool = False,
+                 drivers: Optional[DriverCache] = None) -> PreparedFile:
+    """
+    Preprocessing stage of the pipeline: derive the preprocessor flags from the
+    original command and run `-E -dM` once.  The result feeds both the global
+    probe planner and evaluate_prepared().
+
+    With collect_dependencies=True the preprocessor also writes a depfile and
+    PreparedFile.dependencies lists the TU's include closure.
+
+    With a DriverCache the preprocessor runs as a direct cc1 job.
+    """
+    logging.getLogger("core").info(f"Preprocessing: {source_file}")
+
+    # Derive flags list for preprocessor (-E -dM only needs -D/-I/-isystem/etc.)
+    preprocessor_flags = _extract_preprocessor_flags(original_cmd, directory)
+
+    dep_path = _new_depfile() if collect_dependencies else None
+    try:
+        macro_output = run_preprocessor(source_file, preprocessor_flags, clang_exec,
+                                        depfile=dep_path, drivers=drivers)
+        return _prepared_file(source_file, original_cmd, directory, preprocessor_flags, macro_output, dep_path)
+    finally:
+        if dep_path is not None:
+            os.remove(dep_path)
+
+
+def _new_depfile() -> str:
+    fd, dep_path = tempfile.mkstemp(suffix=".d")
+    os.close(fd)
+    return dep_path
+
+
+def _prepared_file(source_file: str,
+                   original_cmd: str,
+                   directory: str,
+                   preprocessor_flags: List[str],
+                   macro_output: str,
+                   dep_path: Optional[str]) -> PreparedFile:
+    dependencies: Tuple[str, ...] = ()
+    if dep_path is not None:
+        dependencies = tuple(dict.fromkeys(
+            os.path.normpath(os.path.abspath(path)) for path in read_depfile(dep_path)
+        ))
+    return PreparedFile(source_file, original_cmd, directory, preprocessor_flags,
+                        macro_output, parse_macro_dump(macro_output), dependencies)
+
+
 def process_file(source_file: str,
                  original_cmd: str,
                  directory: str,
                  known_macros: Optional[Dict] = None,
-                 clang_exec: str = "clang") -> Optional[Dict]:
+                 clang_exec: str = "clang",
+                 header_only: bool = False,
+                 fingerprints: Optional[FingerprintRegistry] = None,
+                 memo: Optional[MacroMemo] = None,
+                 fold: bool = True,
+                 fold_verify_rate: float = 0.0,
+                 shards: int = 1,
+                 scratch_root: Optional[str] = None,
+                 pipe: bool = False,
+                 backend: str = "object",
+                 drivers: Optional[DriverCache] = None) -> Optional[Dict]:
     """
     Full pipeline for one source file:
       1. Run preprocessor to discover macros → generate probe.c
+         (header_only=True: probe.c holds only the -E -dM #defines + probes)
       2. Compile probe.c → probe.obj (using original compile command)
       3. Read PROBE_ values from probe.obj
       4. Cleanup temp files
 
+    If a FingerprintRegistry is given, a TU whose normalized -E -dM dump and
+    target flags match a TU that was (or is being) evaluated reuses that
+    result and skips steps 1b–4.
+
+    If a MacroMemo is given it replaces known_macros: only macro definitions
+    not yet evaluated by any TU are probed, and the evaluated values are
+    recorded back into the memo.
+
+    With fold=True, macros that are plain integer constant expressions are
+    evaluated in Python and never reach the compiler; fold_verify_rate is the
+    fraction of those that is compiled anyway and compared against the folded
+    value (mismatches are logged and the compiled value wins).
+
+    With shards > 1, large probe sets are split into up to that many probe
+    files compiled concurrently (each with the same prelude).
+
+    Probe files are written to a private directory under scratch_root
+    (default: default_scratch_root()) and removed afterwards.  With
+    pipe=True no file is written: each probe is fed to the compiler on stdin
+    and its object read back from stdout (the compiler must accept
+    `-x <lang> -` and `-o -`).
+
+    backend selects how values are read (elf_reader.BACKENDS); "llvm-ir"
+    compiles the probes with `-S -emit-llvm` (clang only) and reads the IR.
+
+    With a DriverCache every compiler invocation runs its cc1 job directly
+    (see driver_cache).
+
     Returns a dict {macro_name: value_or_null} for all discovered macros.
     """
-    logging.getLogger("core").info(f"Processing: {source_file}")
-    base, ext = os.path.splitext(source_file)
-
-    # Derive flags list for preprocessor (-E -dM only needs -D/-I/-isystem/etc.)
-    preprocessor_flags = _extract_preprocessor_flags(original_cmd, directory)
+    prepared = prepare_file(source_file, original_cmd, directory, clang_exec, drivers=drivers)
+    return evaluate_prepared(prepared, known_macros, clang_exec, header_only,
+                             fingerprints, memo, fold, fold_verify_rate, shards=shards,
+                             scratch_root=scratch_root, pipe=pipe, backend=backend, drivers=drivers)
+
+
+def evaluate_prepared(prepared: PreparedFile,
+                      known_macros: Optional[Dict] = None,
+                      clang_exec: str = "clang",
+                      header_only: bool = False,
+                      fingerprints: Optional[FingerprintRegistry] = None,
+                      memo: Optional[MacroMemo] = None,
+                      fold: bool = True,
+                      fold_verify_rate: float = 0.0,
+                      only_names: Optional[Set[str]] = None,
+                      shards: int = 1,
+                      pch=None,
+                      scratch_root: Optional[str] = None,
+                      pipe: bool = False,
+                      backend: str = "object",
+                      drivers: Optional[DriverCache] = None) -> Optional[Dict]:
+    """
+    Steps 1b–4 of process_file for a TU that already went through
+    prepare_file().  only_names restricts probing to the macros the global
+    planner assigned to this TU (an empty set skips the compile entirely).
+    pch is the pch_cache.SharedPch covering the TU's leading #include lines.
+    scratch_root and pipe select where the probe files go, backend how they
+    are compiled and read, drivers whether cc1 runs directly (see process_file).
+    """
+    logging.getLogger("core").info(f"Processing: {prepared.source_file}")
 
-    # Collect -D macro definitions from command line
-    cmdline_macros = _extract_cmdline_macros(preprocessor_flags)
+    if fingerprints is None:
+        return _evaluate_file(prepared, known_macros, clang_exec, header_only, memo,
+                              fold, fold_verify_rate, only_names, shards, pch, scratch_root, pipe, backend, drivers)
 
-    import threading
-    thread_id = threading.get_native_id() if hasattr(threading, 'get_native_id') else threading.get_ident()
-    probe_c_path = f"{base}.probe.{thread_id}{ext}"
-    # Use a fixed-name .obj in a temp dir to avoid cluttering the build dir
-    probe_obj_path = probe_c_path.replace(ext, ".obj")
+    fp = evaluation_fingerprint(prepared, clang_exec, header_only, only_names)
+    owner, shared = fingerprints.claim(fp)
+    if not owner:
+        logging.getLogger("core").info(
+            f"Reusing result of an identical macro environment for {prepared.source_file} ({fp[:12]})"
+        )
+        return shared
 
     try:
-        # Step 1: inject probes — returns (path, list_of_injected_macro_names)
-        _, injected_names = inject_probes(
+        macros = _evaluate_file(prepared, known_macros, clang_exec, header_only, memo,
+                                fold, fold_verify_rate, only_names, shards, pch, scratch_root, pipe, backend, drivers)
+    except BaseException:
+        fingerprints.abandon(fp)
+        raise
+    if macros is None:
+        fingerprints.abandon(fp)
+    else:
+        fingerprints.publish(fp, macros)
+    return macros
+
+
+def evaluation_fingerprint(prepared: PreparedFile,
+                           clang_exec: str = "clang",
+                           header_only: bool = False,
+                           only_names: Optional[Set[str]] = None) -> str:
+    """The FingerprintRegistry key under which evaluate_prepared() shares a TU's result."""
+    target_flags = [clang_exec, f"header_only={header_only}"] + extract_target_flags(prepared.preprocessor_flags)
+    if only_names is not None:
+        target_flags.append("only=" + ",".join(sorted(only_names)))
+    return tu_fingerprint(prepared.macro_output, target_flags)
+
+
+def _evaluate_file(prepared: PreparedFile,
+                   known_macros: Optional[Dict],
+                   clang_exec: str,
+                   header_only: bool,
+                   memo: Optional[MacroMemo],
+                   fold: bool,
+                   fold_verify_rate: float,
+                   only_names: Optional[Set[str]],
+                   shards: int,
+                   pch,
+                   scratch_root: Optional[str],
+                   pipe: bool,
+                   backend: str,
+                   drivers: Optional[DriverCache]) -> Optional[Dict]:
+    """Write, compile and read the probe TU (once more without the PCH if its prelude fails with it)."""
+    job = ProbeJob.start(prepared, known_macros, clang_exec, header_only, memo, fold, fold_verify_rate,
+                         only_names, shards, pch, scratch_root, pipe, backend, drivers)
+    try:
+        outcomes = job.compile()
+        if job.pch_failed:
+            logging.getLogger("core").warning(
+                f"Probes of {prepared.source_file} do not compile with the shared PCH; retrying without it"
+            )
+            job.close()
+            job = ProbeJob.start(prepared, known_macros, clang_exec, header_only, memo, fold, fold_verify_rate,
+                                 only_names, shards, None, scratch_root, pipe, backend, drivers)
+            outcomes = job.compile()
+        return job.finish(outcomes)
+    finally:
+        job.close()
+
+
+class ProbeJob:
+    """
+    The probe TU of one prepared file between the steps of _evaluate_file():
+    start() builds it and its compile commands, compile() runs them (with
+    retries), finish() reads the values and close() releases the memo claims
+    and removes the probe files.  async_pipeline runs the steps in separate
+    stages; probes holds the _ProbeFile / _PipedProbe of every shard (empty
+    if nothing is left to compile).
+    """
+
+    def __init__(self,
+                 prepared: PreparedFile,
+                 clang_exec: str,
+                 memo: Optional[MacroMemo],
+                 pipe: bool,
+                 backend: str):
+        self.prepared = prepared
+        self.clang_exec = clang_exec
+        self.memo = memo
+        self.pipe = pipe
+        self.backend = backend
+        self.work_dir: Optional[str] = None
+        # {name: memo key} for every definition this TU claimed in the memo
+        self.claims: Dict[str, str] = {}
+        # {name: value} for macros decided without compiling (folded ints, or None
+        # for macros that depend on an unevaluable macro)
+        self.resolved: Dict[str, Optional[int]] = {}
+        self.expected_probe_names: List[str] = []
+        self.parts: List[Tuple[str, List[str]]] = []
+        self.shard_paths: List[Tuple[str, str]] = []
+        self.probes: list = []
+        self.pch = None
+        # What finish() returns when there are no probes
+        self.result: Optional[Dict] = None
+
+    @classmethod
+    def start(cls,
+              prepared: PreparedFile,
+              known_macros: Optional[Dict] = None,
+              clang_exec: str = "clang",
+              header_only: bool = False,
+              memo: Optional[MacroMemo] = None,
+              fold: bool = True,
+              fold_verify_rate: float = 0.0,
+              only_names: Optional[Set[str]] = None,
+              shards: int = 1,
+              pch=None,
+              scratch_root: Optional[str] = None,
+              pipe: bool = False,
+              backend: str = "object",
+              drivers: Optional[DriverCache] = None) -> "ProbeJob":
+        """Build the probe TU of *prepared* (options as for evaluate_prepared())."""
+        job = cls(prepared, clang_exec, memo, pipe, backend)
+        try:
+            job._build(known_macros, header_only, fold, fold_verify_rate, only_names,
+                       shards, pch, scratch_root, drivers)
+        except BaseException:
+            job.close()
+            raise
+        return job
+
+    def _build(self,
+               known_macros: Optional[Dict],
+               header_only: bool,
+               fold: bool,
+               fold_verify_rate: float,
+               only_names: Optional[Set[str]],
+               shards: int,
+               pch,
+               scratch_root: Optional[str],
+               drivers: Optional[DriverCache]) -> None:
+        source_file, original_cmd, directory = (
+            self.prepared.source_file, self.prepared.original_cmd, self.prepared.directory
+        )
+        preprocessor_flags = self.prepared.preprocessor_flags
+        stem, ext = os.path.splitext(os.path.basename(source_file))
+        if not header_only:
+            self.pch = pch
+
+        # Collect -D macro definitions from command line
+        cmdline_macros = _extract_cmdline_macros(preprocessor_flags)
+
+        # Probe, shard, bisection and preprocessed files all go in one private
+        # directory, so concurrent TUs never collide and cleanup is one rmtree
+        # (piped probes need none)
+        if not self.pipe:
+            self.work_dir = tempfile.mkdtemp(prefix=f"{stem}.", dir=scratch_root or default_scratch_root())
+            probe_c_path = os.path.join(self.work_dir, f"{stem}.probe{ext}")
+
+        # Step 1: build the probe TU — returns (text, list_of_injected_macro_names)
+        probe_text, injected_names = build_probe_source(
             source_file,
-            probe_c_path,
             preprocessor_flags,
             known_macros,
-            clang_exec,
+            self.clang_exec,
             cmdline_macros=cmdline_macros,
+            header_only=header_only,
+            macro_output=self.prepared.macro_output,
+            memo=self.memo,
+            claims=self.claims,
+            resolved=self.resolved,
+            fold=fold,
+            fold_verify_rate=fold_verify_rate,
+            macro_table=dict(self.prepared.macro_table),
+            only_names=only_names,
+            line_origin=None if header_only else os.path.abspath(source_file),
         )
 
         # injected_names is the authoritative list of macros written to probe.c,
         # already deduplicated and filtered by inject_probes.
-        expected_probe_names = injected_names
+        self.expected_probe_names = injected_names
 
-        if not expected_probe_names:
+        if not self.expected_probe_names:
             logging.getLogger("core").info(f"No probes generated for {source_file}")
-            return {}
-
-        # Step 2: build and run compile command
-        compile_cmd = build_probe_compile_cmd(
-            original_cmd, source_file, probe_c_path, probe_obj_path, directory
-        )
-        
-        if compile_cmd is None:
-            logging.getLogger("core").error(f"Could not build compile command for {source_file}")
-            return None
-
-        success, removed_macro_names = compile_probe(compile_cmd, probe_c_path, directory)
-        if not success:
+            self.result = dict(self.resolved)
+            return
+
+        # The shared PCH replaces the leading #include lines; blank them so
+        # line numbers in compiler errors stay the same (the probe file's
+        # lines are one below the source's, after the #line directive)
+        if pch is not None and not header_only:
+            probe_text = _blank_source_lines(probe_text, [idx + 1 for idx in pch.source_lines])
+
+        # Step 2: build the compile commands, one per shard (piped probes
+        # read stdin and write the object to stdout)
+        self.parts = _shard_probe_text(probe_text, shards)
+        if self.pipe:
+            self.shard_paths = [(_PIPE_INPUT, "-")] * len(self.parts)
+        else:
+            shard_files = _write_probe_shards(probe_c_path, self.parts,
+                                              ".ll" if self.backend == "llvm-ir" else ".obj")
+            self.shard_paths = [(c_path, obj_path) for c_path, obj_path, _ in shard_files]
+        probes = []
+        for (shard_c_path, shard_obj_path), (shard_text, _) in zip(self.shard_paths, self.parts):
+            compile_cmd = build_probe_compile_cmd(
+                original_cmd, source_file, shard_c_path, shard_obj_path, directory
+            )
+            if compile_cmd is None:
+                logging.getLogger("core").error(f"Could not build compile command for {source_file}")
+                return
+            if not header_only:
+                compile_cmd[1:1] = _probe_quote_dir_flags(source_file)
+                if pch is not None:
+                    compile_cmd[1:1] = ["-include-pch", pch.pch_path]
+            if self.backend == "llvm-ir":
+                compile_cmd = _emit_llvm_cmd(compile_cmd)
+            if self.pipe:
+                probes.append(_PipedProbe(compile_cmd, shard_text, ext.lower() == ".c", directory, drivers))
+            else:
+                probes.append(_ProbeFile(compile_cmd, shard_c_path, directory, drivers))
+        self.probes = probes
+
+    def retry(self,
+              probe,
+              first_result: Optional[subprocess.CompletedProcess] = None,
+              stop: Optional[threading.Event] = None) -> Tuple[bool, List[str]]:
+        """compile_probe() for one of self.probes (see _compile_with_retries)."""
+        return _compile_with_retries(probe, first_result=first_result, stop=stop)
+
+    def compile(self) -> List[Tuple[bool, List[str]]]:
+        """Compile every shard (concurrently); [(success, removed_macro_names)]."""
+        if len(self.probes) <= 1:
+            return [self.retry(probe) for probe in self.probes]
+        logging.getLogger("core").info(f"Compiling {len(self.probes)} probe shards for {self.prepared.source_file}")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.probes)) as executor:
+            # Each shard's compiles belong to the TU's JobControl (job_control)
+            futures = [executor.submit(in_job_context(self.retry), probe) for probe in self.probes]
+            return [future.result() for future in futures]
+
+    @property
+    def pch_failed(self) -> bool:
+        """
+        True after compile() if the probe prelude did not compile with the
+        shared PCH: a stale or foreign PCH breaks every probe, so the caller
+        starts the job again without it.
+        """
+        return self.pch is not None and any(probe.prelude_failed for probe in self.probes)
+
+    def finish(self, outcomes: List[Tuple[bool, List[str]]]) -> Optional[Dict]:
+        """Read the values after compile() and merge them with the resolved ones."""
+        if not self.probes:
+            return self.result
+        source_file = self.prepared.source_file
+
+        removed_macro_names: List[str] = []
+        for success, removed in outcomes:
+            removed_macro_names.extend(removed)
+        if not any(success for success, _ in outcomes):
             logging.getLogger("core").error(f"Probe compilation failed for {source_file}")
-            assert False, "Probe compilation failed"
-
-        # Update expected probe names (remove the ones that were dropped)
-        remaining_probe_names = [n for n in expected_probe_names if n not in removed_macro_names]
+            return None
 
-        # Step 3: read values from obj
-        macros = read_probe_values(probe_obj_path, remaining_probe_names, clang_exec)
+        # Step 3: read values from each shard's obj (minus the dropped probes).
+        # A shard that failed only loses its own probes: they are left out,
+        # so their memo claims are released for another TU
+        macros = {}
+        failed_names: Set[str] = set()
+        for shard, (probe, (_, shard_obj_path), (_, shard_names), (success, _)) in enumerate(
+                zip(self.probes, self.shard_paths, self.parts, outcomes)):
+            remaining_probe_names = [n for n in shard_names if n not in removed_macro_names]
+            if not success:
+                logging.getLogger("core").error(
+                    f"Probe shard {shard + 1}/{len(self.probes)} failed for {source_file}; "
+                    f"leaving out its {len(remaining_probe_names)} probe(s)"
+                )
+                failed_names.update(remaining_probe_names)
+                continue
+            if self.pipe:
+                macros.update(decode_probe_values(probe.obj, remaining_probe_names, self.clang_exec, self.backend))
+            else:
+                macros.update(read_probe_values(shard_obj_path, remaining_probe_names, self.clang_exec, self.backend))
 
         # Mark removed macros as None (they exist but are not statically evaluable)
         for name in removed_macro_names:
@@ -364,7 +1303,7 @@ def process_file(source_file: str,
         # because it's not a compile-time constant).  A name that is completely
         # absent means the ELF reader failed to locate the symbol in the object
         # file — this is unexpected and indicates a bug or an unsupported section.
-        all_expected = set(expected_probe_names)
+        all_expected = set(self.expected_probe_names) - failed_names
         actually_returned = set(macros.keys())
         silently_missing = all_expected - actually_returned
 
@@ -377,18 +1316,114 @@ def process_file(source_file: str,
                 logging.getLogger("core").warning(f"  - MISSING: {name}")
         # ──────────────────────────────────────────────────────────────────
 
+        # Merge values decided without compiling; the folded ones sampled for
+        # cross-checking were also compiled, and the compiler's answer wins
+        for name, value in self.resolved.items():
+            if name not in macros:
+                macros[name] = value
+            elif macros[name] != value:
+                logging.getLogger("core").warning(
+                    f"Constant folding mismatch for {name} in {source_file}: "
+                    f"folded {value}, compiled {macros[name]}"
+                )
+
+        removed = set(removed_macro_names)
+        for name, key in self.claims.items():
+            if name in removed:
+                self.memo.fail(key)
+            elif name in macros:
+                self.memo.resolve(key, macros[name])
+
         return macros
 
+    def close(self) -> None:
+        # Claims left unresolved (failure / missing symbol) go back to the memo
+        for key in self.claims.values():
+            self.memo.release(key)
 
-    finally:
         # Step 4: cleanup temp files
-        for path in (probe_c_path, probe_obj_path):
-            if os.path.exists(path):
-                try:
-                    os.remove(path)
-                    logging.getLogger("core").info(f"Cleaned up {path}")
-                except OSError as e:
-                    logging.getLogger("core").warning(f"Could not remove {path}: {e}")
+        if self.work_dir is not None:
+            try:
+                shutil.rmtree(self.work_dir)
+                logging.getLogger("core").info(f"Cleaned up {self.work_dir}")
+            except OSError as e:
+                logging.getLogger("core").warning(f"Could not remove {self.work_dir}: {e}")
+            self.work_dir = None
+
+
+# ---------------------------------------------------------------------------
+# asyncio variants (see async_pipeline)
+# ---------------------------------------------------------------------------
+
+async def run_command_async(cmd: List[str],
+                            input_data: Optional[bytes] = None,
+                            cwd: Optional[str] = None) -> subprocess.CompletedProcess:
+    """
+    subprocess.run(cmd, input=input_data, capture_output=True, cwd=cwd) with
+    asyncio.create_subprocess_exec; the process is killed if the caller is
+    cancelled.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.PIPE if input_data is not None else None,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        cwd=cwd,
+    )
+    try:
+        stdout, stderr = await proc.communicate(input_data)
+    except asyncio.CancelledError:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+
+async def prepare_file_async(source_file: str,
+                             original_cmd: str,
+                             directory: str,
+                             clang_exec: str = "clang",
+                             collect_dependencies: bool = False,
+                             drivers: Optional[DriverCache] = None) -> PreparedFile:
+    """prepare_file() with the preprocessor run by asyncio.create_subprocess_exec."""
+    logging.getLogger("core").info(f"Preprocessing: {source_file}")
+
+    preprocessor_flags = _extract_preprocessor_flags(original_cmd, directory)
+    dep_path = _new_depfile() if collect_dependencies else None
+    try:
+        # A DriverCache may run `-###` here, so build the command in a thread
+        cmd = await asyncio.to_thread(preprocessor_command, source_file, preprocessor_flags,
+                                      clang_exec, dep_path, drivers)
+        logging.getLogger("core").info(f"Running Preprocessor: {' '.join(cmd)}")
+        result = await run_command_async(cmd)
+        if result.returncode != 0:
+            logging.getLogger("core").error(
+                f"Error running preprocessor: {result.stderr.decode('utf-8', errors='replace')}"
+            )
+        macro_output = result.stdout.decode("utf-8", errors="replace")
+        return _prepared_file(source_file, original_cmd, directory, preprocessor_flags, macro_output, dep_path)
+    finally:
+        if dep_path is not None:
+            os.remove(dep_path)
+
+
+async def compile_probe_async(job: ProbeJob,
+                              probe,
+                              executor: Optional[concurrent.futures.Executor] = None,
+                              stop: Optional[threading.Event] = None) -> Tuple[bool, List[str]]:
+    """
+    ProbeJob.retry() for one of job.probes: the first attempt runs with
+    asyncio.create_subprocess_exec; only a probe that fails it goes through
+    the retry loop, in *executor*.
+    """
+    loop = asyncio.get_running_loop()
+    cmd, input_data = await loop.run_in_executor(executor, probe.command, 0)
+    result = probe.accept(await run_command_async(cmd, input_data, probe.directory))
+    if result.returncode == 0:
+        probe.cleanup()
+        return True, []
+    return await loop.run_in_executor(executor, job.retry, probe, result, stop)
 
 
 # ---------------------------------------------------------------------------
@@ -550,3 +1585,80 @@ def _extract_cmdline_macros(flags: List[str]) -> Dict[str, object]:
                 cmdline_macros[macro_def] = 1
         i += 1
     return cmdline_macros
+
+
+def read_depfile(dep_path: str) -> List[str]:
+    """Return the prerequisites listed in a make-style depfile (-MD / -MF)."""
+    try:
+        with open(dep_path, "r", encoding="utf-8", errors="replace") as f:
+            text = f.read()
+    except OSError:
+        return []
+    text = text.replace("\\\n", " ").replace("\\\r\n", " ")
+    deps = []
+    for rule in text.splitlines():
+        # "target: dep dep ..." — targets may contain ':' on Windows (C:\...)
+        m = re.match(r'^(?:[^:]|:(?=[\\/]))*:\s', rule + " ")
+        if not m:
+            continue
+        tokens = re.findall(r'(?:\\ |[^\s])+', rule[m.end():])
+        deps.extend(token.replace("\\ ", " ") for token in tokens)
+    return deps
+
+
+# ---------------------------------------------------------------------------
+# Benchmark
+# ---------------------------------------------------------------------------
+
+def _benchmark(compile_commands_path: str, clang_exec: str = "clang", limit: int = 20) -> None:
+    """
+    Print the per-TU latency (probe compile + value read) of the object,
+    external-tool and LLVM IR backends over the first *limit* TUs of a
+    compile_commands.json.  Every macro is compiled (no folding, memo or
+    sharding); the TUs are preprocessed once, outside the timings.
+    """
+    import json
+    import statistics
+    import time
+
+    with open(compile_commands_path, "r", encoding="utf-8") as f:
+        entries = json.load(f)[:limit]
+    prepared_files = []
+    for entry in entries:
+        directory = entry.get("directory", ".")
+        source_file = os.path.join(directory, entry["file"])
+        original_cmd = entry.get("command") or shlex.join(entry["arguments"])
+        prepared_files.append(prepare_file(source_file, original_cmd, directory, clang_exec))
+    if not prepared_files:
+        print(f"No TUs in {compile_commands_path}")
+        return
+
+    compiler_lower = Path(clang_exec).stem.lower()
+    tool = "fromelf" if "armclang" in compiler_lower or "armcc" in compiler_lower else "llvm-objdump"
+    backends = ["object", tool, "llvm-ir"]
+    timings: Dict[str, List[float]] = {backend: [] for backend in backends}
+    mismatches: Dict[str, int] = {backend: 0 for backend in backends}
+    for prepared in prepared_files:
+        reference = None
+        for backend in backends:
+            start = time.perf_counter()
+            macros = evaluate_prepared(prepared, clang_exec=clang_exec, fold=False, backend=backend)
+            timings[backend].append(time.perf_counter() - start)
+            if reference is None:
+                reference = macros
+            elif macros != reference:
+                mismatches[backend] += 1
+
+    print(f"{len(prepared_files)} TU(s) from {compile_commands_path}")
+    for backend in backends:
+        ms = [t * 1000 for t in timings[backend]]
+        print(f"{backend:>14}: median {statistics.median(ms):8.1f} ms/TU  mean {statistics.fmean(ms):8.1f} ms/TU"
+              f"  {mismatches[backend]} TU(s) differ from 'object'")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 3 and sys.argv[1] == "--benchmark":
+        _benchmark(sys.argv[2], *sys.argv[3:4], *[int(arg) for arg in sys.argv[4:5]])
+        sys.exit(0)
+    print("Usage: python core.py --benchmark <compile_commands.json> [clang] [max_tus]")
+    sys.exit(1)
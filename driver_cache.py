@@ -0,0 +1,130 @@
+"""
+driver_cache.py — Run clang's cc1 frontend directly instead of the driver.
+
+Every preprocessor and probe compile normally goes through the clang
+driver, which resolves the toolchain, sysroot, target and include paths
+before handing the job to `clang -cc1` (a second process, or in-process
+with -fintegrated-cc1).  Most of those commands differ only in their file
+paths: the same flags are used for every probe of a TU and usually for
+many TUs.
+
+DriverCache runs the driver once with `-###` per distinct command, with
+the per-call paths (input, output, depfile) replaced by placeholders, and
+keeps the single cc1 job it prints as a template.  Later commands with the
+same flags run that cc1 job directly with their own paths substituted.
+
+A command whose expansion is not exactly one `-cc1` job (gcc, an external
+assembler, -save-temps), or whose paths do not all show up verbatim in the
+job, keeps going through the driver.
+"""
+
+import logging
+import os
+import shlex
+import subprocess
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+def _placeholder(i: int, path: str) -> str:
+    # The extension stays part of the key: it selects the input language
+    return f"\0path{i}{os.path.splitext(path)[1]}"
+
+
+def expand_cc1(cmd: List[str], cwd: Optional[str] = None) -> Optional[List[str]]:
+    """
+    The cc1 argument vector the driver would run for *cmd* (from `-###`),
+    or None if it does not run exactly one cc1 job.
+    """
+    try:
+        result = subprocess.run(cmd + ["-###"], capture_output=True, text=True, cwd=cwd)
+    except OSError as e:
+        logging.getLogger("driver_cache").warning(f"Could not run {cmd[0]} -###: {e}")
+        return None
+    if result.returncode != 0:
+        return None
+    # Job lines are the quoted argument vectors; the rest is version/target info
+    jobs = [line for line in result.stderr.splitlines() if line.startswith(' "')]
+    if len(jobs) != 1:
+        return None
+    try:
+        argv = shlex.split(jobs[0])
+    except ValueError:
+        return None
+    if len(argv) < 2 or argv[1] != "-cc1":
+        return None
+    return argv
+
+
+class DriverCache:
+    """Driver expansions (`-###`) of probe and preprocessor commands, per flag set."""
+
+    def __init__(self):
+        # (cwd, command with placeholders) → cc1 template, or None (use the driver)
+        self._templates: Dict[Tuple[str, Tuple[str, ...]], Optional[List[str]]] = {}
+        # Keys being expanded by one worker; the others wait for its template
+        self._pending: Dict[Tuple[str, Tuple[str, ...]], threading.Event] = {}
+        self._lock = threading.Lock()
+        self.expansions = 0
+        self.direct = 0
+
+    def command(self,
+                cmd: List[str],
+                cwd: Optional[str] = None,
+                paths: Sequence[str] = ()) -> List[str]:
+        """
+        The cc1 command equivalent to *cmd*, or *cmd* itself if it has none.
+        *paths* are the per-call file paths in *cmd* (input first); "-" (a
+        pipe) is not a path.
+        """
+        paths = [path for path in paths if path and path != "-"]
+        placeholders = {path: _placeholder(i, path) for i, path in enumerate(paths)}
+        key = (os.path.abspath(cwd or os.getcwd()), tuple(placeholders.get(part, part) for part in cmd))
+
+        template = self._template(key, cmd, cwd, placeholders)
+        if template is None:
+            return cmd
+
+        values = {placeholder: path for path, placeholder in placeholders.items()}
+        if paths:
+            values["\0main"] = os.path.basename(paths[0])
+        with self._lock:
+            self.direct += 1
+        return [values.get(part, part) for part in template]
+
+    def _template(self, key, cmd: List[str], cwd: Optional[str], placeholders: Dict[str, str]) -> Optional[List[str]]:
+        while True:
+            with self._lock:
+                if key in self._templates:
+                    return self._templates[key]
+                pending = self._pending.get(key)
+                if pending is None:
+                    self._pending[key] = threading.Event()
+                    break
+            pending.wait()
+
+        template = None
+        try:
+            template = self._expand(cmd, cwd, placeholders)
+        finally:
+            with self._lock:
+                self._templates[key] = template
+                self.expansions += 1
+                self._pending.pop(key).set()
+        return template
+
+    @staticmethod
+    def _expand(cmd: List[str], cwd: Optional[str], placeholders: Dict[str, str]) -> Optional[List[str]]:
+        argv = expand_cc1(cmd, cwd)
+        if argv is None:
+            logging.getLogger("driver_cache").info(f"No single cc1 job for {' '.join(cmd)}; using the driver")
+            return None
+        template = [placeholders.get(part, part) for part in argv]
+        if any(placeholder not in template for placeholder in placeholders.values()):
+            logging.getLogger("driver_cache").info(f"cc1 job does not name every path of {' '.join(cmd)}; using the driver")
+            return None
+        # The main file name is the input's basename, used for diagnostics and debug info
+        for i in range(len(template) - 1):
+            if template[i] == "-main-file-name" and placeholders:
+                template[i + 1] = "\0main"
+        return template
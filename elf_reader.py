@@ -1,20 +1,34 @@
 """
 elf_reader.py — Read PROBE_ global variable values from a compiled object file.
 
-Supports two backends, selected based on the compiler executable:
+The default backend is an in-process reader that mmaps the object and walks the
+ELF32/ELF64 or COFF section and symbol tables directly — no subprocess, no text
+parsing.  It is used for every compiler (clang and armclang alike).
+
+Two external-tool backends remain as a fallback for containers the in-process
+reader does not understand (e.g. Mach-O):
   - llvm-objdump  (for clang / any LLVM-based compiler)
   - fromelf       (for armclang / ARM Compiler 6)
 
 The reader locates each PROBE_xxx symbol in the object's data/rodata section
-and interprets the 8 bytes at that offset as a little-endian int64.
+and interprets the 8 bytes at that offset as a signed int64 in the object's
+byte order.
+
+The external tools can also be selected directly (backend="llvm-objdump" or
+"fromelf").  A third backend, "llvm-ir", reads probes compiled by clang with
+`-S -emit-llvm` instead of `-c`: the values are the initializers of the
+`@PROBE_xxx = ... i64 N` globals in the IR text, so the compile skips target
+codegen and there is no object to parse at all.
 """
 
+import mmap
 import os
 import re
 import struct
 import subprocess
 import sys
 import logging
+import tempfile
 from pathlib import Path
 from typing import Dict, List, Optional
 
@@ -23,6 +37,9 @@ from typing import Dict, List, Optional
 # compile-time integer constant.
 PROBE_SENTINEL = -9999
 
+# Values of read_probe_values(backend=...)
+BACKENDS = ("object", "llvm-objdump", "fromelf", "llvm-ir")
+
 
 # ---------------------------------------------------------------------------
 # Public API
@@ -30,7 +47,8 @@ PROBE_SENTINEL = -9999
 
 def read_probe_values(obj_path: str,
                       probe_names: List[str],
-                      compiler_exec: str = "clang") -> Dict[str, Optional[int]]:
+                      compiler_exec: str = "clang",
+                      backend: str = "object") -> Dict[str, Optional[int]]:
     """
     Read PROBE_<name> symbol values from *obj_path*.
 
@@ -38,19 +56,61 @@ def read_probe_values(obj_path: str,
     integer value, or None if it could not be determined.
     Entries whose value equals PROBE_SENTINEL are mapped to None, meaning
     "macro exists but is not a compile-time constant".
+
+    backend is one of BACKENDS: "object" (in-process reader, external tools
+    as fallback), one external tool, or "llvm-ir" for an `-S -emit-llvm`
+    output file.
     """
     compiler_lower = Path(compiler_exec).stem.lower()
 
-    # Determine which backend to use
-    if "armclang" in compiler_lower or "armcc" in compiler_lower:
+    if backend == "llvm-ir":
+        raw = _read_with_ir_reader(obj_path)
+    elif backend == "llvm-objdump":
+        raw = _read_with_llvm_objdump(obj_path, compiler_exec)
+    elif backend == "fromelf":
         raw = _read_with_fromelf(obj_path, compiler_exec)
     else:
-        raw = _read_with_llvm_objdump(obj_path, compiler_exec)
+        raw = _read_with_object_reader(obj_path)
+    if raw is None and backend == "object":
+        # Unknown container format — fall back to the external dump tools
+        if "armclang" in compiler_lower or "armcc" in compiler_lower:
+            raw = _read_with_fromelf(obj_path, compiler_exec)
+        else:
+            raw = _read_with_llvm_objdump(obj_path, compiler_exec)
 
     if raw is None:
         logging.getLogger("elf_reader").warning(f"Could not read {obj_path}")
         return {name: None for name in probe_names}
+    return _probe_values(raw, probe_names)
+
+
+def decode_probe_values(obj_image: bytes,
+                        probe_names: List[str],
+                        compiler_exec: str = "clang",
+                        backend: str = "object") -> Dict[str, Optional[int]]:
+    """
+    read_probe_values() for an object image held in memory (e.g. the
+    compiler's stdout with `-o -`).  Only a container the in-process reader
+    does not understand, or an image for an external-tool backend, is
+    written to a temporary file.
+    """
+    if backend == "llvm-ir":
+        return _probe_values(parse_probe_ir(obj_image.decode("utf-8", errors="replace")), probe_names)
+    raw = parse_probe_symbols(obj_image) if obj_image and backend == "object" else None
+    if raw is not None:
+        return _probe_values(raw, probe_names)
 
+    fd, obj_path = tempfile.mkstemp(suffix=".obj")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(obj_image)
+        return read_probe_values(obj_path, probe_names, compiler_exec, backend)
+    finally:
+        os.remove(obj_path)
+
+
+def _probe_values(raw: Dict[str, int], probe_names: List[str]) -> Dict[str, Optional[int]]:
+    """Map probe names to the decoded PROBE_ symbol values (None if missing or the sentinel)."""
     result: Dict[str, Optional[int]] = {}
     for name in probe_names:
         symbol = f"PROBE_{name}"
@@ -65,6 +125,270 @@ def read_probe_values(obj_path: str,
     return result
 
 
+def object_reader_version(compiler_exec: str = "clang") -> str:
+    """
+    Version string of the external dump tool read_probe_values() falls back
+    to for *compiler_exec* ("" if it is not installed).
+    """
+    compiler_lower = Path(compiler_exec).stem.lower()
+    if "armclang" in compiler_lower or "armcc" in compiler_lower:
+        tool = _find_fromelf(compiler_exec)
+    else:
+        tool = _find_llvm_objdump(compiler_exec)
+    try:
+        result = subprocess.run([tool, "--version"], capture_output=True, text=True)
+    except OSError:
+        return ""
+    return result.stdout.strip()
+
+
+# ---------------------------------------------------------------------------
+# Backend: in-process ELF / COFF reader
+# ---------------------------------------------------------------------------
+
+_PROBE_PREFIX = b"PROBE_"
+
+# ELF constants
+_ELF_MAGIC = b"\x7fELF"
+_ELFCLASS64 = 2
+_ELFDATA2MSB = 2
+_ET_REL = 1
+_SHT_SYMTAB = 2
+_SHT_NOBITS = 8
+_SHT_SYMTAB_SHNDX = 18
+_SHN_UNDEF = 0
+_SHN_LORESERVE = 0xFF00
+_SHN_XINDEX = 0xFFFF
+
+# COFF constants
+_COFF_SYMBOL_SIZE = 18
+_COFF_BIGOBJ_SYMBOL_SIZE = 20
+_COFF_SECTION_SIZE = 40
+_IMAGE_SCN_CNT_UNINITIALIZED_DATA = 0x00000080
+_COFF_MACHINES = frozenset({
+    0x0000,  # unknown / any
+    0x014C,  # i386
+    0x8664,  # x86-64
+    0x01C0,  # ARM
+    0x01C2,  # Thumb
+    0x01C4,  # ARMv7 Thumb-2
+    0xAA64,  # ARM64
+    0xA641,  # ARM64EC
+})
+_BIGOBJ_CLASS_ID = bytes.fromhex("c7a1bad1eebaa94baf20faf66aa4dcb8")
+
+
+def _read_with_object_reader(obj_path: str) -> Optional[Dict[str, int]]:
+    """
+    mmap *obj_path* and decode every PROBE_ symbol in one pass over its symbol
+    table.
+
+    Returns None if the file is not an ELF or COFF object (the caller then
+    falls back to an external dump tool).
+    """
+    try:
+        with open(obj_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                logging.getLogger("elf_reader").error(f"Object file is empty: {obj_path}")
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return parse_probe_symbols(mm)
+    except OSError as e:
+        logging.getLogger("elf_reader").error(f"Could not open {obj_path}: {e}")
+        return None
+
+
+def parse_probe_symbols(buf) -> Optional[Dict[str, int]]:
+    """
+    Decode all PROBE_ symbol values from an object image held in *buf*
+    (bytes, bytearray or mmap).
+
+    Returns {symbol_name: int64_value}, or None for an unrecognised format.
+    """
+    with memoryview(buf) as mv:
+        try:
+            if mv[:4] == _ELF_MAGIC:
+                return _parse_elf(mv)
+            return _parse_coff(mv)
+        except struct.error as e:
+            logging.getLogger("elf_reader").error(f"Truncated object file: {e}")
+            return None
+
+
+def _parse_elf(mv: memoryview) -> Optional[Dict[str, int]]:
+    """Walk the section headers and the SHT_SYMTAB of an ELF32/ELF64 object."""
+    is64 = mv[4] == _ELFCLASS64
+    endian = ">" if mv[5] == _ELFDATA2MSB else "<"
+    byteorder = "big" if endian == ">" else "little"
+
+    e_type = struct.unpack_from(endian + "H", mv, 16)[0]
+    if is64:
+        e_shoff = struct.unpack_from(endian + "Q", mv, 0x28)[0]
+        e_shentsize, e_shnum, e_shstrndx = struct.unpack_from(endian + "HHH", mv, 0x3A)
+        sh_fmt = struct.Struct(endian + "IIQQQQIIQQ")
+        sym_fmt = struct.Struct(endian + "IBBHQQ")
+    else:
+        e_shoff = struct.unpack_from(endian + "I", mv, 0x20)[0]
+        e_shentsize, e_shnum, e_shstrndx = struct.unpack_from(endian + "HHH", mv, 0x2E)
+        sh_fmt = struct.Struct(endian + "IIIIIIIIII")
+        sym_fmt = struct.Struct(endian + "IIIBBH")
+
+    if e_shoff == 0:
+        logging.getLogger("elf_reader").warning("ELF object has no section header table.")
+        return {}
+
+    # Extended numbering: the real section count lives in section 0's sh_size
+    if e_shnum == 0:
+        e_shnum = sh_fmt.unpack_from(mv, e_shoff)[5]
+
+    # (sh_type, sh_addr, sh_offset, sh_size, sh_link) per section index
+    sections = []
+    for idx in range(e_shnum):
+        (_, sh_type, _, sh_addr, sh_offset, sh_size,
+         sh_link, _, _, _) = sh_fmt.unpack_from(mv, e_shoff + idx * e_shentsize)
+        sections.append((sh_type, sh_addr, sh_offset, sh_size, sh_link))
+
+    symtab_idx = next((i for i, s in enumerate(sections) if s[0] == _SHT_SYMTAB), None)
+    if symtab_idx is None:
+        logging.getLogger("elf_reader").warning("No symbol table in ELF object.")
+        return {}
+    _, _, symtab_off, symtab_size, strtab_idx = sections[symtab_idx]
+    strtab_off = sections[strtab_idx][2]
+
+    # SHN_XINDEX escapes resolve through the SHT_SYMTAB_SHNDX section
+    shndx_off = next((s[2] for s in sections
+                      if s[0] == _SHT_SYMTAB_SHNDX and s[4] == symtab_idx), None)
+
+    relocatable = e_type == _ET_REL
+    data = mv.obj
+    result: Dict[str, int] = {}
+    for sym_idx in range(symtab_size // sym_fmt.size):
+        fields = sym_fmt.unpack_from(mv, symtab_off + sym_idx * sym_fmt.size)
+        if is64:
+            st_name, _, _, st_shndx, st_value, _ = fields
+        else:
+            st_name, st_value, _, _, _, st_shndx = fields
+
+        name_off = strtab_off + st_name
+        if mv[name_off:name_off + len(_PROBE_PREFIX)] != _PROBE_PREFIX:
+            continue
+
+        if st_shndx == _SHN_XINDEX and shndx_off is not None:
+            st_shndx = struct.unpack_from(endian + "I", mv, shndx_off + sym_idx * 4)[0]
+        elif st_shndx == _SHN_UNDEF or st_shndx >= _SHN_LORESERVE:
+            continue
+        if st_shndx >= len(sections):
+            continue
+
+        name = _read_cstring(data, name_off)
+        sh_type, sh_addr, sh_offset, sh_size, _ = sections[st_shndx]
+        sec_rel = st_value if relocatable else st_value - sh_addr
+        if sh_type == _SHT_NOBITS:
+            # Zero-initialised probe placed in .bss
+            result[name] = 0
+            continue
+        if sec_rel + 8 > sh_size:
+            logging.getLogger("elf_reader").error(f"Not enough bytes for {name} at offset {sec_rel:#x}")
+            continue
+        start = sh_offset + sec_rel
+        result[name] = int.from_bytes(mv[start:start + 8], byteorder=byteorder, signed=True)
+
+    return result
+
+
+def _parse_coff(mv: memoryview) -> Optional[Dict[str, int]]:
+    """Walk the section table and symbol table of a COFF (or /bigobj) object."""
+    if len(mv) < 20:
+        return None
+
+    sig1, sig2 = struct.unpack_from("<HH", mv, 0)
+    if sig1 == 0 and sig2 == 0xFFFF and mv[12:28] == _BIGOBJ_CLASS_ID:
+        n_sections, ptr_symtab, n_symbols = struct.unpack_from("<III", mv, 44)
+        sec_table_off = 56
+        sym_fmt = struct.Struct("<8sIiHBB")
+    else:
+        machine, n_sections, _, ptr_symtab, n_symbols, opt_size, _ = \
+            struct.unpack_from("<HHIIIHH", mv, 0)
+        if machine not in _COFF_MACHINES:
+            return None
+        sec_table_off = 20 + opt_size
+        sym_fmt = struct.Struct("<8sIhHBB")
+
+    strtab_off = ptr_symtab + n_symbols * sym_fmt.size
+    if (n_sections == 0 or ptr_symtab == 0
+            or sec_table_off + n_sections * _COFF_SECTION_SIZE > len(mv)
+            or strtab_off > len(mv)):
+        return None
+
+    # (raw_data_ptr, raw_size, characteristics) per 1-based section number
+    sections = [None]
+    for idx in range(n_sections):
+        _, _, _, raw_size, raw_ptr, _, _, _, _, characteristics = struct.unpack_from(
+            "<8sIIIIIIHHI", mv, sec_table_off + idx * _COFF_SECTION_SIZE)
+        sections.append((raw_ptr, raw_size, characteristics))
+
+    data = mv.obj
+    result: Dict[str, int] = {}
+    sym_idx = 0
+    while sym_idx < n_symbols:
+        raw_name, value, sec_num, _, _, n_aux = sym_fmt.unpack_from(
+            mv, ptr_symtab + sym_idx * sym_fmt.size)
+        sym_idx += 1 + n_aux
+
+        if raw_name[:4] == b"\0\0\0\0":
+            name = _read_cstring(data, strtab_off + int.from_bytes(raw_name[4:], "little"))
+        else:
+            name = raw_name.rstrip(b"\0").decode("ascii", errors="replace")
+
+        # 32-bit x86 decorates C symbols with a leading underscore
+        if name.startswith("_PROBE_"):
+            name = name[1:]
+        if not name.startswith("PROBE_") or not 0 < sec_num < len(sections):
+            continue
+
+        raw_ptr, raw_size, characteristics = sections[sec_num]
+        if raw_ptr == 0 or characteristics & _IMAGE_SCN_CNT_UNINITIALIZED_DATA:
+            result[name] = 0
+            continue
+        if value + 8 > raw_size:
+            logging.getLogger("elf_reader").error(f"Not enough bytes for {name} at offset {value:#x}")
+            continue
+        start = raw_ptr + value
+        result[name] = int.from_bytes(mv[start:start + 8], byteorder="little", signed=True)
+
+    return result
+
+
+def _read_cstring(data, offset: int) -> str:
+    """Read a NUL-terminated ASCII string starting at *offset* of *data*."""
+    end = data.find(b"\0", offset)
+    if end < 0:
+        end = len(data)
+    return bytes(data[offset:end]).decode("ascii", errors="replace")
+
+
+# ---------------------------------------------------------------------------
+# Backend: LLVM IR text (clang -S -emit-llvm)
+# ---------------------------------------------------------------------------
+
+# @PROBE_X = dso_local constant i64 42, align 8   (linkage/attributes vary)
+_IR_PROBE_RE = re.compile(r'^@(PROBE_[A-Za-z0-9_]+) = [^\n]*?\b(?:constant|global) i64 (-?\d+)', re.MULTILINE)
+
+
+def parse_probe_ir(text: str) -> Dict[str, int]:
+    """Decode all PROBE_ global initializers from LLVM IR text."""
+    return {m.group(1): int(m.group(2)) for m in _IR_PROBE_RE.finditer(text)}
+
+
+def _read_with_ir_reader(ir_path: str) -> Optional[Dict[str, int]]:
+    try:
+        with open(ir_path, "r", encoding="utf-8", errors="replace") as f:
+            return parse_probe_ir(f.read())
+    except OSError as e:
+        logging.getLogger("elf_reader").error(f"Could not open {ir_path}: {e}")
+        return None
+
+
 # ---------------------------------------------------------------------------
 # Backend: llvm-objdump
 # ---------------------------------------------------------------------------
@@ -162,6 +486,16 @@ def _read_with_llvm_objdump(obj_path: str, compiler_exec: str) -> Optional[Dict[
         if section is None or offset is None:
             continue
         
+        if not section.startswith("sec"):
+            # ELF: the symbol table names the section itself
+            chunks = section_bytes.get(section)
+            if not chunks:
+                logging.getLogger("elf_reader").error(f"Section '{section}' not found in hex dump.")
+                continue
+            value = int.from_bytes(chunks[0][offset:offset + 8], byteorder='little', signed=True)
+            result[sym_name] = value
+            continue
+
         keys = list(section_map.keys())
         targetIdx = (-1, -1)
         for i in range(0, len(keys)):
@@ -203,9 +537,9 @@ def _parse_symbol_line(line: str, sym_name: str, symbols: dict):
     COFF format example:
       [  2] (sec  3)(fl 0x00)(ty   0)(scl   3) (nx 0) 0x00000000 PROBE_TEST_MACRO
     """
-    # ELF pattern: <hex_addr> <flags> <section> <hex_size> <name>
+    # ELF pattern: <hex_addr> <7 flag columns, e.g. "g     O"> <section> <hex_size> <name>
     elf_m = re.match(
-        r'([0-9a-fA-F]+)\s+\S+\s+(\S+)\s+([0-9a-fA-F]+)\s+(\S+)', line
+        r'([0-9a-fA-F]+) .{7} (\S+)\s+([0-9a-fA-F]+)\s+(\S+)', line
     )
     if elf_m and elf_m.group(4) == sym_name:
         symbols[sym_name] = {
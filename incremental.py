@@ -0,0 +1,147 @@
+"""
+incremental.py — State for `main.py --incremental`.
+
+After a run, the per-TU include closure (from the -MD depfile of the `-E -dM`
+step) and the TU's full macro dict are saved next to the output file
+(<output>.state.json).  On the next run a TU is skipped entirely — not even
+preprocessed — if its compile command is unchanged and none of the files in
+its closure changed:
+
+  - a file whose mtime and size match the saved stamp is unchanged;
+  - otherwise its contents are hashed and compared with the saved digest
+    (a touched-but-identical header does not force a rerun).
+
+The saved results of skipped TUs are merged back into the output, provided
+they cover every macro the current run needs from the TU (the saved probe
+candidates within the conditional-macro filter).  The two checks are
+separate steps — unchanged() before preprocessing, reuse() once the filter
+is known — since the filter itself may be computed from the saved include
+closures (main.py --conditional-scope closure).  The whole state is
+discarded when the compiler, the object reader or a result-affecting option
+changed.
+"""
+
+import json
+import logging
+import os
+import tempfile
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+
+from result_cache import file_digest
+
+_STATE_VERSION = 1
+
+
+class SavedResult(NamedTuple):
+    """Saved state of a TU whose command and include closure are unchanged."""
+    key: str
+    deps: List[str]
+    macros: Dict
+    candidates: List[str]
+
+
+def state_path_for(output_file: str) -> str:
+    """Where the incremental state for *output_file* is kept."""
+    return output_file + ".state.json"
+
+
+class IncrementalState:
+    """Saved per-TU closures and results of the previous run."""
+
+    def __init__(self, path: str, options: Iterable[str]):
+        self.path = path
+        self.options = list(options)
+        self._previous: Dict[str, Dict] = {}
+        self._current: Dict[str, Dict] = {}
+        self.reused = 0
+
+    @classmethod
+    def load(cls, path: str, options: Iterable[str]) -> "IncrementalState":
+        state = cls(path, options)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return state
+        except (OSError, ValueError) as e:
+            logging.getLogger("incremental").warning(f"Ignoring unreadable state {path}: {e}")
+            return state
+
+        if data.get("version") != _STATE_VERSION or data.get("options") != state.options:
+            logging.getLogger("incremental").info("Tool versions or options changed; reprocessing all files.")
+            return state
+        state._previous = data.get("files", {})
+        return state
+
+    @staticmethod
+    def _key(source_file: str, original_cmd: str, directory: str) -> str:
+        return f"{os.path.abspath(source_file)}\0{directory}\0{original_cmd}"
+
+    def unchanged(self,
+                  source_file: str,
+                  original_cmd: str,
+                  directory: str) -> Optional[SavedResult]:
+        """The saved state of the TU if nothing in its include closure changed, else None."""
+        key = self._key(source_file, original_cmd, directory)
+        entry = self._previous.get(key)
+        if entry is None or entry.get("candidates") is None:
+            return None
+
+        deps = entry["deps"]
+        for path, (mtime_ns, size, digest) in deps.items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            if st.st_mtime_ns == mtime_ns and st.st_size == size:
+                continue
+            if file_digest(path) != digest:
+                return None
+            deps[path] = [st.st_mtime_ns, st.st_size, digest]
+        return SavedResult(key, list(deps), entry["macros"], entry["candidates"])
+
+    def reuse(self, saved: SavedResult, allowed: Optional[Set[str]] = None) -> Optional[Dict]:
+        """
+        Saved macro dict of an unchanged() TU if it holds every candidate
+        within *allowed* (the TU is then carried over to the new state),
+        else None.
+        """
+        if any(name not in saved.macros for name in saved.candidates
+               if allowed is None or name in allowed):
+            return None
+        self._current[saved.key] = self._previous[saved.key]
+        self.reused += 1
+        return dict(saved.macros)
+
+    def record(self, prepared, macros: Dict, candidates: List[str]) -> None:
+        """
+        Remember a processed TU (core.PreparedFile with dependencies), its
+        macro dict and all of its probe candidates.
+        """
+        if not prepared.dependencies:
+            return
+        deps = {}
+        for path in prepared.dependencies:
+            digest = file_digest(path)
+            if digest is None:
+                return
+            st = os.stat(path)
+            deps[path] = [st.st_mtime_ns, st.st_size, digest]
+        key = self._key(prepared.source_file, prepared.original_cmd, prepared.directory)
+        self._current[key] = {"deps": deps, "macros": macros, "candidates": candidates}
+
+    def save(self) -> None:
+        """Atomically write the state of this run (reused + newly recorded TUs)."""
+        data = {"version": _STATE_VERSION, "options": self.options, "files": self._current}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.getLogger("incremental").warning(f"Could not save incremental state {self.path}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
@@ -0,0 +1,226 @@
+"""
+job_control.py — Deadlines, cancellation and metering of one TU's compiler runs.
+
+main.py runs each stage of a TU (preprocessing, probing) inside
+job_context(control).  Every compiler process the stage starts through
+run_process() — from any thread carrying the context, see in_job_context()
+— is registered with the JobControl, which
+
+  - reaps it with os.wait4 and keeps the peak RSS for job_costs;
+  - kills it when the attempt's timeout expires (JobTimedOut) or when the
+    attempt is cancelled because another attempt at the same TU won
+    (JobCancelled); no further process starts after that.
+
+Only the process run_process() started is killed: a compiler driver that
+runs its frontend as a separate process (gcc; clang with
+-fno-integrated-cc1) may leave the frontend running until it finishes,
+though the attempt itself stops at once.
+Without os.wait4 (Windows) no peak RSS is recorded.
+"""
+
+import contextlib
+import contextvars
+import os
+import subprocess
+import sys
+import threading
+import time
+from typing import Iterator, Optional, Set
+
+# ru_maxrss is in KiB on Linux, in bytes on macOS
+_RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+class JobCancelled(Exception):
+    """The attempt was cancelled; its compiler processes were killed."""
+
+
+class JobTimedOut(JobCancelled):
+    """The attempt ran past its timeout."""
+
+
+class JobControl:
+    """One attempt at one stage of a TU."""
+
+    def __init__(self, timeout: Optional[float] = None):
+        self.timeout = timeout
+        self.started: Optional[float] = None     # time.monotonic() when the attempt began
+        self.finished: Optional[float] = None
+        self.cancelled = False
+        self.timed_out = False
+        self._lock = threading.Lock()
+        self._procs: Set[subprocess.Popen] = set()
+        self._watchdog: Optional[threading.Timer] = None
+        self._running = 0
+        self._max_running = 0
+        self._max_rss = 0
+
+    @property
+    def elapsed(self) -> float:
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def peak_rss(self) -> int:
+        """Largest compiler process times the most processes running at once (bytes)."""
+        with self._lock:
+            return self._max_rss * max(1, self._max_running)
+
+    def cancel(self) -> None:
+        """Kill the attempt's compiler processes and refuse new ones."""
+        self._kill(timed_out=False)
+
+    def _expire(self) -> None:
+        self._kill(timed_out=True)
+
+    def _kill(self, timed_out: bool) -> None:
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            self.timed_out = timed_out
+            procs = list(self._procs)
+        for proc in procs:
+            try:
+                proc.kill()
+            except OSError:
+                pass
+
+    def _begin(self) -> None:
+        self.started = time.monotonic()
+        if self.timeout is not None:
+            self._watchdog = threading.Timer(self.timeout, self._expire)
+            self._watchdog.daemon = True
+            self._watchdog.start()
+
+    def _end(self) -> None:
+        self.finished = time.monotonic()
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+
+    def _register(self, proc: subprocess.Popen) -> None:
+        with self._lock:
+            if not self.cancelled:
+                self._procs.add(proc)
+                self._running += 1
+                self._max_running = max(self._max_running, self._running)
+                return
+        proc.kill()
+        proc.wait()
+        self.check()
+
+    def _unregister(self, proc: subprocess.Popen, rss: int) -> None:
+        with self._lock:
+            self._procs.discard(proc)
+            self._running -= 1
+            self._max_rss = max(self._max_rss, rss)
+
+    def check(self) -> None:
+        """Raise JobTimedOut / JobCancelled if the attempt was stopped."""
+        if self.timed_out:
+            raise JobTimedOut(f"timed out after {self.timeout:g}s")
+        if self.cancelled:
+            raise JobCancelled("cancelled")
+
+
+_control: contextvars.ContextVar[Optional[JobControl]] = contextvars.ContextVar("job_control", default=None)
+
+
+@contextlib.contextmanager
+def job_context(control: JobControl) -> Iterator[JobControl]:
+    """Run the block as *control*'s attempt: start its clock and timeout."""
+    token = _control.set(control)
+    control._begin()
+    try:
+        yield control
+    finally:
+        control._end()
+        _control.reset(token)
+
+
+def in_job_context(fn):
+    """
+    *fn* bound to a copy of the caller's context, for running in another
+    thread (a thread pool does not carry the current JobControl over).
+    """
+    context = contextvars.copy_context()
+    return lambda *args: context.run(fn, *args)
+
+
+def run_process(cmd,
+                input=None,
+                cwd: Optional[str] = None,
+                text: bool = False,
+                check: bool = False) -> subprocess.CompletedProcess:
+    """
+    subprocess.run(cmd, input=input, capture_output=True, cwd=cwd, text=text,
+    check=check), with the process registered with the current JobControl
+    (if any): killed with it, and its peak RSS recorded.
+    """
+    control = _control.get()
+    if control is None:
+        return subprocess.run(cmd, input=input, capture_output=True, cwd=cwd, text=text, check=check)
+
+    control.check()
+    if text and input is not None:
+        input = input.encode("utf-8")
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE if input is not None else None,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
+    control._register(proc)
+    rss = 0
+    output = {}
+    try:
+        # Popen.communicate() would reap the child itself, so drain the pipes
+        # in threads and reap it here.  The threads are not waited for once
+        # the attempt is killed: a frontend the driver started may still hold
+        # the pipes open.
+        threads = [threading.Thread(target=_drain, args=(proc.stdout, output, "stdout"), daemon=True),
+                   threading.Thread(target=_drain, args=(proc.stderr, output, "stderr"), daemon=True)]
+        if input is not None:
+            threads.append(threading.Thread(target=_feed, args=(proc.stdin, input), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        if hasattr(os, "wait4"):
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            rss = usage.ru_maxrss * _RSS_UNIT
+        else:
+            proc.wait()
+        if not control.cancelled:
+            for thread in threads:
+                thread.join()
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    finally:
+        control._unregister(proc, rss)
+    control.check()
+
+    stdout = output.get("stdout", b"")
+    stderr = output.get("stderr", b"")
+    if text:
+        stdout = stdout.decode("utf-8", errors="replace")
+        stderr = stderr.decode("utf-8", errors="replace")
+    if check and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stdout, stderr)
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+
+def _drain(pipe, output: dict, name: str) -> None:
+    with pipe:
+        output[name] = pipe.read()
+
+
+def _feed(stdin, data: bytes) -> None:
+    try:
+        stdin.write(data)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
@@ -0,0 +1,106 @@
+"""
+job_costs.py — Per-TU cost records for the scheduler (main.py, scheduler.py).
+
+A TU's cost is its wall time and its peak memory (the largest compiler
+process times the most processes it had running at once, e.g. probe
+shards), as metered by the JobControl of each of its stages (job_control.py).
+Costs are saved in <cache_dir>/job_costs.json; the next run starts the most
+expensive TUs first and keeps the expected memory of the running TUs under
+--max-memory.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+from typing import Dict, NamedTuple
+
+_COSTS_VERSION = 1
+
+
+class JobCost(NamedTuple):
+    """Measured cost of one TU."""
+    seconds: float
+    peak_rss: int       # bytes; 0 if unknown
+
+
+def job_key(source_file: str, original_cmd: str, directory: str) -> str:
+    """The key of a compile command in the cost records."""
+    return f"{os.path.abspath(source_file)}\0{directory}\0{original_cmd}"
+
+
+class CostRecords:
+    """Saved JobCost of every compile command, updated with this run's measurements."""
+
+    def __init__(self, path: str):
+        self.path = path
+        # Costs of the previous runs (estimates) and of this run (record())
+        self._saved: Dict[str, JobCost] = {}
+        self._current: Dict[str, JobCost] = {}
+        # Estimate for commands never measured: the mean of the saved costs
+        self._default = JobCost(0.0, 0)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str) -> "CostRecords":
+        records = cls(path)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return records
+        except (OSError, ValueError) as e:
+            logging.getLogger("job_costs").warning(f"Ignoring unreadable cost records {path}: {e}")
+            return records
+        if data.get("version") == _COSTS_VERSION:
+            records._saved = {key: JobCost(*cost) for key, cost in data.get("jobs", {}).items()}
+        if records._saved:
+            known = list(records._saved.values())
+            records._default = JobCost(sum(c.seconds for c in known) / len(known),
+                                       sum(c.peak_rss for c in known) // len(known))
+        return records
+
+    @property
+    def measured(self) -> int:
+        """Number of compile commands measured in this run."""
+        return len(self._current)
+
+    def estimate(self, key: str) -> JobCost:
+        """The saved cost of *key*, or the mean saved cost for a command never measured."""
+        return self._saved.get(key, self._default)
+
+    def record(self, key: str, seconds: float, peak_rss: int) -> None:
+        """
+        Add a measured stage (or attempt) to *key*'s cost of this run: the
+        preprocess and probe phases of a TU add up.
+        """
+        cost = JobCost(seconds, peak_rss)
+        with self._lock:
+            previous = self._current.get(key)
+            if previous is not None:
+                cost = JobCost(previous.seconds + cost.seconds, max(previous.peak_rss, cost.peak_rss))
+            self._current[key] = cost
+
+    def save(self) -> None:
+        """Atomically write the records (this run's measurements replace the saved ones)."""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with self._lock:
+            jobs = {**self._saved, **self._current}
+            data = {"version": _COSTS_VERSION, "jobs": {key: list(cost) for key, cost in jobs.items()}}
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        except OSError as e:
+            logging.getLogger("job_costs").warning(f"Could not save cost records {self.path}: {e}")
+            return
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.getLogger("job_costs").warning(f"Could not save cost records {self.path}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
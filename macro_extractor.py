@@ -12,8 +12,15 @@ The probe file contains one global variable per macro:
 
 import re
 import os
+import sys
+import random
+import hashlib
+import platform
 import subprocess
 import logging
+from typing import NamedTuple
+
+from job_control import run_process
 
 # Sentinel value written when a macro is not a compile-time integer constant.
 # elf_reader.py interprets this as None (not evaluable).
@@ -31,6 +38,10 @@ PROBE_TEMPLATE_MAYBE = (
 # These are trivially known to map to 1.
 PROBE_TEMPLATE_EMPTY = "const volatile long long PROBE_{name} = 1LL;\n"
 
+# Banner lines separating the probe TU sections
+PROBE_BANNER = "\n\n/* --- MACRO PROBES --- */\n"
+DEFINES_BANNER = "/* --- MACRO DEFINITIONS (clang -E -dM) --- */\n"
+
 # C keywords that, when they appear as the START of a macro value, indicate
 # the macro expands to a statement or type fragment — not a castable expression.
 _STMT_KEYWORDS = frozenset({
@@ -84,43 +95,975 @@ def _macro_value_is_skippable(value: str) -> bool:
     return False
 
 
+# Name of the macro on a "#define NAME…" line (object-like or function-like)
+_DEFINE_NAME_RE = re.compile(r'^[ \t]*#[ \t]*define[ \t]+([A-Za-z_][A-Za-z0-9_]*)')
+
+
+def _header_only_prelude(macro_output):
+    """
+    Build the body of a header-only probe TU from a `-E -dM` dump: every
+    #define line, in dump order, and nothing else.
+
+    The probe compile uses the original flags, so compiler-predefined macros
+    (`__x86_64__`, `__GNUC__`, …) already exist; re-defining them with the
+    same text is legal, but redefining a builtin draws diagnostics on some
+    compilers, so reserved `__NAME__` macros are guarded with #ifndef.
+    """
+    lines = [DEFINES_BANNER]
+    for line in macro_output.splitlines():
+        m = _DEFINE_NAME_RE.match(line)
+        if not m:
+            continue
+        name = m.group(1)
+        if name.startswith("__") and name.endswith("__"):
+            lines.append(f"#ifndef {name}\n{line}\n#endif\n")
+        else:
+            lines.append(line + "\n")
+    return "".join(lines)
+
+
+def preprocessor_command(source_path, compile_flags=None, clang_exec="clang", depfile=None, drivers=None):
+    """The `-E -dM` command run_preprocessor() runs (see there)."""
+    if compile_flags is None:
+        compile_flags = []
+
+    # Run compiler -E -dM to discover all macros (including those from headers).
+    # This is the authoritative source — it reflects the exact macro environment
+    # that the compile command would set up.
+    cmd = [clang_exec, "-E", "-dM"] + compile_flags + [source_path]
+    if depfile:
+        cmd[3:3] = ["-MD", "-MF", depfile]
+    if drivers is not None:
+        cmd = drivers.command(cmd, None, [source_path, depfile])
+    return cmd
+
+
+def run_preprocessor(source_path, compile_flags=None, clang_exec="clang", depfile=None, drivers=None):
+    """
+    Run the compiler preprocessor (-E -dM) on *source_path* and return the
+    macro dump as text ("" if the preprocessor produced nothing).
+
+    If *depfile* is given, the preprocessor also writes a make-style list of
+    the source and every header it read there (-MD -MF).
+
+    With a driver_cache.DriverCache the command runs as a direct cc1 job.
+    """
+    cmd = preprocessor_command(source_path, compile_flags, clang_exec, depfile, drivers)
+    logging.getLogger("macro_extractor").info(f"Running Preprocessor: {' '.join(cmd)}")
+
+    try:
+        result = run_process(cmd, text=True, check=True)
+        return result.stdout
+    except subprocess.CalledProcessError as e:
+        logging.getLogger("macro_extractor").error(f"Error running preprocessor: {e.stderr}")
+        return e.stdout if e.stdout else ""
+
+
+def normalize_macro_dump(macro_output):
+    """
+    Canonical form of a `-E -dM` dump: #define lines with trailing whitespace
+    stripped, sorted.  Two TUs with the same macro environment produce the same
+    normalized dump regardless of the order the preprocessor listed them in.
+    """
+    lines = (line.rstrip() for line in macro_output.splitlines())
+    return "\n".join(sorted(line for line in lines if line))
+
+
+# "#define NAME body" or "#define NAME(params) body" — one line of a -dM dump
+_MACRO_DEF_RE = re.compile(
+    r'^[ \t]*#[ \t]*define[ \t]+([A-Za-z_][A-Za-z0-9_]*)(\([^)]*\))?(?:[ \t]+(.*?))?[ \t]*$',
+    re.MULTILINE,
+)
+
+_IDENT_RE = re.compile(r'\b[A-Za-z_][A-Za-z0-9_]*\b')
+
+
+def parse_macro_dump(macro_output):
+    """
+    Parse a `-E -dM` dump into {name: (params, body)}.
+
+    params is the parameter list text including parentheses for function-like
+    macros (e.g. "(a,b)"), or None for object-like macros; body is "" for
+    macros defined without a value.
+    """
+    return {
+        m.group(1): (m.group(2), m.group(3) or "")
+        for m in _MACRO_DEF_RE.finditer(macro_output)
+    }
+
+
+# Preprocessor flags whose effect is fully captured by the -E -dM dump
+_DUMP_CAPTURED_WITH_NEXT = {
+    "-D", "-U",
+    "-I", "-isystem", "-isysroot", "-iprefix",
+    "-iwithprefix", "-iwithprefixbefore",
+    "-iquote", "-include", "-include-pch",
+}
+
+
+def extract_target_flags(flags):
+    """
+    Drop macro definitions and include-search flags from a preprocessor flags
+    list, keeping only those that also shape code generation (target triple,
+    CPU, ABI, language standard, char signedness, …).
+    """
+    target_flags = []
+    i = 0
+    while i < len(flags):
+        flag = flags[i]
+        if flag in _DUMP_CAPTURED_WITH_NEXT:
+            i += 2
+            continue
+        if any(flag.startswith(pfx) for pfx in _DUMP_CAPTURED_WITH_NEXT):
+            i += 1
+            continue
+        target_flags.append(flag)
+        i += 1
+    return target_flags
+
+
+def macro_definition_keys(macro_table, names, target=""):
+    """
+    Return {name: key} for each of *names*, where key identifies the macro's
+    full meaning: its own definition text, the definitions of every macro it
+    references (transitively) and the *target* string.  Two TUs produce the
+    same key for a macro only if the macro would expand identically.
+    """
+    digests = {}
+
+    def digest(name, active):
+        if name in digests:
+            return digests[name], False
+        params, body = macro_table[name]
+        h = hashlib.sha1(f"{name}{params or ''} {body}".encode("utf-8"))
+        cyclic = False
+        active.add(name)
+        for dep in sorted(set(_IDENT_RE.findall(body))):
+            if dep == name or dep not in macro_table:
+                continue
+            if dep in active:
+                # Self-referential chain: the name alone identifies it
+                h.update(f"|{dep}".encode("utf-8"))
+                cyclic = True
+                continue
+            dep_digest, dep_cyclic = digest(dep, active)
+            h.update(f"|{dep}={dep_digest}".encode("utf-8"))
+            cyclic = cyclic or dep_cyclic
+        active.discard(name)
+        # Digests computed through an open cycle depend on the entry point
+        if not cyclic:
+            digests[name] = h.hexdigest()
+        return h.hexdigest(), cyclic
+
+    keys = {}
+    for name in names:
+        if name in macro_table:
+            own, _ = digest(name, set())
+        else:
+            own = hashlib.sha1(name.encode("utf-8")).hexdigest()
+        keys[name] = f"{target}\0{name}\0{own}"
+    return keys
+
+
+def probe_target(clang_exec, compile_flags):
+    """Target string mixed into macro_definition_keys() for a compile."""
+    return "\0".join([clang_exec] + extract_target_flags(compile_flags))
+
+
+def probe_candidate_names(macro_table):
+    """
+    Names of the macros inject_probes() would consider probing: object-like,
+    not reserved (__NAME), and not an obvious non-expression.
+    """
+    return [
+        name for name, (params, body) in macro_table.items()
+        if params is None and not name.startswith("__")
+        and not (body and _macro_value_is_skippable(body))
+    ]
+
+
+# Keywords that make a macro body a statement fragment: no expression that
+# expands such a macro can compile
+_CONTROL_KEYWORDS = frozenset({
+    "do", "while", "for", "if", "else", "switch", "case", "default",
+    "break", "continue", "return", "goto",
+})
+
+
+# Character and string literals, whose contents are not tokens
+_QUOTED_RE = re.compile(r"""'(?:[^'\\\n]|\\.)*'|"(?:[^"\\\n]|\\.)*\"""")
+
+
+def _is_statement_fragment(value):
+    """True if a macro body can never appear inside an expression."""
+    v = value.strip()
+    if not v or v.startswith('"'):
+        return False
+    if v.startswith(('{', '}', '#')) or ';' in _QUOTED_RE.sub("''", v):
+        return True
+    first_token_m = re.match(r'([A-Za-z_][A-Za-z0-9_]*)', v)
+    return bool(first_token_m) and first_token_m.group(1) in _CONTROL_KEYWORDS
+
+
+def macro_dependency_graph(macro_table):
+    """
+    Return {name: set of macro names its body references directly}, for
+    every macro of a parse_macro_dump() table.  Parameters of function-like
+    macros are not dependencies even if a macro of the same name exists.
+    """
+    graph = {}
+    for name, (params, body) in macro_table.items():
+        shadowed = set(_IDENT_RE.findall(params)) if params else set()
+        shadowed.add(name)
+        graph[name] = {dep for dep in _IDENT_RE.findall(body)
+                       if dep in macro_table and dep not in shadowed}
+    return graph
+
+
+def macro_dependents(graph):
+    """Invert a dependency graph: {name: set of macros that reference it}."""
+    dependents = {}
+    for name, deps in graph.items():
+        for dep in deps:
+            dependents.setdefault(dep, set()).add(name)
+    return dependents
+
+
+def propagate_unevaluable(dependents, unevaluable):
+    """Return *unevaluable* plus every macro that transitively references one."""
+    result = set(unevaluable)
+    stack = list(unevaluable)
+    while stack:
+        for user in dependents.get(stack.pop(), ()):
+            if user not in result:
+                result.add(user)
+                stack.append(user)
+    return result
+
+
+def dependency_order(names, graph):
+    """
+    Order *names* so every macro follows the macros it (transitively)
+    references; otherwise keep the input order.  Cycles are broken arbitrarily.
+    """
+    wanted = set(names)
+    order = []
+    visited = set()
+    for root in names:
+        if root in visited:
+            continue
+        visited.add(root)
+        stack = [(root, iter(sorted(graph.get(root, ()))))]
+        while stack:
+            node, deps = stack[-1]
+            dep = next(deps, None)
+            if dep is None:
+                stack.pop()
+                if node in wanted:
+                    order.append(node)
+            elif dep not in visited:
+                visited.add(dep)
+                stack.append((dep, iter(sorted(graph.get(dep, ())))))
+    return order
+
+
+# ---------------------------------------------------------------------------
+# Constant-expression fast path
+# ---------------------------------------------------------------------------
+#
+# Most object-like macros are plain literals or integer arithmetic on other
+# macros.  ConstantFolder evaluates those in Python with C semantics for the
+# target's data model, so only the macros it cannot fold are compiled.
+
+class DataModel(NamedTuple):
+    """Sizes (in bytes) of the target's basic types that vary across ABIs."""
+    name: str
+    long: int
+    pointer: int
+    long_double: int
+    char_signed: bool
+
+
+_DATA_MODELS = {
+    "ILP32": DataModel("ILP32", long=4, pointer=4, long_double=8, char_signed=True),
+    "LP64": DataModel("LP64", long=8, pointer=8, long_double=16, char_signed=True),
+    "LLP64": DataModel("LLP64", long=4, pointer=8, long_double=8, char_signed=True),
+}
+
+_ARCH_64 = frozenset({
+    "x86_64", "amd64", "aarch64", "aarch64_be", "arm64", "arm64e", "arm64ec",
+    "riscv64", "ppc64", "ppc64le", "powerpc64", "powerpc64le",
+    "mips64", "mips64el", "s390x", "sparcv9", "sparc64", "loongarch64", "wasm64",
+})
+# Architectures whose ABI makes plain `char` unsigned (outside Apple/Windows)
+_ARCH_UNSIGNED_CHAR_PREFIXES = ("arm", "thumb", "aarch64", "ppc", "powerpc", "riscv", "s390")
+
+
+def select_data_model(flags, macro_table=None):
+    """
+    Pick the data model for a preprocessor flags list (see
+    core._extract_preprocessor_flags): the --target / -target triple first,
+    adjusted by -m32 / -m64 / -mabi=ilp32 and -f(un)signed-char, falling back
+    to the host.  When a `-E -dM` macro table is given, the compiler's own
+    __SIZEOF_*__ / __CHAR_UNSIGNED__ predefines take precedence.
+    """
+    triple = ""
+    for i, flag in enumerate(flags):
+        if flag in ("-target", "--target") and i + 1 < len(flags):
+            triple = flags[i + 1]
+        elif flag.startswith(("--target=", "-target=")):
+            triple = flag.split("=", 1)[1]
+    triple = triple.lower()
+    if triple:
+        arch = triple.split("-", 1)[0]
+    else:
+        arch = platform.machine().lower() or "x86_64"
+        triple = arch + ("-windows" if sys.platform == "win32" else "")
+
+    if "-m32" in flags:
+        arch = {"x86_64": "i686", "amd64": "i686", "ppc64": "ppc", "mips64": "mips"}.get(arch, arch)
+    elif "-m64" in flags:
+        arch = {"i386": "x86_64", "i486": "x86_64", "i586": "x86_64",
+                "i686": "x86_64", "ppc": "ppc64", "mips": "mips64"}.get(arch, arch)
+
+    windows = any(os_tag in triple for os_tag in ("windows", "win32", "mingw", "msvc"))
+    apple = any(os_tag in triple for os_tag in ("apple", "darwin", "macos", "ios"))
+    ilp32_abi = "gnux32" in triple or "ilp32" in triple or "-mabi=ilp32" in flags
+
+    if arch in _ARCH_64 and not ilp32_abi:
+        model = _DATA_MODELS["LLP64" if windows else "LP64"]
+    else:
+        model = _DATA_MODELS["ILP32"]
+
+    long_double = model.long_double
+    if windows or (apple and arch.startswith(("aarch64", "arm64"))):
+        long_double = 8
+    elif arch in ("i386", "i486", "i586", "i686"):
+        long_double = 12
+    elif model.name == "ILP32" and not arch.startswith(("i", "x86")):
+        long_double = 8
+
+    char_signed = not (arch.startswith(_ARCH_UNSIGNED_CHAR_PREFIXES) and not (windows or apple))
+    if "-funsigned-char" in flags or "-fno-signed-char" in flags:
+        char_signed = False
+    elif "-fsigned-char" in flags or "-fno-unsigned-char" in flags:
+        char_signed = True
+
+    model = model._replace(long_double=long_double, char_signed=char_signed)
+
+    # GCC-compatible compilers describe their own data model in the dump
+    if macro_table and "__SIZEOF_INT__" in macro_table:
+        def predefined(name, default):
+            body = macro_table.get(name, (None, ""))[1]
+            return int(body) if body.isdigit() else default
+        model = model._replace(
+            long=predefined("__SIZEOF_LONG__", model.long),
+            pointer=predefined("__SIZEOF_POINTER__", model.pointer),
+            long_double=predefined("__SIZEOF_LONG_DOUBLE__", model.long_double),
+            char_signed="__CHAR_UNSIGNED__" not in macro_table,
+        )
+    return model
+
+
+class _Unfoldable(Exception):
+    """The expression needs the compiler (unknown identifier, float, UB, …)."""
+
+
+_CTOKEN_RE = re.compile(r"""
+      (?P<ws>\s+)
+    | (?P<num>\.?[0-9](?:[eEpP][+-]|[A-Za-z0-9_.'])*)
+    | (?P<chr>(?:L|u8|u|U)?'(?:[^'\\\n]|\\.)*')
+    | (?P<str>(?:L|u8|u|U|R)?"(?:[^"\\\n]|\\.)*")
+    | (?P<id>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<op><<=|>>=|\.\.\.|->|\+\+|--|<<|>>|<=|>=|==|!=|&&|\|\||\#\#|[-+*/%&|^~!<>?:,()\[\]{}.;=\#])
+""", re.VERBOSE)
+
+_INT_LITERAL_RE = re.compile(r'^(0[xX][0-9a-fA-F]+|0[bB][01]+|[0-9]+)([uUlL]*)$')
+
+# Integer types after promotion: (rank, unsigned)
+_INT, _UINT = (1, False), (1, True)
+_LONG, _ULONG = (2, False), (2, True)
+_LLONG, _ULLONG = (3, False), (3, True)
+
+# Candidate types of an integer literal, by (suffix, is_decimal) — C11 6.4.4.1
+_LITERAL_TYPES = {
+    ("", True): (_INT, _LONG, _LLONG),
+    ("", False): (_INT, _UINT, _LONG, _ULONG, _LLONG, _ULLONG),
+    ("u", True): (_UINT, _ULONG, _ULLONG),
+    ("u", False): (_UINT, _ULONG, _ULLONG),
+    ("l", True): (_LONG, _LLONG),
+    ("l", False): (_LONG, _ULONG, _LLONG, _ULLONG),
+    ("ul", True): (_ULONG, _ULLONG),
+    ("ul", False): (_ULONG, _ULLONG),
+    ("ll", True): (_LLONG,),
+    ("ll", False): (_LLONG, _ULLONG),
+    ("ull", True): (_ULLONG,),
+    ("ull", False): (_ULLONG,),
+}
+
+_SIMPLE_ESCAPES = {
+    "n": 10, "t": 9, "r": 13, "0": 0, "a": 7, "b": 8, "f": 12, "v": 11,
+    "\\": 92, "'": 39, '"': 34, "?": 63,
+}
+
+_TYPE_SPECIFIERS = frozenset({
+    "signed", "unsigned", "char", "short", "int", "long",
+    "_Bool", "bool", "float", "double", "void",
+})
+_TYPE_QUALIFIERS = frozenset({"const", "volatile"})
+
+# <stdint.h> / <stddef.h> typedefs, as basic type names per data model
+_TYPEDEF_NAMES = {
+    "int8_t": "signed char", "uint8_t": "unsigned char",
+    "int16_t": "short", "uint16_t": "unsigned short",
+    "int32_t": "int", "uint32_t": "unsigned int",
+    "int64_t": "int64", "uint64_t": "unsigned int64",
+    "intmax_t": "int64", "uintmax_t": "unsigned int64",
+    "intptr_t": "intptr", "uintptr_t": "unsigned intptr",
+    "ptrdiff_t": "intptr", "size_t": "unsigned intptr",
+}
+
+
+class _ConstExprFolder:
+    """
+    Recursive-descent evaluator for C integer constant expressions over a
+    token list that has already been macro-expanded.
+
+    Values are (int, (rank, unsigned)) pairs; every operator applies the C
+    integer promotions and usual arithmetic conversions of the data model.
+    Signed overflow, division by zero and out-of-range shifts raise
+    _Unfoldable — the compiler gets the final say on those.  Operands that
+    C leaves unevaluated (the untaken ?: branch, the right side of a
+    short-circuited && / ||) are type-checked but may not trap.
+    """
+
+    def __init__(self, tokens, model: DataModel):
+        self.tokens = tokens
+        self.pos = 0
+        self.model = model
+
+    # ── type helpers ───────────────────────────────────────────────────────
+
+    def _bits(self, t):
+        rank, _ = t
+        return 8 * (4 if rank == 1 else self.model.long if rank == 2 else 8)
+
+    def _wrap(self, value, t):
+        """Convert an exact integer to type t (two's complement)."""
+        bits = self._bits(t)
+        value &= (1 << bits) - 1
+        if not t[1] and value >= 1 << (bits - 1):
+            value -= 1 << bits
+        return value
+
+    def _signed_result(self, value, t, live):
+        """Result of a signed operation: must be representable (no UB)."""
+        if t[1]:
+            return self._wrap(value, t)
+        bits = self._bits(t)
+        if live and not -(1 << (bits - 1)) <= value < 1 << (bits - 1):
+            raise _Unfoldable("signed overflow")
+        return self._wrap(value, t)
+
+    def _common(self, a, b):
+        """Usual arithmetic conversions on two promoted integer types."""
+        if a[1] == b[1]:
+            return a if a[0] >= b[0] else b
+        u, s = (a, b) if a[1] else (b, a)
+        if u[0] >= s[0]:
+            return u
+        if self._bits(s) > self._bits(u):
+            return s
+        return (s[0], True)
+
+    def _basic_type(self, name):
+        """(size_bytes, cast) for a basic type name; cast maps an int to (value, type)."""
+        model = self.model
+        if name.endswith("int64"):
+            name = name.replace("int64", "long" if model.long == 8 else "long long")
+        if name.endswith("intptr"):
+            name = name.replace("intptr", "long" if model.long == model.pointer else "long long")
+        if name.startswith("unsigned int ") or name == "unsigned int":
+            name = "unsigned" + name[len("unsigned int"):]
+        if name == "char":
+            name = "signed char" if model.char_signed else "unsigned char"
+
+        small = {"_Bool": (1, None), "signed char": (1, False), "unsigned char": (1, True),
+                 "short": (2, False), "unsigned short": (2, True)}
+        if name in small:
+            size, unsigned = small[name]
+
+            def cast(v, size=size, unsigned=unsigned):
+                if unsigned is None:
+                    return int(v != 0), _INT
+                bits = 8 * size
+                v &= (1 << bits) - 1
+                if not unsigned and v >= 1 << (bits - 1):
+                    v -= 1 << bits
+                return v, _INT
+            return size, cast
+
+        full = {"int": _INT, "unsigned": _UINT, "long": _LONG, "unsigned long": _ULONG,
+                "long long": _LLONG, "unsigned long long": _ULLONG}
+        if name in full:
+            t = full[name]
+            return self._bits(t) // 8, lambda v, t=t: (self._wrap(v, t), t)
+
+        floats = {"float": 4, "double": 8, "long double": model.long_double}
+        if name in floats:
+            return floats[name], None
+        raise _Unfoldable(f"type {name}")
+
+    # ── token helpers ──────────────────────────────────────────────────────
+
+    def _peek(self, offset=0):
+        i = self.pos + offset
+        return self.tokens[i] if i < len(self.tokens) else (None, None)
+
+    def _take(self, text=None):
+        kind, tok = self._peek()
+        if kind is None or (text is not None and tok != text):
+            raise _Unfoldable(f"expected {text!r}")
+        self.pos += 1
+        return kind, tok
+
+    def _at(self, text):
+        return self._peek()[1] == text and self._peek()[0] == "op"
+
+    def _starts_type_name(self, offset=0):
+        kind, tok = self._peek(offset)
+        return kind == "id" and (tok in _TYPE_SPECIFIERS or tok in _TYPE_QUALIFIERS
+                                 or tok in _TYPEDEF_NAMES)
+
+    # ── grammar ────────────────────────────────────────────────────────────
+
+    def fold(self):
+        value, t = self._comma(True)
+        if self.pos != len(self.tokens):
+            raise _Unfoldable("trailing tokens")
+        return value, t
+
+    def _comma(self, live):
+        value, t = self._conditional(live)
+        while self._at(","):
+            self._take()
+            value, t = self._conditional(live)
+        return value, t
+
+    def _conditional(self, live):
+        cond, t = self._binary(0, live)
+        if not self._at("?"):
+            return cond, t
+        self._take()
+        a, ta = self._comma(live and cond != 0)
+        self._take(":")
+        b, tb = self._conditional(live and cond == 0)
+        t = self._common(ta, tb)
+        return self._wrap(a if cond else b, t), t
+
+    # (operators, precedence) from loosest to tightest
+    _BINARY_LEVELS = (
+        ("||",), ("&&",), ("|",), ("^",), ("&",),
+        ("==", "!="), ("<", ">", "<=", ">="), ("<<", ">>"), ("+", "-"), ("*", "/", "%"),
+    )
+
+    def _binary(self, level, live):
+        if level == len(self._BINARY_LEVELS):
+            return self._unary(live)
+        ops = self._BINARY_LEVELS[level]
+        a, ta = self._binary(level + 1, live)
+        while self._peek()[0] == "op" and self._peek()[1] in ops:
+            _, op = self._take()
+            if op == "&&":
+                b, _ = self._binary(level + 1, live and a != 0)
+                a, ta = int(a != 0 and b != 0), _INT
+            elif op == "||":
+                b, _ = self._binary(level + 1, live and a == 0)
+                a, ta = int(a != 0 or b != 0), _INT
+            else:
+                b, tb = self._binary(level + 1, live)
+                a, ta = self._apply(op, a, ta, b, tb, live)
+        return a, ta
+
+    def _apply(self, op, a, ta, b, tb, live):
+        if op in ("<<", ">>"):
+            bits = self._bits(ta)
+            if b < 0 or b >= bits:
+                if live:
+                    raise _Unfoldable("shift count out of range")
+                return 0, ta
+            if op == ">>":
+                return a >> b, ta
+            if not ta[1] and a < 0 and live:
+                raise _Unfoldable("left shift of negative value")
+            return self._signed_result(a << b, ta, live), ta
+
+        t = self._common(ta, tb)
+        a, b = self._wrap(a, t), self._wrap(b, t)
+        if op in ("==", "!=", "<", ">", "<=", ">="):
+            return int({"==": a == b, "!=": a != b, "<": a < b,
+                        ">": a > b, "<=": a <= b, ">=": a >= b}[op]), _INT
+        if op == "&":
+            return self._wrap(a & b, t), t
+        if op == "|":
+            return self._wrap(a | b, t), t
+        if op == "^":
+            return self._wrap(a ^ b, t), t
+        if op == "+":
+            return self._signed_result(a + b, t, live), t
+        if op == "-":
+            return self._signed_result(a - b, t, live), t
+        if op == "*":
+            return self._signed_result(a * b, t, live), t
+        # "/" and "%": C truncates toward zero
+        if b == 0:
+            if live:
+                raise _Unfoldable("division by zero")
+            return 0, t
+        q = abs(a) // abs(b)
+        if (a < 0) != (b < 0):
+            q = -q
+        if op == "/":
+            return self._signed_result(q, t, live), t
+        self._signed_result(q, t, live)  # INT_MIN % -1 is UB too
+        return self._wrap(a - b * q, t), t
+
+    def _unary(self, live):
+        kind, tok = self._peek()
+        if kind == "op" and tok in ("+", "-", "~", "!"):
+            self._take()
+            v, t = self._unary(live)
+            if tok == "+":
+                return v, t
+            if tok == "-":
+                return self._signed_result(-v, t, live), t
+            if tok == "~":
+                return self._wrap(~v, t), t
+            return int(v == 0), _INT
+        if kind == "id" and tok == "sizeof":
+            self._take()
+            return self._sizeof(live)
+        if kind == "op" and tok == "(" and self._starts_type_name(1):
+            self._take()
+            size, cast = self._type_name()
+            self._take(")")
+            v, _ = self._unary(live)
+            if cast is None:
+                raise _Unfoldable("cast to non-integer type")
+            return cast(v)
+        return self._primary(live)
+
+    def _sizeof(self, live):
+        size_t = _ULONG if self.model.long == self.model.pointer else _ULLONG
+        if not (self._at("(") and self._starts_type_name(1)):
+            # sizeof expression: operand types differ between C and C++
+            # (e.g. sizeof 'a'), so leave it to the compiler
+            raise _Unfoldable("sizeof expression")
+        self._take()
+        size, _ = self._type_name()
+        self._take(")")
+        return size, size_t
+
+    def _type_name(self):
+        """Parse a type-name; returns (size_bytes, cast_or_None)."""
+        words = []
+        while self._starts_type_name():
+            _, tok = self._take()
+            if tok not in _TYPE_QUALIFIERS:
+                words.append("_Bool" if tok == "bool" else tok)
+
+        typedefs = [w for w in words if w in _TYPEDEF_NAMES]
+        unsigned = "unsigned" in words
+        longs = words.count("long")
+        base = {w for w in words if w not in ("signed", "unsigned", "long", "int")}
+        if typedefs:
+            if len(words) != 1:
+                raise _Unfoldable("specifiers combined with a typedef")
+            name = _TYPEDEF_NAMES[typedefs[0]]
+        elif len(base) > 1 or longs > 2:
+            raise _Unfoldable("conflicting type specifiers")
+        elif base:
+            (name,) = base
+            if name == "double" and longs == 1:
+                name = "long double"
+            elif longs:
+                raise _Unfoldable("conflicting type specifiers")
+            elif name in ("char", "short") and unsigned:
+                name = "unsigned " + name
+            elif name == "char" and "signed" in words:
+                name = "signed char"
+            elif name == "void":
+                raise _Unfoldable("void type")
+        else:
+            name = ("unsigned " if unsigned else "") + ("int", "long", "long long")[longs]
+        size, cast = self._basic_type(name)
+
+        # Abstract declarator: pointers and array bounds
+        if self._at("*"):
+            while self._at("*") or (self._peek()[0] == "id" and self._peek()[1] in _TYPE_QUALIFIERS):
+                self._take()
+            size, cast = self.model.pointer, None
+        while self._at("["):
+            self._take()
+            count, _ = self._conditional(True)
+            self._take("]")
+            if count < 0:
+                raise _Unfoldable("negative array bound")
+            size, cast = size * count, None
+        return size, cast
+
+    def _primary(self, live):
+        kind, tok = self._take()
+        if kind == "op" and tok == "(":
+            v, t = self._comma(live)
+            self._take(")")
+            return v, t
+        if kind == "num":
+            return self._int_literal(tok)
+        if kind == "chr":
+            return self._char_literal(tok)
+        if kind == "id" and tok in ("true", "false"):
+            return int(tok == "true"), _INT
+        raise _Unfoldable(f"unexpected token {tok!r}")
+
+    def _int_literal(self, text):
+        m = _INT_LITERAL_RE.match(text.replace("'", ""))
+        if not m:
+            raise _Unfoldable(f"not an integer literal: {text}")
+        digits, suffix = m.group(1), m.group(2).lower()
+        if suffix not in ("", "u", "l", "ul", "lu", "ll", "ull", "llu"):
+            raise _Unfoldable(f"bad suffix: {text}")
+        suffix = "".join(sorted(suffix, reverse=True))  # "lu" → "ul", "llu" → "ull"
+        if digits[:2].lower() == "0x":
+            value, decimal = int(digits[2:], 16), False
+        elif digits[:2].lower() == "0b":
+            value, decimal = int(digits[2:], 2), False
+        elif len(digits) > 1 and digits[0] == "0":
+            if any(c in "89" for c in digits):
+                raise _Unfoldable(f"bad octal literal: {text}")
+            value, decimal = int(digits, 8), False
+        else:
+            value, decimal = int(digits), True
+        for t in _LITERAL_TYPES[(suffix, decimal)]:
+            bits = self._bits(t)
+            if value < (1 << bits if t[1] else 1 << (bits - 1)):
+                return value, t
+        raise _Unfoldable(f"literal too large: {text}")
+
+    def _char_literal(self, text):
+        if not text.startswith("'"):
+            raise _Unfoldable("prefixed character literal")
+        body = text[1:-1]
+        if body.startswith("\\"):
+            esc = body[1:]
+            if esc in _SIMPLE_ESCAPES:
+                code = _SIMPLE_ESCAPES[esc]
+            elif esc[:1] == "x" and len(esc) > 1 and all(c in "0123456789abcdefABCDEF" for c in esc[1:]):
+                code = int(esc[1:], 16)
+            elif 0 < len(esc) <= 3 and all(c in "01234567" for c in esc):
+                code = int(esc, 8)
+            else:
+                raise _Unfoldable(f"bad escape: {text}")
+        elif len(body) == 1 and ord(body) < 128:
+            code = ord(body)
+        else:
+            raise _Unfoldable(f"multi-character literal: {text}")
+        if code > 0xFF:
+            raise _Unfoldable(f"escape out of range: {text}")
+        if self.model.char_signed and code >= 0x80:
+            code -= 0x100
+        return code, _INT
+
+
+def _tokenize_c(text):
+    """Split C source text into (kind, text) tokens; whitespace is dropped."""
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        m = _CTOKEN_RE.match(text, pos)
+        if not m:
+            raise _Unfoldable(f"cannot tokenize {text[pos:pos + 10]!r}")
+        pos = m.end()
+        if m.lastgroup != "ws":
+            tokens.append((m.lastgroup, m.group()))
+    return tokens
+
+
+_MAX_EXPANDED_TOKENS = 4096
+
+
+class ConstantFolder:
+    """
+    Fold object-like macros of one `-E -dM` macro table to integers.
+
+    fold(name) returns the value `(long long)(name)` would have, or None when
+    the expansion is not a plain integer constant expression (function-like
+    macros, unknown identifiers such as enumerators or variables, floats,
+    strings, casts to pointers, undefined behaviour, …).  None means "ask the
+    compiler", not "not evaluable".
+    """
+
+    def __init__(self, macro_table, model: DataModel):
+        self.macro_table = macro_table
+        self.model = model
+        self._expanded = {}  # name → token list, or None if not foldable
+
+    def fold(self, name):
+        if name not in self.macro_table:
+            return None
+        params, body = self.macro_table[name]
+        if params is not None:
+            return None
+        if not body.strip():
+            return 1  # matches PROBE_TEMPLATE_EMPTY
+        try:
+            tokens = self._expand(name, set())
+            value, _ = _ConstExprFolder(tokens, self.model).fold()
+        except (_Unfoldable, RecursionError):
+            return None
+        # (long long)(value): two's complement wrap to 64 bits
+        value &= (1 << 64) - 1
+        return value - (1 << 64) if value >= 1 << 63 else value
+
+    def _expand(self, name, active):
+        """
+        Fully expand object-like macro *name* into tokens.
+
+        A successful expansion never depends on the enclosing expansion (a
+        macro reached again while it is being expanded is left unexpanded and
+        is then an unknown identifier), so results are cached per name.
+        """
+        if name in self._expanded:
+            cached = self._expanded[name]
+            if cached is None:
+                raise _Unfoldable(f"{name} is not foldable")
+            return cached
+        if name in active:
+            raise _Unfoldable(f"recursive macro {name}")
+
+        active.add(name)
+        out = []
+        try:
+            for kind, tok in _tokenize_c(self.macro_table[name][1]):
+                if kind == "id" and tok in self.macro_table:
+                    if self.macro_table[tok][0] is not None:
+                        raise _Unfoldable(f"function-like macro {tok}")
+                    out.extend(self._expand(tok, active))
+                elif kind == "id" and not (tok in ("sizeof", "true", "false")
+                                           or tok in _TYPE_SPECIFIERS
+                                           or tok in _TYPE_QUALIFIERS
+                                           or tok in _TYPEDEF_NAMES):
+                    raise _Unfoldable(f"unknown identifier {tok}")
+                elif kind == "str" or (kind == "op" and tok in ("#", "##", "{", "}", ";", "=")):
+                    raise _Unfoldable(f"not an expression: {tok}")
+                else:
+                    out.append((kind, tok))
+                if len(out) > _MAX_EXPANDED_TOKENS:
+                    raise _Unfoldable("expansion too large")
+        except _Unfoldable:
+            self._expanded[name] = None
+            raise
+        finally:
+            active.discard(name)
+        self._expanded[name] = out
+        return out
+
+
+def line_directive(path: str) -> str:
+    """`#line 1 "<path>"` line attributing what follows to *path*."""
+    escaped = path.replace("\\", "/").replace('"', '\\"')
+    return f'#line 1 "{escaped}"\n'
+
+
 def inject_probes(source_path, target_path=None, compile_flags=None, known_macros=None,
-                  clang_exec="clang", cmdline_macros=None):
+                  clang_exec="clang", cmdline_macros=None, header_only=False,
+                  macro_output=None, memo=None, claims=None,
+                  resolved=None, fold=False, fold_verify_rate=0.0, macro_table=None,
+                  only_names=None, line_origin=None):
     """
     Run the compiler preprocessor (-E -dM) to discover all macros, then write
     a probe .c file with one PROBE_xxx global variable per macro.
 
+    By default the probes are appended to the full original source.  With
+    header_only=True the probe TU instead contains only the #define lines of
+    the `-E -dM` dump followed by the probes, so the probe compile skips the
+    include search, the original function bodies and their codegen.  Macros
+    that depend on types or enumerators declared in the source (e.g.
+    `sizeof(struct foo)`) cannot be evaluated in that mode and come back None.
+
+    If the caller already ran run_preprocessor(), pass its dump as
+    macro_output to skip the second preprocessor run.
+
+    If a MacroMemo is given it replaces the name-based known_macros check: a
+    macro is skipped only when the same definition (see
+    macro_definition_keys) was already evaluated or is being evaluated by
+    another worker.  Every macro this call claims in the memo is recorded in
+    the *claims* dict as {name: key}; the caller must resolve or release them.
+
+    Values decided without compiling are stored in the *resolved* dict:
+      - None for macros that reference (transitively, through the
+        macro_dependency_graph) a statement-fragment macro or a definition
+        the memo recorded as failing to compile
+      - with fold=True, the value of every macro whose expansion is a plain
+        integer constant expression, evaluated in Python (ConstantFolder,
+        using the data model selected from compile_flags).  A random
+        fraction fold_verify_rate of those is probed anyway so the caller
+        can cross-check both values.
+    The remaining probes are written in dependency order (a macro after the
+    macros it references).  Pass macro_table if the caller already parsed
+    macro_output with parse_macro_dump().
+
+    only_names restricts probing to the given macro names (the share of the
+    global probe plan assigned to this TU).
+
+    If the probe file is written away from the source, pass the source path
+    as line_origin: the copied source is then preceded by a
+    `#line 1 "<line_origin>"` directive, so __FILE__ and diagnostics name
+    the original file and line (the probe file's lines are shifted by one).
+
     Macros are skipped if:
+      - They are not in only_names (when given)
       - They are double-underscore built-in macros (__FOO__)
-      - They are already in known_macros
+      - They are already in known_macros / memo
+      - They were decided into *resolved*
       - Their value is a non-expression fragment (statement keywords, string literals, etc.)
       - They are function-like macros (with parameter list — filtered by the define regex)
     """
     if target_path is None:
         target_path = source_path + ".probe.c"
+    final_code, injected_names = build_probe_source(
+        source_path, compile_flags, known_macros, clang_exec, cmdline_macros, header_only,
+        macro_output, memo, claims, resolved, fold, fold_verify_rate, macro_table,
+        only_names, line_origin,
+    )
+
+    with open(target_path, 'w', encoding='utf-8') as f:
+        f.write(final_code)
+
+    return target_path, injected_names
+
+
+def build_probe_source(source_path, compile_flags=None, known_macros=None,
+                       clang_exec="clang", cmdline_macros=None, header_only=False,
+                       macro_output=None, memo=None, claims=None,
+                       resolved=None, fold=False, fold_verify_rate=0.0, macro_table=None,
+                       only_names=None, line_origin=None):
+    """
+    The probe TU of inject_probes() (same parameters, same filtering), built
+    in memory: returns (probe_source_text, injected_names) without writing
+    a file.
+    """
     if compile_flags is None:
         compile_flags = []
     if known_macros is None:
         known_macros = {}
     if cmdline_macros is None:
         cmdline_macros = {}
+    if resolved is None:
+        resolved = {}
 
-    # Read original source code
-    with open(source_path, 'r', encoding='utf-8') as f:
-        original_code = f.read()
-
-    # Run compiler -E -dM to discover all macros (including those from headers).
-    # This is the authoritative source — it reflects the exact macro environment
-    # that the compile command would set up.
-    cmd = [clang_exec, "-E", "-dM"] + compile_flags + [source_path]
-    logging.getLogger("macro_extractor").info(f"Running Preprocessor: {' '.join(cmd)}")
-
-    try:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        macro_output = result.stdout
-    except subprocess.CalledProcessError as e:
-        logging.getLogger("macro_extractor").error(f"Error running preprocessor: {e.stderr}")
-        macro_output = e.stdout if e.stdout else ""
+    if macro_output is None:
+        macro_output = run_preprocessor(source_path, compile_flags, clang_exec)
 
     # Match "#define NAME [value]" — note NO parenthesis after NAME so function-like
     # macros (NAME(x)) are excluded because -E -dM emits them as "NAME(x) body".
@@ -138,44 +1081,109 @@ def inject_probes(source_path, target_path=None, compile_flags=None, known_macro
             macro_pairs.append((name, str(value) if value != 1 else None))
             seen_names.add(name)
 
-    probes = []
-    injected_names = []  # names actually written, in order, after all filtering
+    # First pass: drop macros that cannot (or need not) be probed
+    candidates = []
     for macro_name, macro_value in macro_pairs:
         # Skip internal compiler macros
         if macro_name.startswith("__"):
             continue
 
+        # Skip macros the global plan assigned to another TU
+        if only_names is not None and macro_name not in only_names:
+            continue
+
         # Skip already-known macros (avoid re-processing across source files)
-        if macro_name in known_macros:
+        if memo is None and macro_name in known_macros:
             continue
 
         # Normalise the macro value
         value_str = macro_value.strip() if macro_value else ""
 
-        if not value_str:
-            # Include guard / flag macro with no value → trivially 1
-            probes.append(PROBE_TEMPLATE_EMPTY.format(name=macro_name))
-            injected_names.append(macro_name)
-            continue
-
         # Skip values that cannot be cast to long long at compile time
-        if _macro_value_is_skippable(value_str):
+        if value_str and _macro_value_is_skippable(value_str):
             continue
 
-        # Use the __builtin_constant_p guard for everything else.
-        probes.append(PROBE_TEMPLATE_MAYBE.format(name=macro_name))
-        injected_names.append(macro_name)
+        candidates.append((macro_name, value_str))
 
-    final_code = original_code + "\n\n/* --- MACRO PROBES --- */\n" + "".join(probes)
+    if macro_table is None:
+        macro_table = parse_macro_dump(macro_output)
+    for name, value in cmdline_macros.items():
+        macro_table.setdefault(name, (None, str(value)))
+    graph = macro_dependency_graph(macro_table)
+    target = probe_target(clang_exec, compile_flags)
 
-    with open(target_path, 'w', encoding='utf-8') as f:
-        f.write(final_code)
+    # Failure propagation: anything expanding a statement fragment cannot
+    # compile.  Other compile failures are left to the compiler to attribute
+    unevaluable = {name for name, (_, body) in macro_table.items() if _is_statement_fragment(body)}
+    unevaluable = propagate_unevaluable(macro_dependents(graph), unevaluable)
+    remaining = []
+    for macro_name, value_str in candidates:
+        if macro_name in unevaluable:
+            resolved[macro_name] = None
+        else:
+            remaining.append((macro_name, value_str))
+    if len(remaining) != len(candidates):
+        logging.getLogger("macro_extractor").info(
+            f"Marked {len(candidates) - len(remaining)} macros None via unevaluable dependencies"
+        )
+    candidates = remaining
 
-    return target_path, injected_names
+    # Fast path: fold plain integer constant expressions without the compiler
+    if fold:
+        folder = ConstantFolder(macro_table, select_data_model(compile_flags, macro_table))
+        unfolded = []
+        for macro_name, value_str in candidates:
+            value = folder.fold(macro_name)
+            if value is None:
+                unfolded.append((macro_name, value_str))
+                continue
+            resolved[macro_name] = value
+            if fold_verify_rate and random.random() < fold_verify_rate:
+                unfolded.append((macro_name, value_str))  # sampled for cross-check
+        logging.getLogger("macro_extractor").info(
+            f"Folded {len(candidates) - len(unfolded)}/{len(candidates)} macros without compiling"
+        )
+        candidates = unfolded
+
+    # Claim each remaining definition in the shared memo; skip the ones that
+    # were already evaluated or are being evaluated by another worker
+    if memo is not None:
+        keys = macro_definition_keys(macro_table, [name for name, _ in candidates], target)
+        claimed = []
+        for macro_name, value_str in candidates:
+            if memo.claim(keys[macro_name]):
+                if claims is not None:
+                    claims[macro_name] = keys[macro_name]
+                claimed.append((macro_name, value_str))
+        candidates = claimed
+
+    # Dependencies first, so one compile surfaces every remaining failure
+    values = dict(candidates)
+    candidates = [(name, values[name]) for name in dependency_order(list(values), graph)]
+
+    probes = []
+    injected_names = []  # names actually written, in order, after all filtering
+    for macro_name, value_str in candidates:
+        if not value_str:
+            # Include guard / flag macro with no value → trivially 1
+            probes.append(PROBE_TEMPLATE_EMPTY.format(name=macro_name))
+        else:
+            # Use the __builtin_constant_p guard for everything else.
+            probes.append(PROBE_TEMPLATE_MAYBE.format(name=macro_name))
+        injected_names.append(macro_name)
+
+    if header_only:
+        prelude = _header_only_prelude(macro_output)
+    else:
+        with open(source_path, 'r', encoding='utf-8') as f:
+            prelude = f.read()
+        if line_origin is not None:
+            prelude = line_directive(line_origin) + prelude
+
+    return prelude + PROBE_BANNER + "".join(probes), injected_names
 
 
 if __name__ == "__main__":
-    import sys
     if len(sys.argv) > 1:
         inject_probes(sys.argv[1])
     else:
@@ -1,16 +1,32 @@
 import os
 import argparse
+import concurrent.futures
 import json
 import logging
 import subprocess
 import sys
 import xml.etree.ElementTree as ET
 from xml.dom import minidom
-from pathlib import Path
-
-from core import process_file
-from conditional_macro_scanner import collect_conditional_macros
 
+from core import prepare_file, evaluate_prepared
+from async_pipeline import StageLimits, evaluate_files, preprocess_files
+from job_control import JobControl, job_context
+from job_costs import CostRecords, JobCost, job_key
+from scheduler import schedule
+from elf_reader import BACKENDS
+from driver_cache import DriverCache
+from probe_memo import FingerprintRegistry, MacroMemo
+from probe_planner import plan_probes, expand_results, replan_missing, required_names
+from result_cache import ResultCache, tool_versions, tu_cache_key
+from incremental import IncrementalState, state_path_for
+from pch_cache import plan_shared_pchs
+from conditional_macro_scanner import collect_conditional_macros, scan_conditional_macros
+from repo_crawler import TU_EXTENSIONS, crawl_repo
+
+# Probe rounds for definitions whose planned TU failed
+_REPLAN_ROUNDS = 3
+# Probe shards of a --probe-timeout backup
+_BACKUP_SHARDS = 8
 
 class SilenceFilter(logging.Filter):
     def filter(self, record):
@@ -53,7 +69,7 @@ def generate_compile_commands(repo_dir, build_dir):
     return compile_commands_path
 
 
-def fallback_find_c_files(repo_dir, clang_exec="clang", compile_fallback=False):
+def fallback_find_c_files(repo_dir, clang_exec="clang", compile_fallback=False, entries=None):
     assert compile_fallback, (
         "compile_commands.json missing and --compile-fallback is not enabled. "
         "Halting to avoid inaccurate extraction."
@@ -62,17 +78,19 @@ def fallback_find_c_files(repo_dir, clang_exec="clang", compile_fallback=False):
     logging.getLogger("main").warning("Falling back to naive recursive C file search.")
     logging.getLogger("main").warning("Macro extraction results may be incomplete or inaccurate!")
     commands = []
-    repo_path = Path(repo_dir)
-    for ext in ("*.c", "*.cpp", "*.cxx", "*.cc"):
-        for f in repo_path.rglob(ext):
-            if "build" not in f.parts:
-                abs_f = str(f.absolute())
-                commands.append({
-                    "file": abs_f,
-                    "directory": repo_dir,
-                    # Minimal fallback command — no -I, no -D; results will be imprecise
-                    "command": f"{clang_exec} -c {abs_f}",
-                })
+    if entries is None:
+        entries = crawl_repo(repo_dir)
+    for entry in entries:
+        # The crawler classifies extensions case-insensitively (for the
+        # conditional-macro scan); TUs are only taken with lowercase ones
+        if entry.kind != "tu" or os.path.splitext(entry.path)[1] not in TU_EXTENSIONS:
+            continue
+        commands.append({
+            "file": entry.path,
+            "directory": repo_dir,
+            # Minimal fallback command — no -I, no -D; results will be imprecise
+            "command": f"{clang_exec} -c {entry.path}",
+        })
     return commands
 
 
@@ -131,11 +149,198 @@ def main():
         help="Disable the conditional-macro filter; include ALL evaluated macros in output "
              "(by default only macros referenced in #if/#ifdef/#ifndef/#elif/etc. are kept)",
     )
+    parser.add_argument(
+        "--conditional-scope",
+        choices=["tree", "closure"],
+        default="tree",
+        help="Files scanned for the conditional-macro filter: every source file of the "
+             "repository (tree, default), or only the repository files some compile command "
+             "actually includes, taken from the preprocessor's dependency output (closure)",
+    )
+    parser.add_argument(
+        "--header-only-probes",
+        action="store_true",
+        help="Compile probes in a TU holding only the -E -dM #define lines instead of the full "
+             "source (much faster; macros that need types declared in the source become null)",
+    )
+    parser.add_argument(
+        "--no-tu-dedup",
+        dest="tu_dedup",
+        action="store_false",
+        default=True,
+        help="Probe every TU even if another TU has an identical macro environment "
+             "(same -E -dM dump and target flags)",
+    )
+    parser.add_argument(
+        "--no-constant-folding",
+        dest="constant_folding",
+        action="store_false",
+        default=True,
+        help="Compile a probe for every macro instead of evaluating plain integer "
+             "constant expressions in Python first",
+    )
+    parser.add_argument(
+        "--fold-verify-rate",
+        type=float,
+        default=0.0,
+        help="Fraction (0-1) of folded macros to compile anyway and cross-check "
+             "against the folded value (default: 0)",
+    )
+    parser.add_argument(
+        "--no-global-plan",
+        dest="global_plan",
+        action="store_false",
+        default=True,
+        help="Let every TU probe the macro definitions not yet evaluated by another TU "
+             "instead of assigning each distinct definition to one TU up front",
+    )
+    parser.add_argument(
+        "--probe-shards",
+        type=int,
+        default=4,
+        help="Split a large probe file into up to N shards compiled concurrently "
+             "(default: 4; 1 compiles each probe file in one piece)",
+    )
+    parser.add_argument(
+        "--shared-pch",
+        action="store_true",
+        help="Build a precompiled header for each leading #include sequence shared by "
+             "several TUs with the same flags, and compile probes with -include-pch",
+    )
+    parser.add_argument(
+        "--pch-dir",
+        default=None,
+        help="Directory for the shared PCH cache (default: <repo>/build/.macro_pch)",
+    )
+    parser.add_argument(
+        "--scratch-dir",
+        default=None,
+        help="Directory for the temporary probe files (default: /dev/shm if writable, "
+             "else the system temp directory)",
+    )
+    parser.add_argument(
+        "--probe-backend",
+        choices=BACKENDS,
+        default="object",
+        help="How probe values are read: 'object' (in-process ELF/COFF reader, default), "
+             "'llvm-objdump' or 'fromelf' (external dump tool), or 'llvm-ir' (compile probes "
+             "with -S -emit-llvm and read the IR text; clang only, skips codegen)",
+    )
+    parser.add_argument(
+        "--direct-cc1",
+        action="store_true",
+        help="Expand each distinct preprocessor/probe command once with `clang -###` and run "
+             "the cc1 job directly from then on, skipping the driver (clang only)",
+    )
+    parser.add_argument(
+        "--pipe-probes",
+        action="store_true",
+        help="Feed probe sources to the compiler on stdin and read the objects from its stdout "
+             "instead of writing temporary files (needs a compiler accepting -x <lang> - and -o -)",
+    )
+    parser.add_argument(
+        "--async-pipeline",
+        action="store_true",
+        help="Run the preprocess, probe-compile and read stages as an asyncio pipeline with "
+             "a concurrency limit per stage, instead of one thread pool worker per file",
+    )
+    parser.add_argument(
+        "--preprocess-jobs",
+        type=int,
+        default=None,
+        help="With --async-pipeline: concurrent preprocessor runs (default: --jobs or the CPU count)",
+    )
+    parser.add_argument(
+        "--compile-jobs",
+        type=int,
+        default=None,
+        help="With --async-pipeline: concurrent probe compiles (default: --jobs or the CPU count)",
+    )
+    parser.add_argument(
+        "--read-jobs",
+        type=int,
+        default=None,
+        help="With --async-pipeline: concurrent probe value reads (default: half the compile jobs)",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Save each file's include closure next to the output and, on the next run, "
+             "only reprocess files whose command or included files changed",
+    )
+    parser.add_argument(
+        "--no-result-cache",
+        dest="result_cache",
+        action="store_false",
+        default=True,
+        help="Do not reuse or store per-file results in the persistent result cache",
+    )
+    parser.add_argument(
+        "--no-scan-index",
+        dest="scan_index",
+        action="store_false",
+        default=True,
+        help="Rescan every source file for conditional macros instead of reusing the "
+             "per-file results of unchanged files from the scan index",
+    )
+    parser.add_argument(
+        "--no-listing-cache",
+        dest="listing_cache",
+        action="store_false",
+        default=True,
+        help="Read every directory of the repository again instead of reusing the saved "
+             "listing of directories whose modification time is unchanged",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Directory of the persistent result cache and conditional-scan index "
+             "(default: <repo>/build/.macro_cache)",
+    )
+    parser.add_argument(
+        "--cache-max-mb",
+        type=int,
+        default=256,
+        help="Size bound of the result cache in MiB; least recently used entries are "
+             "evicted beyond it (default: 256)",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=int,
+        default=None,
+        help="Memory budget in MiB: files are only started while the expected peak memory of "
+             "the running ones (measured in earlier runs) fits in it (default: no limit)",
+    )
+    parser.add_argument(
+        "--no-cost-model",
+        dest="cost_model",
+        action="store_false",
+        default=True,
+        help="Process files in compile database order instead of starting the ones that took "
+             "longest in earlier runs first, and do not record per-file costs",
+    )
+    parser.add_argument(
+        "--preprocess-timeout",
+        type=float,
+        default=None,
+        help="Seconds a file's -E -dM step may take before its compiler is killed and the "
+             "file skipped (default: no limit)",
+    )
+    parser.add_argument(
+        "--probe-timeout",
+        type=float,
+        default=None,
+        help="Seconds a file's probe compiles and retries may take: past it the file is retried "
+             f"split into {_BACKUP_SHARDS} probe shards (if --probe-shards is lower) on the next free worker, "
+             "the first attempt to finish is used, and the original is killed at twice the "
+             "timeout; a shared PCH build is killed after it (default: no limit)",
+    )
     parser.add_argument(
         "--jobs", "-j",
         type=int,
         default=None,
-        help="Number of concurrent threads to use for parsing (default: automatic based on CPU cores)",
+        help="Number of concurrent threads to use for parsing, and of conditional-macro "
+             "scanner processes (default: automatic based on CPU cores)",
     )
     parser.add_argument(
         "--file-list",
@@ -162,6 +367,39 @@ def main():
     compile_fallback = args.compile_fallback
 
     compile_commands_path = os.path.join(build_dir, "compile_commands.json")
+    cache_dir = args.cache_dir or os.path.join(build_dir, ".macro_cache")
+    scratch_root = os.path.abspath(args.scratch_dir) if args.scratch_dir else None
+    if scratch_root is not None:
+        os.makedirs(scratch_root, exist_ok=True)
+
+    # --conditional-macro filter (enabled by default): scan the tree while the
+    # compile commands load, so only conditional macros get probed.  With
+    # --conditional-scope closure the scan waits for the include closures of
+    # the preprocessing step instead.
+    # The repository is crawled at most once, for both the scan and the
+    # fallback source search
+    scan_index_path = os.path.join(cache_dir, "conditional_scan.sqlite") if args.scan_index else None
+    listing_path = os.path.join(cache_dir, "repo_listing.json") if args.listing_cache else None
+    scan_closure = args.conditional_macro and args.conditional_scope == "closure"
+    scan_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    crawl_future = None
+    scan_future = None
+    if args.conditional_macro and not scan_closure:
+        logging.getLogger("conditional-macro").info("Scanning source files for conditional-compilation macros...")
+        crawl_future = scan_pool.submit(crawl_repo, repo_dir, listing_path)
+        scan_future = scan_pool.submit(lambda: collect_conditional_macros(
+            repo_dir, args.jobs, scan_index_path, crawl_future.result()))
+    scan_pool.shutdown(wait=False)
+
+    def repo_entries():
+        """The repository's source files (crawled here if the scan did not)."""
+        if crawl_future is None:
+            return crawl_repo(repo_dir, listing_path)
+        return crawl_future.result()
+
+    def conditional_names():
+        """The scanner's name set (None if the filter is disabled)."""
+        return scan_future.result() if scan_future is not None else None
 
     logging.getLogger("Bar").info("Init Cmd List")
     if not os.path.exists(compile_commands_path):
@@ -177,7 +415,7 @@ def main():
 
     commands = []
     if not os.path.exists(compile_commands_path):
-        commands = fallback_find_c_files(repo_dir, clang_exec, compile_fallback)
+        commands = fallback_find_c_files(repo_dir, clang_exec, compile_fallback, repo_entries())
     else:
         logging.getLogger("main").info(f"Reading compile commands from {compile_commands_path}")
         try:
@@ -206,11 +444,20 @@ def main():
     count = 0
 
     import threading
-    import concurrent.futures
-
-    all_macros_lock = threading.Lock()
 
-    def worker(cmd):
+    count_lock = threading.Lock()
+    fingerprints = FingerprintRegistry() if args.tu_dedup else None
+    memo = MacroMemo()
+    drivers = DriverCache() if args.direct_cc1 else None
+    state = None
+    if args.incremental:
+        options = [clang_exec, *tool_versions(clang_exec), f"header_only={args.header_only_probes}"]
+        state = IncrementalState.load(state_path_for(output_file), options)
+    cache = None
+    if args.result_cache:
+        cache = ResultCache(cache_dir, args.cache_max_mb * 1024 * 1024)
+
+    def resolve_command(cmd):
         file_path = cmd.get("file", "")
         if not file_path.endswith((".c", ".cpp", ".cxx", ".cc")):
             return None
@@ -229,41 +476,280 @@ def main():
         else:
             logging.getLogger("main").warning(f"Warning: no command/arguments for {file_path}, skipping.")
             return None
+        return file_path, original_cmd, directory
 
-        macros = process_file(
-            source_file=file_path,
-            original_cmd=original_cmd,
-            directory=directory,
-            known_macros=all_macros,
-            clang_exec=clang_exec,
-        )
-        return macros
+    # Per-file wall time and compiler peak memory of earlier runs: the most
+    # expensive files start first, and --max-memory bounds what runs at once
+    costs = CostRecords.load(os.path.join(cache_dir, "job_costs.json")) if args.cost_model else None
+    max_memory = args.max_memory * 1024 * 1024 if args.max_memory is not None else None
+
+    def estimates(keys):
+        if costs is None:
+            return [JobCost(0.0, 0)] * len(keys)
+        return [costs.estimate(key) for key in keys]
+
+    def run_attempt(control: JobControl, key: str, fn, *fn_args, **fn_kwargs):
+        """fn() as *control*'s attempt, its time and memory recorded for *key*."""
+        try:
+            with job_context(control):
+                return fn(*fn_args, **fn_kwargs)
+        finally:
+            if costs is not None:
+                costs.record(key, control.elapsed, control.peak_rss)
+
+    collect_dependencies = cache is not None or state is not None or scan_closure
+
+    def preprocess_worker(control, file_path, original_cmd, directory):
+        return run_attempt(control, job_key(file_path, original_cmd, directory), prepare_file,
+                           file_path, original_cmd, directory, clang_exec,
+                           collect_dependencies=collect_dependencies, drivers=drivers)
+
+    # evaluate_prepared() options besides the TU, its planned names and PCH
+    probe_options = dict(
+        clang_exec=clang_exec,
+        header_only=args.header_only_probes,
+        memo=memo,
+        fold=args.constant_folding,
+        fold_verify_rate=args.fold_verify_rate,
+        shards=args.probe_shards,
+        scratch_root=scratch_root,
+        pipe=args.pipe_probes,
+        backend=args.probe_backend,
+        drivers=drivers,
+    )
 
-    logging.getLogger("core").info(f"Starting parallel processing with {'automatic' if args.jobs is None else args.jobs} workers...")
+    def probe_worker(control, prepared, only_names, pch):
+        return run_attempt(control, job_key(prepared.source_file, prepared.original_cmd, prepared.directory),
+                           evaluate_prepared, prepared, fingerprints=fingerprints, only_names=only_names,
+                           pch=pch, **probe_options)
+
+    # --probe-timeout: a straggling file is retried with more shards in the
+    # same probe mode, so the values do not depend on which attempt wins; they
+    # are cached and shared with other files like any other.  The backup
+    # neither claims memo entries nor a fingerprint: the original
+    # still holds them, and releases them when it is killed.
+    backup_options = None
+    if args.probe_shards < _BACKUP_SHARDS:
+        backup_options = dict(probe_options, shards=_BACKUP_SHARDS, memo=None)
+
+    def backup_worker(control, prepared, only_names, pch):
+        logging.getLogger("core").warning(
+            f"{prepared.source_file} exceeded --probe-timeout ({args.probe_timeout:g}s), "
+            f"retrying it with {_BACKUP_SHARDS} probe shards"
+        )
+        return run_attempt(control, job_key(prepared.source_file, prepared.original_cmd, prepared.directory),
+                           evaluate_prepared, prepared, only_names=only_names, pch=pch, **backup_options)
+
+    limits = None
+    if args.async_pipeline:
+        workers = args.jobs or os.cpu_count() or 1
+        compile_jobs = args.compile_jobs or workers
+        limits = StageLimits(args.preprocess_jobs or workers, compile_jobs, args.read_jobs or max(1, compile_jobs // 2))
+        logging.getLogger("core").info(
+            f"Starting the asyncio pipeline with {limits.preprocess} preprocess, "
+            f"{limits.compile} compile and {limits.read} read slot(s)..."
+        )
+        ignored = [option for option, value in (("--max-memory", args.max_memory),
+                                                ("--preprocess-timeout", args.preprocess_timeout),
+                                                ("--probe-timeout", args.probe_timeout)) if value is not None]
+        if ignored:
+            logging.getLogger("main").warning(f"{', '.join(ignored)} not applied with --async-pipeline.")
+    else:
+        logging.getLogger("core").info(f"Starting parallel processing with {'automatic' if args.jobs is None else args.jobs} workers...")
     logging.getLogger("Bar").info(f"total job count: {len(commands)}")
-    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
-        futures = {executor.submit(worker, cmd): cmd for cmd in commands}
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                macros = future.result()
-                if macros is not None:
-                    with all_macros_lock:
-                        if macros:
-                            all_macros.update(macros)
-                        count += 1
-                        logging.getLogger("Bar").info(f"processed {count} files.")
-            except Exception as e:
-                logging.getLogger("core").error(f"Error processing file: {e}")
+    # ThreadPoolExecutor's default, spelled out for the scheduler
+    workers = args.jobs or min(32, (os.cpu_count() or 1) + 4)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        def preprocess_all(jobs):
+            job_costs = estimates([job_key(*job) for job in jobs])
+            if limits is not None:
+                return preprocess_files(jobs, limits, clang_exec, collect_dependencies, drivers,
+                                        [cost.seconds for cost in job_costs])
+            prepared = [None] * len(jobs)
+            for i, future in schedule(executor, preprocess_worker, jobs, job_costs, workers, max_memory,
+                                          args.preprocess_timeout):
+                try:
+                    prepared[i] = future.result()
+                except Exception as e:
+                    logging.getLogger("core").error(f"Error preprocessing file: {e}")
+            return [p for p in prepared if p is not None]
+
+        # --incremental: files whose command and include closure are unchanged
+        # since the last run are not even preprocessed
+        jobs = []
+        unchanged = []
+        # Every file's result is merged into all_macros once, in compile
+        # database order, whether it was reused, cached or probed: files may
+        # disagree on a macro's value, and the last one in the database wins
+        positions = {}
+        reused = []
+        for cmd in commands:
+            resolved = resolve_command(cmd)
+            if resolved is None:
+                continue
+            positions.setdefault(job_key(*resolved), len(positions))
+            saved = state.unchanged(*resolved) if state is not None else None
+            if saved is None:
+                jobs.append(resolved)
+            else:
+                unchanged.append((resolved, saved))
+
+        # Phase 1: run every -E -dM step
+        prepared_files = preprocess_all(jobs)
+
+        # --conditional-scope closure: scan each file of the repository that
+        # some TU includes, once
+        if scan_closure:
+            closure = {path for prepared in prepared_files for path in prepared.dependencies}
+            closure.update(path for _, saved in unchanged for path in saved.deps)
+            closure = sorted(path for path in closure if path.startswith(repo_dir + os.sep))
+            logging.getLogger("conditional-macro").info(
+                f"Scanning {len(closure)} file(s) of the compile database's include closure "
+                f"for conditional-compilation macros..."
+            )
+            scan_future = executor.submit(scan_conditional_macros, closure, args.jobs, scan_index_path)
+
+        # Reuse unchanged files whose saved results cover the filter; the
+        # others (the filter grew since) are preprocessed after all
+        stale = []
+        for resolved, saved in unchanged:
+            macros = state.reuse(saved, conditional_names())
+            if macros is None:
+                stale.append(resolved)
+                continue
+            reused.append((job_key(*resolved), macros))
+            count += 1
+            logging.getLogger("Bar").info(f"processed {count} files.")
+        if stale:
+            prepared_files += preprocess_all(stale)
+
+        # Reuse results of TUs whose flags, include closure and tools are unchanged
+        cache_keys = [None] * len(prepared_files)
+        cache_hits = []
+        if cache is not None:
+            versions = tool_versions(clang_exec)
+            options = [f"header_only={args.header_only_probes}"]
+            cache_keys = [tu_cache_key(prepared, versions, options) for prepared in prepared_files]
+            pending = []
+            for prepared, key in zip(prepared_files, cache_keys):
+                macros = None
+                if key is not None:
+                    macros = cache.get(key, required_names(prepared, conditional_names()))
+                if macros is None:
+                    pending.append((prepared, key))
+                    continue
+                cache_hits.append((prepared, macros))
+                reused.append((job_key(prepared.source_file, prepared.original_cmd, prepared.directory), macros))
+                count += 1
+                logging.getLogger("Bar").info(f"processed {count} files.")
+            prepared_files = [prepared for prepared, _ in pending]
+            cache_keys = [key for _, key in pending]
+
+        # Phase 2: decide which TU probes which macro definition
+        if args.global_plan:
+            plan = plan_probes(prepared_files, clang_exec, conditional_names())
+        else:
+            plan = [conditional_names()] * len(prepared_files)
+
+        # Optional: shared PCHs for the leading #include blocks
+        if args.shared_pch and not args.header_only_probes:
+            pch_dir = args.pch_dir or os.path.join(build_dir, ".macro_pch")
+            pchs = plan_shared_pchs(prepared_files, pch_dir, executor, costs, args.probe_timeout)
+        else:
+            pchs = [None] * len(prepared_files)
+
+        # Phase 3: compile and read the probes
+        def count_processed():
+            nonlocal count
+            with count_lock:
+                count += 1
+                logging.getLogger("Bar").info(f"processed {count} files.")
+
+        def probe_all(items, on_done):
+            item_costs = estimates([job_key(p.source_file, p.original_cmd, p.directory) for p, _, _ in items])
+            if limits is not None:
+                return evaluate_files(items, limits, on_done, fingerprints,
+                                      [cost.seconds for cost in item_costs], **probe_options)
+            probed = [None] * len(items)
+            for i, future in schedule(executor, probe_worker, items, item_costs, workers, max_memory,
+                                      args.probe_timeout,
+                                      backup_worker if backup_options is not None else None):
+                try:
+                    macros = future.result()
+                    if macros is not None:
+                        probed[i] = macros
+                        on_done()
+                except Exception as e:
+                    logging.getLogger("core").error(f"Error processing file: {e}")
+            return probed
+
+        results = probe_all(list(zip(prepared_files, plan, pchs)), count_processed)
+
+        # Definitions whose planned TU failed (or lost the shard probing them)
+        # go to other TUs that can see them, for a few more rounds
+        if args.global_plan:
+            attempted = list(plan)
+            for _ in range(_REPLAN_ROUNDS):
+                replan = replan_missing(prepared_files, results, attempted, clang_exec, conditional_names())
+                todo = [i for i, names in enumerate(replan) if names]
+                if not todo:
+                    break
+                retried = probe_all([(prepared_files[i], replan[i], pchs[i]) for i in todo], lambda: None)
+                for i, macros in zip(todo, retried):
+                    attempted[i] = attempted[i] | replan[i]
+                    if macros is not None:
+                        results[i] = {**results[i], **macros}
+
+        # Probed files contribute every macro they see (as the reused ones
+        # do), not only the ones the plan gave them
+        expanded = expand_results(prepared_files, results, clang_exec, conditional_names(), partial=True)
+        probed = [(job_key(p.source_file, p.original_cmd, p.directory), macros)
+                  for p, macros in zip(prepared_files, expanded)]
+        for _, macros in sorted(reused + probed, key=lambda entry: positions[entry[0]]):
+            if macros:
+                all_macros.update(macros)
+
+    if cache is not None or state is not None:
+        # Only complete per-file results are stored
+        expanded = expand_results(prepared_files, results, clang_exec, conditional_names())
+    if cache is not None:
+        for key, macros in zip(cache_keys, expanded):
+            if key is not None and macros is not None:
+                cache.put(key, macros)
+        cache.trim()
+        logging.getLogger("core").info(
+            f"Result cache: {cache.hits} file(s) reused, {cache.stores} stored ({cache.cache_dir})."
+        )
+    if state is not None:
+        for prepared, macros in cache_hits + list(zip(prepared_files, expanded)):
+            if macros is not None:
+                state.record(prepared, macros, required_names(prepared))
+        state.save()
+        logging.getLogger("core").info(
+            f"Incremental: {state.reused} unchanged file(s) reused, "
+            f"{len(cache_hits) + len(prepared_files)} reprocessed."
+        )
+
+    if costs is not None:
+        costs.save()
+        logging.getLogger("job_costs").info(f"Recorded the cost of {costs.measured} file(s) in {costs.path}.")
 
     logging.getLogger("core").info(f"Processed {count} files.")
+    if fingerprints is not None:
+        logging.getLogger("core").info(f"{fingerprints.hits} file(s) reused the result of an identical macro environment.")
+    logging.getLogger("core").info(f"{memo.hits} probe(s) skipped because the same macro definition was already evaluated.")
+    if drivers is not None:
+        logging.getLogger("driver_cache").info(
+            f"{drivers.direct} compiler run(s) went straight to cc1 using {drivers.expansions} driver expansion(s)."
+        )
 
     # --conditional-macro filter (enabled by default)
+    # Results reused from the cache / incremental state may hold more names
     if args.conditional_macro:
-        logging.getLogger("conditional-macro").info("Scanning source files for conditional-compilation macros...")
-        conditional_names = collect_conditional_macros(repo_dir)
-        logging.getLogger("conditional-macro").info(f"Found {len(conditional_names)} unique macro names in #if/#ifdef/etc. directives.")
+        names = conditional_names()
+        logging.getLogger("conditional-macro").info(f"Found {len(names)} unique macro names in #if/#ifdef/etc. directives.")
         before = len(all_macros)
-        all_macros = {k: v for k, v in all_macros.items() if k in conditional_names}
+        all_macros = {k: v for k, v in all_macros.items() if k in names}
         logging.getLogger("conditional-macro").info(f"Kept {len(all_macros)}/{before} macros (use --no-conditional-macro to disable this filter).")
 
     save_output(all_macros, output_file, output_fmt)
@@ -273,4 +759,8 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except KeyboardInterrupt:
+        logging.getLogger("main").error("Interrupted.")
+        sys.exit(130)
@@ -0,0 +1,307 @@
+"""
+pch_cache.py — Shared precompiled headers for probe compiles.
+
+Most TUs of a firmware project start with the same run of SDK / board
+#include lines, and every probe compile parses those headers again.  This
+optional stage (main.py --shared-pch):
+
+  1. reads the leading #include block of every TU;
+  2. groups TUs by probe compile flags and source directory (a PCH is only
+     valid for the flags it was built with, and quoted includes resolve
+     relative to the including file);
+  3. gives every TU the longest include prefix it shares with at least one
+     other TU of its group, and builds one PCH per distinct prefix;
+  4. core blanks those #include lines in the probe file and compiles it with
+     `-include-pch`.
+
+PCHs live in a cache directory keyed by a hash of (compile flags, source
+directory, include lines).  Each one has a manifest recording the compiler
+that built it (result_cache.tool_versions()), the PCH file itself and the
+headers it was built from (via a -MD depfile) with their mtime and size; a
+PCH is rebuilt as soon as the compiler or any of those files changes.  The
+manifest is published before the PCH, so a concurrent run that sees a new
+manifest next to the old PCH takes the PCH as stale rather than current.
+
+PCH builds run under a JobControl (job_control.py): they are killed after
+the given timeout or when planning is interrupted, and their cost is
+recorded in the job_costs records so the longest builds start first.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from core import build_probe_compile_cmd, read_depfile
+from job_control import JobControl, JobTimedOut, job_context, run_process
+from job_costs import CostRecords
+from result_cache import tool_versions
+
+
+class SharedPch(NamedTuple):
+    """A PCH a TU uses, and the 0-indexed source lines it replaces."""
+    pch_path: str
+    header_path: str
+    source_lines: Tuple[int, ...]
+
+
+_INCLUDE_RE = re.compile(r'^\s*#\s*include\s*([<"][^>"]+[>"])\s*(?://.*|/\*.*?\*/\s*)?$')
+
+
+def leading_includes(source_file: str) -> List[Tuple[int, str]]:
+    """
+    Return [(line_index, '<header>' or '"header"')] for the #include lines at
+    the top of *source_file*, up to the first line that is neither an
+    #include, blank, nor a comment.
+    """
+    try:
+        with open(source_file, "r", encoding="utf-8", errors="replace") as f:
+            lines = f.readlines()
+    except OSError:
+        return []
+
+    includes = []
+    in_comment = False
+    for idx, line in enumerate(lines):
+        stripped = line.strip()
+        if in_comment:
+            if "*/" in stripped:
+                in_comment = False
+                stripped = stripped.split("*/", 1)[1].strip()
+                if stripped:
+                    break
+            continue
+        if not stripped or stripped.startswith("//"):
+            continue
+        if stripped.startswith("/*"):
+            if "*/" not in stripped:
+                in_comment = True
+                continue
+            if not stripped.split("*/", 1)[1].strip():
+                continue
+            break
+        m = _INCLUDE_RE.match(line)
+        if not m:
+            break
+        includes.append((idx, m.group(1)))
+    return includes
+
+
+def _file_state(path: str) -> Optional[List[int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _pch_is_current(pch_path: str, manifest_path: str, tools: Tuple[str, str]) -> bool:
+    """
+    True if the PCH is the one its manifest describes, was built by the same
+    compiler (*tools*) and none of the headers it was built from changed.
+    """
+    if not os.path.exists(pch_path) or not os.path.exists(manifest_path):
+        return False
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        deps, pch_state, built_with = manifest["deps"], manifest["pch"], manifest["tools"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+    if built_with != list(tools) or _file_state(pch_path) != pch_state:
+        return False
+    return all(_file_state(path) == state for path, state in deps.items())
+
+
+def _write_manifest(manifest_path: str, manifest: Dict) -> bool:
+    """Atomically write a PCH manifest; False if it could not be written."""
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(manifest_path), suffix=".tmp")
+    except OSError as e:
+        logging.getLogger("pch_cache").warning(f"Could not write {manifest_path}: {e}")
+        return False
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_path, manifest_path)
+    except OSError as e:
+        logging.getLogger("pch_cache").warning(f"Could not write {manifest_path}: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def _build_pch(base_cmd: List[str],
+               header_path: str,
+               pch_path: str,
+               manifest_path: str,
+               source_dir: str,
+               directory: str,
+               lang: str,
+               tools: Tuple[str, str]) -> bool:
+    """Compile *header_path* into *pch_path* and record its manifest."""
+    dep_path = pch_path + ".d"
+    tmp_path = f"{pch_path}.{os.getpid()}.tmp"
+    cmd = []
+    for part in base_cmd:
+        if part == "-c":
+            continue
+        if part == "\0in":
+            cmd.extend(["-x", lang, "-iquote", source_dir, header_path])
+        elif part == "\0out":
+            cmd.append(tmp_path)
+        else:
+            cmd.append(part)
+    cmd.extend(["-MD", "-MF", dep_path])
+
+    logging.getLogger("pch_cache").info(f"Building PCH: {' '.join(cmd)}")
+    try:
+        result = run_process(cmd, text=True, cwd=directory)
+    except JobTimedOut as e:
+        result = None
+        logging.getLogger("pch_cache").warning(f"PCH build for {header_path} {e}")
+    except BaseException:
+        _remove(tmp_path, dep_path)
+        raise
+    if result is None or result.returncode != 0:
+        if result is not None:
+            logging.getLogger("pch_cache").warning(f"PCH build failed for {header_path}:\n{result.stderr[:2000]}")
+        _remove(tmp_path, dep_path)
+        return False
+
+    deps = {}
+    for path in read_depfile(dep_path):
+        path = os.path.normpath(os.path.join(directory, path))
+        state = _file_state(path)
+        if state is not None:
+            deps[path] = state
+    # os.replace keeps the PCH's mtime and size, so the manifest can name it
+    # before it is published
+    manifest = {"tools": list(tools), "pch": _file_state(tmp_path), "deps": deps}
+    if not _write_manifest(manifest_path, manifest):
+        _remove(tmp_path, dep_path)
+        return False
+    os.replace(tmp_path, pch_path)
+    _remove(dep_path)
+    return True
+
+
+def _remove(*paths: str) -> None:
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def plan_shared_pchs(prepared_files: Sequence,
+                     pch_dir: str,
+                     executor=None,
+                     costs: Optional[CostRecords] = None,
+                     timeout: Optional[float] = None) -> List[Optional[SharedPch]]:
+    """
+    Return, for each core.PreparedFile, the SharedPch its probe compile should
+    use (or None).  PCHs that are missing or stale are (re)built, in parallel
+    on *executor* if one is given, longest first by *costs*; a build is
+    killed after *timeout* seconds (None: no limit).
+    """
+    os.makedirs(pch_dir, exist_ok=True)
+
+    # group → [(index, includes)]
+    groups: Dict[Tuple, List[Tuple[int, List[Tuple[int, str]]]]] = defaultdict(list)
+    base_cmds: Dict[Tuple, List[str]] = {}
+    for i, prepared in enumerate(prepared_files):
+        includes = leading_includes(prepared.source_file)
+        if not includes:
+            continue
+        base_cmd = build_probe_compile_cmd(prepared.original_cmd, prepared.source_file,
+                                           "\0in", "\0out", prepared.directory)
+        if base_cmd is None or "\0in" not in base_cmd:
+            continue
+        source_dir = os.path.dirname(os.path.abspath(prepared.source_file))
+        ext = os.path.splitext(prepared.source_file)[1].lower()
+        key = (tuple(base_cmd), source_dir, prepared.directory, ext)
+        groups[key].append((i, includes))
+        base_cmds[key] = base_cmd
+
+    # Longest prefix each TU shares with another TU of its group
+    assignments: Dict[int, Tuple[Tuple, Tuple[str, ...], Tuple[int, ...]]] = {}
+    for key, members in groups.items():
+        counts: Dict[Tuple[str, ...], int] = defaultdict(int)
+        for _, includes in members:
+            names = tuple(name for _, name in includes)
+            for k in range(1, len(names) + 1):
+                counts[names[:k]] += 1
+        for i, includes in members:
+            names = tuple(name for _, name in includes)
+            k = len(names)
+            while k and counts[names[:k]] < 2:
+                k -= 1
+            if k:
+                assignments[i] = (key, names[:k], tuple(idx for idx, _ in includes[:k]))
+
+    # One PCH per distinct (group, prefix)
+    builds: Dict[Tuple, Tuple[str, str]] = {}
+    for key, prefix, _ in assignments.values():
+        if (key, prefix) not in builds:
+            digest = hashlib.sha256(repr((key, prefix)).encode("utf-8")).hexdigest()[:24]
+            header_path = os.path.join(pch_dir, f"{digest}.h")
+            builds[(key, prefix)] = (header_path, header_path + ".pch")
+
+    # --version of each compiler the PCHs are built with
+    versions: Dict[str, Tuple[str, str]] = {}
+    for key, _ in builds:
+        compiler = base_cmds[key][0]
+        if compiler not in versions:
+            versions[compiler] = tool_versions(compiler)
+
+    controls: List[JobControl] = []
+
+    def ensure(item) -> bool:
+        (key, prefix), (header_path, pch_path) = item
+        manifest_path = pch_path + ".json"
+        tools = versions[base_cmds[key][0]]
+        if _pch_is_current(pch_path, manifest_path, tools):
+            return True
+        with open(header_path, "w", encoding="utf-8") as f:
+            f.writelines(f"#include {name}\n" for name in prefix)
+        _, source_dir, directory, ext = key
+        lang = "c-header" if ext == ".c" else "c++-header"
+        control = JobControl(timeout)
+        controls.append(control)
+        try:
+            with job_context(control):
+                return _build_pch(base_cmds[key], header_path, pch_path, manifest_path,
+                                  source_dir, directory, lang, tools)
+        finally:
+            if costs is not None:
+                costs.record(pch_path, control.elapsed, control.peak_rss)
+
+    items = list(builds.items())
+    if costs is not None:
+        items.sort(key=lambda item: -costs.estimate(item[1][1]).seconds)
+    try:
+        results = list(executor.map(ensure, items) if executor is not None else map(ensure, items))
+    except BaseException:
+        # Ctrl-C (or a failed build): kill the builds still running
+        for control in controls:
+            control.cancel()
+        raise
+    built = {build_key for (build_key, _), ok in zip(items, results) if ok}
+
+    plan: List[Optional[SharedPch]] = [None] * len(prepared_files)
+    for i, (key, prefix, lines) in assignments.items():
+        if (key, prefix) in built:
+            header_path, pch_path = builds[(key, prefix)]
+            plan[i] = SharedPch(pch_path, header_path, lines)
+
+    used = sum(1 for p in plan if p is not None)
+    logging.getLogger("pch_cache").info(f"{len(built)} shared PCH(s) cover {used}/{len(prepared_files)} file(s)")
+    return plan
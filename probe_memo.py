@@ -0,0 +1,172 @@
+"""
+probe_memo.py — Share evaluation results between translation units.
+
+FingerprintRegistry
+    Hundreds of TUs in a compile database typically share the same -D/-I set
+    and include the same headers, so their `-E -dM` dumps are byte-identical.
+    The registry maps a fingerprint of (normalized dump, target flags) to the
+    per-TU macro dict, so only the first TU with a given fingerprint builds,
+    compiles and reads a probe; the others reuse its result.  A TU whose
+    fingerprint is currently being evaluated by another worker waits for that
+    result instead of repeating the work.
+
+MacroMemo
+    Finer-grained sharing at the level of single macros.  Entries are keyed by
+    macro_extractor.macro_definition_keys(): the macro name, its definition
+    text, the definitions of every macro it references and the target.  A
+    probe is skipped only when the same definition was already evaluated —
+    differing definitions across configurations are still probed — and
+    in-flight entries are claimed so two workers never probe the same
+    definition concurrently.
+"""
+
+import hashlib
+import logging
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+
+from macro_extractor import normalize_macro_dump
+
+
+# ---------------------------------------------------------------------------
+# Fingerprints
+# ---------------------------------------------------------------------------
+
+def tu_fingerprint(macro_output: str, target_flags: Iterable[str]) -> str:
+    """
+    Hash a TU's macro environment: the normalized `-E -dM` dump plus the flags
+    that influence code generation of the probe (target, ABI, language).
+    """
+    h = hashlib.sha256()
+    for flag in target_flags:
+        h.update(flag.encode("utf-8"))
+        h.update(b"\0")
+    h.update(b"\1")
+    h.update(normalize_macro_dump(macro_output).encode("utf-8"))
+    return h.hexdigest()
+
+
+# ---------------------------------------------------------------------------
+# Per-TU result sharing
+# ---------------------------------------------------------------------------
+
+class _PendingResult:
+    """A fingerprint claimed by one worker; others wait on `done`."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[Dict] = None
+        self.ok = False
+
+
+class FingerprintRegistry:
+    """
+    Thread-safe map of TU fingerprint → macro dict.
+
+    Usage by a worker:
+        owner, result = registry.claim(fp)
+        if not owner:
+            return result               # reused (possibly after waiting)
+        try:
+            result = ... evaluate ...
+            registry.publish(fp, result)
+        except:
+            registry.abandon(fp)        # let a waiting worker take over
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[str, _PendingResult] = {}
+        self.hits = 0
+
+    def claim(self, fp: str) -> Tuple[bool, Optional[Dict]]:
+        """
+        Return (True, None) if the caller now owns *fp* and must evaluate it,
+        or (False, result) if another TU already evaluated it.  Blocks while
+        another worker is evaluating the same fingerprint.
+        """
+        while True:
+            with self._lock:
+                entry = self._entries.get(fp)
+                if entry is None:
+                    self._entries[fp] = _PendingResult()
+                    return True, None
+            entry.done.wait()
+            if entry.ok:
+                with self._lock:
+                    self.hits += 1
+                return False, dict(entry.result)
+            # The owner gave up — loop and try to claim it ourselves.
+
+    def publish(self, fp: str, result: Dict) -> None:
+        """Record the result for a fingerprint claimed by this worker."""
+        with self._lock:
+            entry = self._entries[fp]
+        entry.result = dict(result)
+        entry.ok = True
+        entry.done.set()
+
+    def abandon(self, fp: str) -> None:
+        """Release a claim without a result so another worker may retry it."""
+        with self._lock:
+            entry = self._entries.get(fp)
+            if entry is None or entry.ok:
+                return
+            del self._entries[fp]
+        entry.done.set()
+        logging.getLogger("probe_memo").info(f"Abandoned fingerprint {fp[:12]}")
+
+
+# ---------------------------------------------------------------------------
+# Per-macro evaluation memo
+# ---------------------------------------------------------------------------
+
+_PENDING = object()
+
+
+class MacroMemo:
+    """
+    Thread-safe map of macro definition key → evaluated value (int or None).
+
+    Usage by a worker:
+        if memo.claim(key):             # True → this worker must probe it
+            ...
+            memo.resolve(key, value)    # memo.fail(key) if it did not compile,
+                                        # memo.release(key) if it was never tried
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values: Dict[str, object] = {}
+        self.hits = 0
+
+    def claim(self, key: str) -> bool:
+        """Claim *key* for evaluation; False if it is done or in flight elsewhere."""
+        with self._lock:
+            if key in self._values:
+                self.hits += 1
+                return False
+            self._values[key] = _PENDING
+            return True
+
+    def resolve(self, key: str, value: Optional[int]) -> None:
+        """Record the evaluated value for a claimed key."""
+        with self._lock:
+            self._values[key] = value
+
+    def fail(self, key: str) -> None:
+        """Record that the definition failed to compile (value None)."""
+        with self._lock:
+            self._values[key] = None
+
+    def release(self, key: str) -> None:
+        """Drop an unresolved claim so a later TU may evaluate the definition."""
+        with self._lock:
+            if self._values.get(key) is _PENDING:
+                del self._values[key]
+
+    def get(self, key: str, default=None):
+        """Return the evaluated value for *key*, or *default* if unknown / pending."""
+        with self._lock:
+            value = self._values.get(key, _PENDING)
+        return default if value is _PENDING else value
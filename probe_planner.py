@@ -0,0 +1,151 @@
+"""
+probe_planner.py — Assign every distinct macro definition to one probe TU.
+
+After the preprocessing pass every TU's `-E -dM` dump is known, so the set of
+definitions that must be probed across the whole compile database is known
+before anything is compiled.  Instead of letting each TU probe whatever the
+memo has not seen yet (which depends on thread timing and still compiles many
+nearly-empty probes), the planner computes a global assignment:
+
+  * every distinct definition key (macro_extractor.macro_definition_keys) is
+    probed by exactly one TU that can see it;
+  * the TUs are picked greedily by how many not-yet-covered keys they hold
+    (classic greedy set cover), so the number of probe compiles stays close
+    to the minimum;
+  * ties are broken by compile-database order, so the plan is deterministic.
+
+TUs that end up with an empty assignment skip the compile entirely.
+A definition whose TU failed (compile error, killed by a timeout, lost
+shard) has no value afterwards; replan_missing() assigns those definitions
+to other TUs that can see them, for another (small) probe round.
+expand_results() maps the partial per-TU results back to the full macro dict
+of every TU (needed wherever results are stored per TU, e.g. result_cache).
+"""
+
+import heapq
+import logging
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from macro_extractor import macro_definition_keys, probe_candidate_names, probe_target
+
+
+def plan_probes(prepared_files: Sequence,
+                clang_exec: str = "clang",
+                allowed: Optional[Set[str]] = None) -> List[Set[str]]:
+    """
+    Return, for each entry of *prepared_files* (core.PreparedFile), the set of
+    macro names that TU should probe.  *allowed* (e.g. the conditional-macro
+    scanner's names) restricts the macros that are probed at all.
+    """
+    # keys[i] = {definition key: macro name} for TU i
+    keys: List[Dict[str, str]] = []
+    for prepared in prepared_files:
+        name_keys = _definition_keys(prepared, clang_exec, allowed)
+        keys.append({key: name for name, key in name_keys.items()})
+
+    plan, covered = _cover(keys)
+    selected = sum(1 for names in plan if names)
+    logging.getLogger("probe_planner").info(
+        f"Probe plan: {len(covered)} distinct definition(s) across "
+        f"{len(prepared_files)} file(s), {selected} probe compile(s)"
+    )
+    return plan
+
+
+def replan_missing(prepared_files: Sequence,
+                   results: Sequence[Optional[Dict]],
+                   attempted: Sequence[Set[str]],
+                   clang_exec: str = "clang",
+                   allowed: Optional[Set[str]] = None) -> List[Set[str]]:
+    """
+    After a probe round: the plan for the definitions no TU returned a value
+    for.  They go to TUs that can see them, did not fail outright (result
+    None) and were not asked for them already (attempted[i]: the names TU i
+    probed so far).  All sets are empty when nothing is left to try.
+    """
+    all_keys = [_definition_keys(prepared, clang_exec, allowed) for prepared in prepared_files]
+    evaluated = _evaluated_keys(all_keys, results)
+
+    keys: List[Dict[str, str]] = []
+    for name_keys, macros, names in zip(all_keys, results, attempted):
+        if macros is None:
+            keys.append({})
+            continue
+        keys.append({key: name for name, key in name_keys.items() if key not in evaluated and name not in names})
+
+    plan, covered = _cover(keys)
+    if covered:
+        logging.getLogger("probe_planner").info(
+            f"Re-planning {len(covered)} definition(s) left without a value onto "
+            f"{sum(1 for names in plan if names)} other file(s)"
+        )
+    return plan
+
+
+def _cover(keys: List[Dict[str, str]]) -> Tuple[List[Set[str]], Set[str]]:
+    """Greedy set cover of the definition keys; (names per TU, keys covered)."""
+    covered: Set[str] = set()
+    plan: List[Set[str]] = [set() for _ in keys]
+
+    # Lazy greedy: the heap holds (-gain, index) with possibly stale gains;
+    # a popped entry is re-scored and pushed back unless it is still the best.
+    heap = [(-len(k), i) for i, k in enumerate(keys) if k]
+    heapq.heapify(heap)
+    while heap:
+        neg_gain, i = heapq.heappop(heap)
+        fresh = [key for key in keys[i] if key not in covered]
+        if not fresh:
+            continue
+        if len(fresh) < -neg_gain:
+            heapq.heappush(heap, (-len(fresh), i))
+            continue
+        covered.update(fresh)
+        plan[i] = {keys[i][key] for key in fresh}
+    return plan, covered
+
+
+def _evaluated_keys(all_keys: List[Dict[str, str]], results: Sequence[Optional[Dict]]) -> Dict[str, Optional[int]]:
+    """{definition key: value} over every TU's result."""
+    by_key: Dict[str, Optional[int]] = {}
+    for keys, macros in zip(all_keys, results):
+        for name, value in (macros or {}).items():
+            if name in keys:
+                by_key[keys[name]] = value
+    return by_key
+
+
+def required_names(prepared, allowed: Optional[Set[str]] = None) -> List[str]:
+    """The macros of a TU that must be probed: its probe candidates within *allowed*."""
+    names = probe_candidate_names(prepared.macro_table)
+    if allowed is not None:
+        names = [name for name in names if name in allowed]
+    return names
+
+
+def _definition_keys(prepared, clang_exec: str, allowed: Optional[Set[str]] = None) -> Dict[str, str]:
+    target = probe_target(clang_exec, prepared.preprocessor_flags)
+    return macro_definition_keys(prepared.macro_table, required_names(prepared, allowed), target)
+
+
+def expand_results(prepared_files: Sequence,
+                   results: Sequence[Optional[Dict]],
+                   clang_exec: str = "clang",
+                   allowed: Optional[Set[str]] = None,
+                   partial: bool = False) -> List[Optional[Dict]]:
+    """
+    Given the (possibly partial) macro dict each TU returned, return the full
+    dict of every TU: the value of each of its required_names(), taken from
+    whichever TU evaluated that definition.  A TU is None if it failed or one
+    of its definitions was not evaluated anywhere; with *partial*, such a
+    definition is only left out.
+    """
+    all_keys = [_definition_keys(prepared, clang_exec, allowed) for prepared in prepared_files]
+    by_key = _evaluated_keys(all_keys, results)
+
+    expanded: List[Optional[Dict]] = []
+    for keys, macros in zip(all_keys, results):
+        if macros is None or (not partial and any(key not in by_key for key in keys.values())):
+            expanded.append(None)
+        else:
+            expanded.append({name: by_key[key] for name, key in keys.items() if key in by_key})
+    return expanded
@@ -0,0 +1,158 @@
+"""
+repo_crawler.py — One walk of the repository, shared by every consumer.
+
+Source discovery without a compile database (main.fallback_find_c_files)
+and the conditional-macro scanner both need the C/C++ files of the tree.
+crawl_repo() lists it once with os.scandir, applying the same skip rules
+for both, and returns typed entries ("tu" or "header") with their stat data.
+
+With a listing_path the per-directory listing is saved and reused on the
+next run: a directory whose mtime is unchanged (adding, removing or renaming
+an entry updates it) is not read again, only its files are stat'ed.  This
+saves one readdir per directory, which is what dominates a walk on
+network-mounted workspaces.  Directories modified within the last couple of
+seconds of a crawl are not saved, since a coarse mtime may not show a
+change made right after.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+TU_EXTENSIONS = frozenset({".c", ".cpp", ".cxx", ".cc"})
+HEADER_EXTENSIONS = frozenset({".h", ".hpp", ".hxx", ".hh", ".inl", ".inc"})
+
+# Directories to skip entirely during the walk
+SKIP_DIRS = frozenset({"build", ".git", ".svn", ".hg", "node_modules"})
+
+_LISTING_VERSION = 1
+# A directory modified this recently is listed again on the next run
+_RACY_NS = 2_000_000_000
+
+
+class RepoEntry(NamedTuple):
+    """A source file of the repository."""
+    path: str
+    kind: str       # "tu" or "header"
+    mtime_ns: int
+    size: int
+
+
+def _kind(name: str) -> Optional[str]:
+    # Case-insensitive, as the conditional-macro scanner always matched
+    ext = os.path.splitext(name)[1].lower()
+    if ext in TU_EXTENSIONS:
+        return "tu"
+    if ext in HEADER_EXTENSIONS:
+        return "header"
+    return None
+
+
+def _load_listing(listing_path: str, root: str) -> Dict[str, Dict]:
+    try:
+        with open(listing_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.getLogger("repo_crawler").warning(f"Ignoring unreadable listing {listing_path}: {e}")
+        return {}
+    if data.get("version") != _LISTING_VERSION or data.get("root") != root:
+        return {}
+    return data.get("dirs", {})
+
+
+def _save_listing(listing_path: str, root: str, dirs: Dict[str, Dict]) -> None:
+    directory = os.path.dirname(os.path.abspath(listing_path))
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    except OSError as e:
+        logging.getLogger("repo_crawler").warning(f"Could not save listing {listing_path}: {e}")
+        return
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"version": _LISTING_VERSION, "root": root, "dirs": dirs}, f)
+        os.replace(tmp_path, listing_path)
+    except OSError as e:
+        logging.getLogger("repo_crawler").warning(f"Could not save listing {listing_path}: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def crawl_repo(repo_dir: str, listing_path: Optional[str] = None) -> List[RepoEntry]:
+    """
+    Return every TU and header under *repo_dir* (skipping SKIP_DIRS and
+    symlinked directories), sorted by path within each directory.  With
+    *listing_path*, reuse and update the saved directory listing.
+    """
+    root = os.path.abspath(repo_dir)
+    previous = _load_listing(listing_path, root) if listing_path else {}
+    listing: Dict[str, Dict] = {}
+    started_ns = time.time_ns()
+    entries: List[RepoEntry] = []
+    reused = 0
+
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        saved = previous.get(directory)
+        dir_mtime_ns = None
+        if listing_path:
+            try:
+                dir_mtime_ns = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+
+        stats = {}  # name → os.stat_result, from scandir (free on Windows)
+        if saved is not None and saved["mtime_ns"] == dir_mtime_ns:
+            subdirs, files = saved["dirs"], [tuple(item) for item in saved["files"]]
+            reused += 1
+        else:
+            subdirs, files = [], []
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                if entry.name not in SKIP_DIRS:
+                                    subdirs.append(entry.name)
+                                continue
+                            kind = _kind(entry.name)
+                            if kind is not None and entry.is_file():
+                                stats[entry.name] = entry.stat()
+                                files.append((entry.name, kind))
+                        except OSError:
+                            continue
+            except OSError as e:
+                logging.getLogger("repo_crawler").warning(f"Cannot list {directory}: {e}")
+                continue
+            subdirs.sort()
+            files.sort()
+
+        if dir_mtime_ns is not None and dir_mtime_ns < started_ns - _RACY_NS:
+            listing[directory] = {"mtime_ns": dir_mtime_ns, "dirs": subdirs, "files": files}
+
+        for name, kind in files:
+            path = os.path.join(directory, name)
+            st = stats.get(name)
+            if st is None:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+            entries.append(RepoEntry(path, kind, st.st_mtime_ns, st.st_size))
+        stack.extend(os.path.join(directory, name) for name in reversed(subdirs))
+
+    if listing_path:
+        _save_listing(listing_path, root, listing)
+        logging.getLogger("repo_crawler").info(
+            f"Listed {len(entries)} source file(s); {reused} "
+            f"director{'y' if reused == 1 else 'ies'} reused from {listing_path}"
+        )
+    return entries
@@ -0,0 +1,216 @@
+"""
+result_cache.py — Persistent, content-addressed cache of per-TU results.
+
+A TU's macro dict only depends on:
+  - its probe compile flags (normalized: the probe's own input/output paths
+    are replaced by placeholders),
+  - the contents of the source file and of every header in its dependency
+    closure (the -MD depfile of the `-E -dM` step),
+  - the compiler and object-reader versions,
+  - options that change results (header-only probes).
+
+The cache key is a SHA-256 over all of these, so an entry can never be stale:
+a changed header simply yields a different key.  Entries are small JSON files
+written atomically (temp file + os.replace), so concurrent workers and
+concurrent runs can share one cache directory.  The entries are kept under a
+size bound by evicting least-recently-used ones (a hit refreshes the entry's
+mtime); they live in their own subdirectory, since the cache directory also
+holds other state (scan index, directory listing, job costs).
+"""
+
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import subprocess
+import tempfile
+import threading
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+from core import build_probe_compile_cmd
+from elf_reader import object_reader_version
+
+
+@functools.lru_cache(maxsize=None)
+def tool_versions(clang_exec: str) -> Tuple[str, str]:
+    """(compiler --version, object reader --version) — empty if unavailable."""
+    try:
+        result = subprocess.run([clang_exec, "--version"], capture_output=True, text=True)
+        compiler = result.stdout.strip()
+    except OSError:
+        compiler = ""
+    return compiler, object_reader_version(clang_exec)
+
+
+# (path, mtime_ns, size) → sha256 of the contents; headers are shared by many TUs
+_digests: Dict[Tuple[str, int, int], str] = {}
+_digests_lock = threading.Lock()
+
+
+def file_digest(path: str) -> Optional[str]:
+    """SHA-256 of a file's contents, memoized per (path, mtime, size)."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    stamp = (path, st.st_mtime_ns, st.st_size)
+    with _digests_lock:
+        digest = _digests.get(stamp)
+    if digest is None:
+        h = hashlib.sha256()
+        try:
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+        except OSError:
+            return None
+        digest = h.hexdigest()
+        with _digests_lock:
+            _digests[stamp] = digest
+    return digest
+
+
+def tu_cache_key(prepared,
+                 versions: Sequence[str],
+                 options: Iterable[str] = ()) -> Optional[str]:
+    """
+    Cache key for a core.PreparedFile, or None if it cannot be content-
+    addressed (no dependency list, or a dependency is unreadable).
+    """
+    if not prepared.dependencies:
+        return None
+    flags = build_probe_compile_cmd(prepared.original_cmd, prepared.source_file,
+                                    "\0in", "\0out", prepared.directory)
+    if flags is None:
+        return None
+
+    h = hashlib.sha256()
+    for part in list(flags) + ["\1"] + list(versions) + ["\1"] + list(options):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    for path in sorted(set(prepared.dependencies)):
+        digest = file_digest(path)
+        if digest is None:
+            return None
+        h.update(f"{path}\0{digest}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+# Entries of the layout before <cache_dir>/results/
+_LEGACY_SUBDIR_RE = re.compile(r"^[0-9a-f]{2}$")
+_LEGACY_ENTRY_RE = re.compile(r"^[0-9a-f]{64}\.json$")
+
+
+class ResultCache:
+    """
+    On-disk map of tu_cache_key() → per-TU macro dict.
+
+    Entries live in <cache_dir>/results/<key[:2]>/<key>.json.  trim() evicts
+    the least recently used entries until they are under max_bytes.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.entries_dir = os.path.join(cache_dir, "results")
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stores = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.entries_dir, key[:2], f"{key}.json")
+
+    def get(self, key: str, required: Iterable[str] = ()) -> Optional[Dict]:
+        """
+        Cached dict for *key*, or None.  An entry missing any of the *required*
+        names (stored under a narrower conditional-macro filter) is a miss.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                macros = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if any(name not in macros for name in required):
+            return None
+        try:
+            os.utime(path)  # LRU: mark as recently used
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return macros
+
+    def put(self, key: str, macros: Dict) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(macros, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.getLogger("result_cache").warning(f"Could not write cache entry {path}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            self.stores += 1
+
+    def trim(self) -> int:
+        """Evict least recently used entries above max_bytes; returns the count evicted."""
+        self._remove_legacy_entries()
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.entries_dir):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, path))
+                total += st.st_size
+
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+        if evicted:
+            logging.getLogger("result_cache").info(f"Evicted {evicted} cache entr{'y' if evicted == 1 else 'ies'}")
+        return evicted
+
+    def _remove_legacy_entries(self) -> None:
+        """Remove entries of the old <cache_dir>/<key[:2]>/<key>.json layout; they are never read."""
+        try:
+            subdirs = [name for name in os.listdir(self.cache_dir) if _LEGACY_SUBDIR_RE.match(name)]
+        except OSError:
+            return
+        for subdir in subdirs:
+            subdir = os.path.join(self.cache_dir, subdir)
+            try:
+                names = os.listdir(subdir)
+            except OSError:
+                continue
+            for name in names:
+                if name[:2] == os.path.basename(subdir) and _LEGACY_ENTRY_RE.match(name):
+                    try:
+                        os.remove(os.path.join(subdir, name))
+                    except OSError:
+                        pass
+            try:
+                os.rmdir(subdir)
+            except OSError:
+                pass
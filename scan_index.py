@@ -0,0 +1,118 @@
+"""
+scan_index.py — Persistent per-file index of conditional-macro scan results.
+
+collect_conditional_macros(index_path=...) keeps, for every scanned source
+file, its (mtime_ns, size, content digest) and the names its conditional
+directives reference.  On the next run a file whose mtime and size match is
+not opened at all; a file whose stamp changed but whose contents hash to
+the saved digest is not parsed again.
+
+The index is one SQLite database:
+
+    names(id, name)                                 every name, stored once
+    files(path, mtime_ns, size, digest, name_ids)   name_ids: packed uint32 ids
+
+It is discarded as a whole when the scanner version changes (a different
+scanner may find different names in the same file).
+"""
+
+import logging
+import os
+import sqlite3
+from array import array
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+
+
+class IndexEntry(NamedTuple):
+    """Saved scan result of one file."""
+    mtime_ns: int
+    size: int
+    digest: bytes
+    names: Tuple[str, ...]
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta  (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS names (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL,
+                                  size INTEGER NOT NULL, digest BLOB NOT NULL,
+                                  name_ids BLOB NOT NULL);
+"""
+
+
+class ScanIndex:
+    """On-disk map of source path → IndexEntry."""
+
+    def __init__(self, path: str, scanner_version: str):
+        self.path = path
+        self.scanner_version = scanner_version
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.executescript(_SCHEMA)
+        return conn
+
+    def load(self) -> Dict[str, IndexEntry]:
+        """All saved entries (empty if the index is missing, unreadable or outdated)."""
+        try:
+            conn = self._connect()
+        except (OSError, sqlite3.Error) as e:
+            logging.getLogger("scan_index").warning(f"Ignoring unreadable scan index {self.path}: {e}")
+            return {}
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'scanner'").fetchone()
+            if row is None or row[0] != self.scanner_version:
+                return {}
+            names = dict(conn.execute("SELECT id, name FROM names"))
+            entries = {}
+            for path, mtime_ns, size, digest, name_ids in conn.execute("SELECT * FROM files"):
+                ids = array("I")
+                ids.frombytes(name_ids)
+                entries[path] = IndexEntry(mtime_ns, size, digest, tuple(names[i] for i in ids))
+            return entries
+        except (sqlite3.Error, KeyError, ValueError) as e:
+            logging.getLogger("scan_index").warning(f"Ignoring unreadable scan index {self.path}: {e}")
+            return {}
+        finally:
+            conn.close()
+
+    def update(self,
+               changed: Dict[str, IndexEntry],
+               keep: Optional[Iterable[str]] = None) -> None:
+        """
+        Store the *changed* entries in one transaction.  If *keep* is given,
+        entries of every other path (deleted or no longer scanned files) are
+        dropped.
+        """
+        try:
+            conn = self._connect()
+        except (OSError, sqlite3.Error) as e:
+            logging.getLogger("scan_index").warning(f"Could not open scan index {self.path}: {e}")
+            return
+        try:
+            with conn:
+                row = conn.execute("SELECT value FROM meta WHERE key = 'scanner'").fetchone()
+                if row is None or row[0] != self.scanner_version:
+                    conn.execute("DELETE FROM files")
+                    conn.execute("DELETE FROM names")
+                    conn.execute("INSERT OR REPLACE INTO meta VALUES ('scanner', ?)", (self.scanner_version,))
+
+                new_names = {name for entry in changed.values() for name in entry.names}
+                conn.executemany("INSERT OR IGNORE INTO names(name) VALUES (?)",
+                                 ((name,) for name in new_names))
+                ids = {name: i for i, name in conn.execute("SELECT id, name FROM names")}
+                conn.executemany(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                    ((path, e.mtime_ns, e.size, e.digest, array("I", (ids[n] for n in e.names)).tobytes())
+                     for path, e in changed.items()),
+                )
+
+                if keep is not None:
+                    conn.execute("CREATE TEMP TABLE keep (path TEXT PRIMARY KEY)")
+                    conn.executemany("INSERT OR IGNORE INTO keep VALUES (?)", ((p,) for p in keep))
+                    conn.execute("DELETE FROM files WHERE path NOT IN (SELECT path FROM keep)")
+        except sqlite3.Error as e:
+            logging.getLogger("scan_index").warning(f"Could not update scan index {self.path}: {e}")
+        finally:
+            conn.close()
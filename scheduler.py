@@ -0,0 +1,131 @@
+"""
+scheduler.py — Cost-ordered, memory-bounded submission of per-TU jobs.
+
+main.py used to submit every TU to its thread pool up front, in compile
+database order.  A few huge TUs near the end of the database then run
+alone at the tail of the run, and with many workers the compilers of big
+TUs together can exhaust the machine's memory.
+
+schedule() submits jobs lazily, most expensive first (by the job_costs
+estimates of earlier runs), keeping at most max_jobs running and the sum of
+their expected peak memory within max_memory.  When the next job does not
+fit the budget nothing else starts until enough running jobs finished: a
+smaller job started in its place would push the big one towards the tail
+again.  A job larger than the whole budget runs alone.
+
+Every attempt at a job runs under its own JobControl (job_control.py) with
+a timeout.  Given a backup_fn, a job still running after the timeout is a
+straggler: a backup attempt (the same work, split up differently)
+starts on the next free worker, ahead of the pending jobs.  The original
+keeps running until twice the timeout; the first of the two to succeed is
+used and the other one is killed.
+"""
+
+import collections
+import concurrent.futures
+import time
+from typing import Callable, Dict, Iterator, NamedTuple, Optional, Sequence, Set, Tuple
+
+from job_control import JobControl
+from job_costs import JobCost
+
+
+class _Attempt(NamedTuple):
+    index: int
+    control: JobControl
+    backup: bool
+
+
+def schedule(executor: concurrent.futures.Executor,
+             fn: Callable,
+             jobs: Sequence[tuple],
+             costs: Sequence[JobCost],
+             max_jobs: int,
+             max_memory: Optional[int] = None,
+             timeout: Optional[float] = None,
+             backup_fn: Optional[Callable] = None) -> Iterator[Tuple[int, concurrent.futures.Future]]:
+    """
+    Run fn(control, *jobs[i]) on *executor* for every job and yield (i,
+    future) as each one completes.  costs[i] is the estimate for jobs[i];
+    max_memory is in bytes (None: no memory limit).
+
+    *control* is the attempt's JobControl, to be entered with
+    job_control.job_context().  With *timeout* (seconds) an attempt is
+    killed after that long; with *backup_fn* too, an attempt running longer
+    gets a backup, backup_fn(control, *jobs[i]) with the same timeout,
+    while the original may run on for twice the timeout.  A job's future is
+    the one of the attempt that succeeded (no exception, result not None)
+    first, or of the last one to fail.
+    """
+    hard_timeout = timeout * 2 if timeout is not None and backup_fn is not None else timeout
+    # Longest first; stable, so jobs without history keep database order
+    pending = collections.deque(sorted(range(len(jobs)), key=lambda i: -costs[i].seconds))
+    backups: collections.deque = collections.deque()
+    running: Dict[concurrent.futures.Future, _Attempt] = {}
+    speculated: Set[int] = set()
+    finished: Set[int] = set()
+    memory_in_use = 0
+
+    def start(queue: collections.deque, backup: bool) -> bool:
+        nonlocal memory_in_use
+        i = queue[0]
+        if running and max_memory is not None and memory_in_use + costs[i].peak_rss > max_memory:
+            return False
+        queue.popleft()
+        control = JobControl(timeout if backup else hard_timeout)
+        running[executor.submit(backup_fn if backup else fn, control, *jobs[i])] = _Attempt(i, control, backup)
+        memory_in_use += costs[i].peak_rss
+        return True
+
+    def straggling(attempt: _Attempt) -> Optional[float]:
+        """When the attempt becomes a straggler, if it may get a backup."""
+        if backup_fn is None or timeout is None or attempt.backup or attempt.index in speculated:
+            return None
+        if attempt.control.started is None:
+            return time.monotonic() + timeout
+        return attempt.control.started + timeout
+
+    try:
+        while pending or backups or running:
+            # Backups first: they stand in for jobs that are already late
+            while len(running) < max_jobs and (backups or pending):
+                if not start(backups if backups else pending, bool(backups)):
+                    break
+
+            deadlines = [t for t in map(straggling, running.values()) if t is not None]
+            wait_for = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            done, _ = concurrent.futures.wait(running, timeout=wait_for, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            now = time.monotonic()
+            for future, attempt in running.items():
+                if future in done:
+                    continue
+                deadline = straggling(attempt)
+                if deadline is not None and attempt.control.started is not None and deadline <= now:
+                    speculated.add(attempt.index)
+                    backups.append(attempt.index)
+
+            for future in done:
+                attempt = running.pop(future)
+                memory_in_use -= costs[attempt.index].peak_rss
+                i = attempt.index
+                if i in finished:
+                    # The losing attempt of a job, killed or too late
+                    continue
+                siblings = [other for other in running.values() if other.index == i]
+                queued = i in backups
+                if _succeeded(future) or (not siblings and not queued):
+                    finished.add(i)
+                    for other in siblings:
+                        other.control.cancel()
+                    if queued:
+                        backups.remove(i)
+                    yield i, future
+    finally:
+        # Ctrl-C, or the caller stopped iterating: kill what is still running
+        for attempt in running.values():
+            attempt.control.cancel()
+
+
+def _succeeded(future: concurrent.futures.Future) -> bool:
+    return future.exception() is None and future.result() is not None